@@ -0,0 +1,153 @@
+"""Simulates message routing with the old choose_bot policy and BotScheduler.
+
+Runs a discrete event simulation, no requests are sent. Usage:
+
+    python benchmarks/scheduler_sim.py [--requests 20000] [--rate 3.0] [--seed 1]
+"""
+import argparse
+import heapq
+import random
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set
+
+import source_tree
+from chatgpt_mixin.scheduler import BotScheduler
+
+class SimBot:
+    def __init__(self, name: str, ttft: float, generation: float, max_concurrency: int, error_rate: float, sticky: bool):
+        self.name = name
+        self.ttft = ttft
+        self.generation = generation
+        self.max_concurrency = max_concurrency
+        self.error_rate = error_rate
+        self.sticky = sticky
+        self.available = True
+        self.running = 0
+        self.waiting: Deque[tuple] = deque()
+        self.users: Set[str] = set()
+        self.on_users_changed = None
+
+def make_bots() -> List[SimBot]:
+    return [
+        SimBot('browser-1', ttft=6.0, generation=15.0, max_concurrency=1, error_rate=0.05, sticky=True),
+        SimBot('browser-2', ttft=6.0, generation=15.0, max_concurrency=1, error_rate=0.05, sticky=True),
+        SimBot('api-1', ttft=0.8, generation=6.0, max_concurrency=8, error_rate=0.01, sticky=False),
+        SimBot('api-2', ttft=0.8, generation=6.0, max_concurrency=8, error_rate=0.01, sticky=False),
+        SimBot('api-3', ttft=0.8, generation=6.0, max_concurrency=8, error_rate=0.01, sticky=False),
+        # a degraded key
+        SimBot('api-4', ttft=3.0, generation=6.0, max_concurrency=8, error_rate=0.2, sticky=False),
+    ]
+
+def choose_bot_legacy(bots: List[SimBot], user_id: str) -> Optional[SimBot]:
+    candidates = [bot for bot in bots if bot.available]
+    for bot in candidates:
+        if user_id in bot.users:
+            return bot
+    if not candidates:
+        return None
+    user_counts = [len(bot.users) for bot in candidates]
+    return candidates[user_counts.index(min(user_counts))]
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def simulate(policy: str, requests: int, rate: float, users: int, seed: int) -> Dict[str, float]:
+    rng = random.Random(seed)
+    random.seed(seed)
+    bots = make_bots()
+    scheduler = BotScheduler()
+    for bot in bots:
+        scheduler.add(bot)
+
+    events: List[tuple] = []
+    sequence = 0
+
+    def push(time, kind, *data):
+        nonlocal sequence
+        sequence += 1
+        heapq.heappush(events, (time, sequence, kind, data))
+
+    def start(now, bot, arrival):
+        bot.running += 1
+        ttft = rng.lognormvariate(0, 0.5) * bot.ttft
+        if rng.random() < bot.error_rate:
+            push(now + ttft, 'failed', bot, arrival)
+        else:
+            push(now + ttft, 'first_token', bot, arrival)
+            push(now + ttft + rng.lognormvariate(0, 0.5) * bot.generation, 'done', bot, now + ttft - arrival)
+
+    def next_waiting(now, bot):
+        bot.running -= 1
+        if bot.waiting:
+            start(now, bot, bot.waiting.popleft())
+
+    now = 0.0
+    for _ in range(requests):
+        now += rng.expovariate(rate)
+        push(now, 'arrival', f'user-{rng.randrange(users)}')
+
+    latencies: List[float] = []
+    errors = 0
+    usage: Dict[str, int] = {bot.name: 0 for bot in bots}
+    while events:
+        now, _, kind, data = heapq.heappop(events)
+        if kind == 'arrival':
+            user_id = data[0]
+            if policy == 'legacy':
+                bot = choose_bot_legacy(bots, user_id)
+                bot.users.add(user_id)
+            else:
+                bot = scheduler.choose(user_id)
+                scheduler.acquire(bot)
+                # a browser account keeps the conversations of the users it answers
+                if bot.sticky and user_id not in bot.users:
+                    bot.users.add(user_id)
+                    bot.on_users_changed(user_id, True)
+            usage[bot.name] += 1
+            if bot.running < bot.max_concurrency:
+                start(now, bot, now)
+            else:
+                bot.waiting.append(now)
+        elif kind == 'first_token':
+            bot, arrival = data
+            latencies.append(now - arrival)
+        elif kind == 'failed':
+            bot, arrival = data
+            errors += 1
+            if policy != 'legacy':
+                scheduler.release(bot, None, True)
+            next_waiting(now, bot)
+        elif kind == 'done':
+            bot, ttft = data
+            if policy != 'legacy':
+                scheduler.release(bot, ttft, False)
+            next_waiting(now, bot)
+
+    result = {
+        'mean': sum(latencies) / len(latencies),
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'errors': errors,
+    }
+    result.update(usage)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--rate', type=float, default=3.0, help='messages per second')
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{args.requests} messages of {args.users} users at {args.rate}/s, time to first token in seconds")
+    for policy in ('legacy', 'scheduler'):
+        result = simulate(policy, args.requests, args.rate, args.users, args.seed)
+        print(f"{policy:>10}: mean {result['mean']:7.2f}  p50 {result['p50']:7.2f}  p95 {result['p95']:7.2f}  "
+            f"p99 {result['p99']:7.2f}  errors {result['errors']}")
+        print(' ' * 12 + '  '.join(f"{bot.name} {result[bot.name]}" for bot in make_bots()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,17 @@
+"""Imported first by the benchmarks to run them against this checkout.
+
+setup.py installs src as the chatgpt_mixin package, there is no chatgpt_mixin
+directory to put on sys.path, so src is loaded under that name here.
+"""
+import importlib.util
+import os
+import sys
+
+src_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+if 'chatgpt_mixin' not in sys.modules:
+    spec = importlib.util.spec_from_file_location('chatgpt_mixin', os.path.join(src_dir, '__init__.py'),
+        submodule_search_locations=[src_dir])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules['chatgpt_mixin'] = package
+    spec.loader.exec_module(package)
@@ -0,0 +1,75 @@
+"""Measures how long the bot takes to start taking messages.
+
+Imports are timed in fresh interpreters: what startup imports now, and the openai
+sdk with the tiktoken encoding it used to load before the event loop started.
+Backend initialization is simulated with the given seconds per backend, like a
+browser login and a few api keys, initialized one after the other as before and
+concurrently as now, the bot takes messages once the first backend is ready. Usage:
+
+    python benchmarks/startup.py [--runs 5] [--backends 8,0.3,0.3,0.3]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Tuple
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+
+IMPORTS = {
+    'mixinbot': 'import chatgpt_mixin.mixinbot',
+    'mixinbot + openai + tiktoken': 'import chatgpt_mixin.mixinbot, chatgpt_mixin.chatgpt_openai; '
+        'from chatgpt_mixin.tokenizer import g_tokenizer; g_tokenizer.load()',
+}
+
+def time_import(statement: str, cwd: str) -> float:
+    # source_tree only registers the package, the modules are imported by the statement
+    code = f'import source_tree, time; start = time.perf_counter(); {statement}; print(time.perf_counter() - start)'
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([benchmarks_dir, os.environ.get('PYTHONPATH', '')]))
+    out = subprocess.run([sys.executable, '-c', code], cwd=cwd, env=env, check=True, capture_output=True, text=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+async def init_backend(delay: float):
+    await asyncio.sleep(delay)
+
+async def sequential(delays: List[float]) -> Tuple[float, float]:
+    start = time.monotonic()
+    for delay in delays:
+        await init_backend(delay)
+    # nothing was taken until all were ready
+    total = time.monotonic() - start
+    return total, total
+
+async def concurrent(delays: List[float]) -> Tuple[float, float]:
+    start = time.monotonic()
+    tasks = [asyncio.create_task(init_backend(delay)) for delay in delays]
+    await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    first = time.monotonic() - start
+    await asyncio.gather(*tasks)
+    return first, time.monotonic() - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--backends', default='8,0.3,0.3,0.3', help='seconds to initialize each backend')
+    args = parser.parse_args()
+    delays = [float(delay) for delay in args.backends.split(',')]
+
+    print(f"{'imports':<32}{'median s':>10}{'min s':>10}")
+    with tempfile.TemporaryDirectory() as cwd:
+        for name, statement in IMPORTS.items():
+            times = [time_import(statement, cwd) for _ in range(args.runs)]
+            print(f'{name:<32}{statistics.median(times):>10.3f}{min(times):>10.3f}')
+
+    print()
+    print(f"{'backends ' + args.backends:<32}{'first s':>10}{'all s':>10}")
+    for name, init in (('sequential', sequential), ('concurrent', concurrent)):
+        first, total = asyncio.run(init(delays))
+        print(f'{name:<32}{first:>10.3f}{total:>10.3f}')
+
+if __name__ == '__main__':
+    main()
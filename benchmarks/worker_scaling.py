@@ -0,0 +1,100 @@
+"""Measures message throughput of WorkerPool by number of worker processes.
+
+Each message costs about what answering it costs the bot process: decoding the
+message, parsing the streamed completion chunks, pickling the conversation and
+sending the answer back, no requests are sent. Usage:
+
+    python benchmarks/worker_scaling.py [--messages 2000] [--chunks 300] [--workers 1,2,4]
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import pickle
+import time
+import uuid
+from typing import List
+
+from pymixin.mixin_ws_api import MessageView
+
+import source_tree
+from chatgpt_mixin.workers import WorkerPool
+
+def make_message(index: int) -> MessageView:
+    text = f'question {index}: ' + 'please explain how this works. ' * 20
+    return MessageView(
+        type='message', representative_id='', quote_message_id='',
+        conversation_id=str(uuid.uuid4()), user_id=str(uuid.uuid4()), session_id='',
+        message_id=str(uuid.uuid4()), category='PLAIN_TEXT',
+        data=base64.urlsafe_b64encode(text.encode()).decode(), data_base64='',
+        status='SENT', source='', created_at='', updated_at=''
+    )
+
+def answer(msg: MessageView, chunks: int) -> str:
+    question = base64.urlsafe_b64decode(msg.data).decode()
+    events = [
+        'data: ' + json.dumps({'id': msg.message_id, 'object': 'chat.completion.chunk',
+            'choices': [{'index': 0, 'delta': {'content': f'token{i} '}, 'finish_reason': None}]})
+        for i in range(chunks)
+    ]
+    reply = ''.join(json.loads(event[6:])['choices'][0]['delta']['content'] for event in events)
+    pickle.dumps({'question': question, 'reply': reply, 'history': [question, reply] * 4})
+    return reply
+
+def bench_worker(config_file, index, inbox, replies):
+    chunks = int(config_file)
+    replies.put(('ready', index))
+    while True:
+        msg = inbox.get()
+        if msg is None:
+            return
+        replies.put(('text', msg.conversation_id, msg.user_id, answer(msg, chunks)))
+
+async def run_single(messages: List[MessageView], chunks: int) -> float:
+    start = time.monotonic()
+    for msg in messages:
+        answer(msg, chunks)
+        # yield to the event loop as the bot does between messages
+        await asyncio.sleep(0)
+    return time.monotonic() - start
+
+async def run_pool(messages: List[MessageView], chunks: int, workers: int) -> float:
+    done = asyncio.Event()
+    received = 0
+
+    def on_text(conversation_id: str, user_id: str, text: str):
+        nonlocal received
+        received += 1
+        if received == len(messages):
+            done.set()
+
+    pool = WorkerPool(str(chunks), workers, bench_worker)
+    await pool.start(on_text)
+    for index in range(workers):
+        await pool.wait_ready(index)
+    start = time.monotonic()
+    for msg in messages:
+        pool.dispatch(msg.user_id, msg)
+    await done.wait()
+    duration = time.monotonic() - start
+    await pool.close()
+    return duration
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--chunks', type=int, default=300, help='streamed chunks per answer')
+    parser.add_argument('--workers', default=','.join(str(n) for n in (1, 2, 4, 8) if n <= (os.cpu_count() or 1) * 2))
+    args = parser.parse_args()
+
+    messages = [make_message(i) for i in range(args.messages)]
+    print(f'{os.cpu_count()} cores, {args.messages} messages, {args.chunks} chunks per answer')
+    baseline = args.messages / await run_single(messages, args.chunks)
+    print(f'{"single process":>16}: {baseline:8.1f} messages/s')
+    for workers in [int(n) for n in args.workers.split(',')]:
+        throughput = args.messages / await run_pool(messages, args.chunks, workers)
+        print(f'{workers:>8} workers: {throughput:8.1f} messages/s, {throughput / baseline:.2f}x')
+
+if __name__ == '__main__':
+    asyncio.run(main())
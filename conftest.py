@@ -0,0 +1,12 @@
+import importlib.util
+import os
+import sys
+
+# setup.py installs src as the chatgpt_mixin package, the tests import the modules of
+# this checkout by that name without installing it
+src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src')
+spec = importlib.util.spec_from_file_location('chatgpt_mixin', os.path.join(src_dir, '__init__.py'),
+    submodule_search_locations=[src_dir])
+package = importlib.util.module_from_spec(spec)
+sys.modules['chatgpt_mixin'] = package
+spec.loader.exec_module(package)
@@ -0,0 +1,87 @@
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Deque, List, Optional
+
+from pymixin import log
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+SendAcks = Callable[[List[str]], Awaitable]
+
+class AckBatcher:
+    """Acknowledges received messages in batches from a background task.
+
+    A batch is sent once `max_batch` ids are collected or `max_delay` seconds after
+    the first one. Ids of a failed batch are kept and sent again with the next one.
+    """
+
+    def __init__(self, send: SendAcks, max_batch: int = 100, max_delay: float = 0.05, retry_delay: float = 1.0):
+        self.send = send
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.retry_delay = retry_delay
+        self.pending: Deque[str] = deque()
+        self.wake = asyncio.Event()
+        self.full = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.acked = 0
+
+    def add(self, message_id: str):
+        self.pending.append(message_id)
+        if len(self.pending) >= self.max_batch:
+            self.full.set()
+        self.wake.set()
+        if not self.task:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await self.wake.wait()
+            try:
+                await asyncio.wait_for(self.full.wait(), self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            if not await self.flush_batch():
+                await asyncio.sleep(self.retry_delay)
+
+    async def flush_batch(self) -> bool:
+        """Send up to `max_batch` pending acks, return False if sending failed."""
+        batch = [self.pending.popleft() for _ in range(min(self.max_batch, len(self.pending)))]
+        if len(self.pending) < self.max_batch:
+            self.full.clear()
+        if not self.pending:
+            self.wake.clear()
+        if not batch:
+            return True
+        try:
+            await self.send(batch)
+        except asyncio.CancelledError:
+            self.pending.extendleft(reversed(batch))
+            raise
+        except Exception as e:
+            logger.info("+++sending %s acks failed: %s", len(batch), e)
+            self.pending.extendleft(reversed(batch))
+            self.wake.set()
+            return False
+        self.batches += 1
+        self.acked += len(batch)
+        return True
+
+    async def close(self, attempts: int = 3):
+        """Stop the background task and send all pending acks."""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        failures = 0
+        while self.pending and failures < attempts:
+            if not await self.flush_batch():
+                failures += 1
+                await asyncio.sleep(self.retry_delay)
+        if self.pending:
+            logger.warning("+++%s acks could not be sent", len(self.pending))
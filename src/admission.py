@@ -0,0 +1,150 @@
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Set
+
+from pymixin import log
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+@dataclass
+class Job:
+    user_id: str
+    conversation_id: str
+    handler: Callable[[], Awaitable[Any]]
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+@dataclass
+class Flow:
+    # messages served per round
+    weight: int
+    queue: Deque[Job] = field(default_factory=deque)
+    deficit: int = 0
+
+class AdmissionController:
+    """Bounds the messages handled at a time and shares the capacity fairly between users.
+
+    Messages are queued per user and served by deficit round robin, a user gets
+    `dm_weight` or `group_weight` messages per round depending on where the message
+    was sent. A user has at most `max_user_in_flight` and a conversation at most
+    `max_conversation_in_flight` messages handled at a time. Messages beyond
+    `max_queue` queued messages in total or `max_user_queue` of one user are shed.
+    """
+
+    def __init__(self, max_in_flight: int = 32, max_queue: int = 1000, max_user_queue: int = 20,
+                max_user_in_flight: int = 1, max_conversation_in_flight: int = 4,
+                dm_weight: int = 2, group_weight: int = 1):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_user_queue = max_user_queue
+        self.max_user_in_flight = max_user_in_flight
+        self.max_conversation_in_flight = max_conversation_in_flight
+        self.dm_weight = max(1, dm_weight)
+        self.group_weight = max(1, group_weight)
+        self.flows: Dict[str, Flow] = {}
+        # users with queued messages in round robin order
+        self.active: Deque[str] = deque()
+        self.user_in_flight: Dict[str, int] = {}
+        self.conversation_in_flight: Dict[str, int] = {}
+        self.tasks: Set[asyncio.Task] = set()
+        self.queued = 0
+        self.admitted = 0
+        self.shed = 0
+        self.wait_times: Deque[float] = deque(maxlen=1000)
+
+    @classmethod
+    def from_config(cls, config) -> 'AdmissionController':
+        if not config:
+            return cls()
+        return cls(**config)
+
+    def set_limits(self, **limits):
+        """Change limits in place, weights apply to users queueing from now on."""
+        for name, value in limits.items():
+            if not hasattr(self, name):
+                raise ValueError(f"unknown admission limit: {name}")
+            setattr(self, name, max(1, value) if name in ('dm_weight', 'group_weight') else value)
+        # a larger max_in_flight admits queued messages right away
+        self.dispatch()
+
+    def submit(self, user_id: str, conversation_id: str, direct: bool, handler: Callable[[], Awaitable[Any]]) -> bool:
+        """Queue `handler` for a message of `user_id`, return False if the message is shed."""
+        flow = self.flows.get(user_id)
+        if self.queued >= self.max_queue or (flow and len(flow.queue) >= self.max_user_queue):
+            self.shed += 1
+            logger.info("+++shed message of %s, %s messages queued", user_id, self.queued)
+            return False
+        if not flow:
+            flow = Flow(self.dm_weight if direct else self.group_weight)
+            self.flows[user_id] = flow
+            self.active.append(user_id)
+        flow.queue.append(Job(user_id, conversation_id, handler))
+        self.queued += 1
+        self.admitted += 1
+        self.dispatch()
+        return True
+
+    def eligible(self, job: Job) -> bool:
+        return self.user_in_flight.get(job.user_id, 0) < self.max_user_in_flight and \
+            self.conversation_in_flight.get(job.conversation_id, 0) < self.max_conversation_in_flight
+
+    def next_job(self) -> Optional[Job]:
+        # every flow is visited at most twice, once to top up its deficit and once to be served
+        for _ in range(2 * len(self.active)):
+            user_id = self.active[0]
+            flow = self.flows[user_id]
+            if not self.eligible(flow.queue[0]):
+                self.active.rotate(-1)
+                continue
+            if flow.deficit < 1:
+                flow.deficit += flow.weight
+            flow.deficit -= 1
+            job = flow.queue.popleft()
+            if not flow.queue:
+                self.active.popleft()
+                del self.flows[user_id]
+            elif flow.deficit < 1:
+                self.active.rotate(-1)
+            return job
+        return None
+
+    def dispatch(self):
+        while len(self.tasks) < self.max_in_flight and self.active:
+            job = self.next_job()
+            if not job:
+                return
+            self.queued -= 1
+            self.wait_times.append(time.monotonic() - job.enqueued_at)
+            self.user_in_flight[job.user_id] = self.user_in_flight.get(job.user_id, 0) + 1
+            self.conversation_in_flight[job.conversation_id] = self.conversation_in_flight.get(job.conversation_id, 0) + 1
+            task = asyncio.create_task(job.handler())
+            self.tasks.add(task)
+            task.add_done_callback(lambda task, job=job: self.finished(task, job))
+
+    def finished(self, task: asyncio.Task, job: Job):
+        self.tasks.discard(task)
+        for counts, key in ((self.user_in_flight, job.user_id), (self.conversation_in_flight, job.conversation_id)):
+            counts[key] -= 1
+            if not counts[key]:
+                del counts[key]
+        if not task.cancelled() and task.exception():
+            logger.error("message handler failed", exc_info=task.exception())
+        self.dispatch()
+
+    def stats(self) -> Dict[str, float]:
+        """Queue depth and the seconds recent messages waited, `oldest_wait` is of the queued ones."""
+        wait_times = sorted(self.wait_times)
+        now = time.monotonic()
+        return {
+            'queued': self.queued,
+            'in_flight': len(self.tasks),
+            'users_queued': len(self.flows),
+            'admitted': self.admitted,
+            'shed': self.shed,
+            'wait_p50': wait_times[len(wait_times) // 2] if wait_times else 0.0,
+            'wait_p95': wait_times[int(len(wait_times) * 0.95)] if wait_times else 0.0,
+            'wait_max': wait_times[-1] if wait_times else 0.0,
+            'oldest_wait': max((now - flow.queue[0].enqueued_at for flow in self.flows.values()), default=0.0),
+        }
@@ -0,0 +1,175 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, List, Optional
+
+from pymixin import log
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+# attributes set with `extra=` that are written as fields of their own
+structured_fields = ('category', 'conversation', 'user', 'bot', 'stage', 'duration')
+
+def truncate(value: str, max_length: int) -> str:
+    if max_length <= 0 or len(value) <= max_length:
+        return value
+    return f'{value[:max_length]}...({len(value) - max_length} more)'
+
+class StructuredFormatter(logging.Formatter):
+    """Formats records as JSON objects, or as text lines, with the structured fields and long texts truncated."""
+
+    def __init__(self, json_format: bool = True, max_length: int = 1000):
+        super().__init__()
+        self.json_format = json_format
+        self.max_length = max_length
+
+    def fields(self, record: logging.LogRecord) -> Dict[str, Any]:
+        fields = {}
+        for name in structured_fields:
+            value = getattr(record, name, None)
+            if value is not None:
+                fields[name] = truncate(value, self.max_length) if isinstance(value, str) else value
+        return fields
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = truncate(record.getMessage(), self.max_length)
+        exception = self.formatException(record.exc_info) if record.exc_info else None
+        if not self.json_format:
+            extra = ''.join(f' {name}={value}' for name, value in self.fields(record).items())
+            line = f'{self.formatTime(record)} {record.levelname} {record.module} {record.funcName} {record.lineno} {message}{extra}'
+            return line + '\n' + exception if exception else line
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'func': record.funcName,
+            'line': record.lineno,
+            'message': message,
+        }
+        entry.update(self.fields(record))
+        if exception:
+            entry['exception'] = exception
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class SamplingFilter(logging.Filter):
+    """Keeps a `sample_rates` share of the records of each category, warnings and errors are always kept."""
+
+    def __init__(self, sample_rates: Optional[Dict[str, float]] = None):
+        super().__init__()
+        self.sample_rates = dict(sample_rates or {})
+        self.sampled_out = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        category = getattr(record, 'category', None)
+        if category is None or record.levelno >= logging.WARNING:
+            return True
+        rate = self.sample_rates.get(category, 1.0)
+        if rate >= 1.0 or random.random() < rate:
+            return True
+        self.sampled_out += 1
+        return False
+
+class DeferredQueueHandler(QueueHandler):
+    """Queues records unformatted, the arguments are formatted by the writer thread.
+
+    A full queue drops the record instead of blocking the event loop.
+    """
+
+    def __init__(self, records: 'queue.Queue[logging.LogRecord]'):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class AsyncLogging:
+    """Writes the log records of this process from a background thread.
+
+    The records of all loggers are queued by one handler on the root logger, in
+    place of the file and terminal handlers that format and write on the calling
+    thread. Records logged with a `category` in their `extra` fields are sampled
+    by `sample_rates`, texts are cut at `max_length` characters when written.
+    """
+
+    def __init__(self, path: Optional[str] = 'logfile.log', stderr: bool = True, format: str = 'json',
+                max_length: int = 1000, queue_size: int = 10000, sample_rates: Optional[Dict[str, float]] = None):
+        if format not in ('json', 'text'):
+            raise ValueError(f"unknown log format: {format}")
+        self.formatter = StructuredFormatter(format == 'json', max_length)
+        self.handlers: List[logging.Handler] = []
+        if path:
+            self.handlers.append(logging.FileHandler(path, encoding='utf-8'))
+        if stderr:
+            self.handlers.append(logging.StreamHandler(sys.stderr))
+        for handler in self.handlers:
+            handler.setFormatter(self.formatter)
+        self.queue_handler = DeferredQueueHandler(queue.Queue(queue_size))
+        self.sampling = SamplingFilter(sample_rates)
+        self.queue_handler.addFilter(self.sampling)
+        self.listener = QueueListener(self.queue_handler.queue, *self.handlers)
+        self.replaced: List[logging.Handler] = []
+        self.started = False
+
+    @classmethod
+    def from_config(cls, config) -> Optional['AsyncLogging']:
+        """None in the default sync mode, records are written by the handlers of pymixin."""
+        if not config or config.get('mode', 'sync') != 'async':
+            return None
+        config = {key: value for key, value in config.items() if key != 'mode'}
+        return cls(**config)
+
+    def start(self):
+        root = logging.getLogger()
+        self.replaced = list(root.handlers)
+        for handler in self.replaced:
+            root.removeHandler(handler)
+        root.addHandler(self.queue_handler)
+        # the module loggers write to the terminal with this handler and propagate to the root logger
+        log.handler.setLevel(logging.CRITICAL + 1)
+        self.listener.start()
+        self.started = True
+        # records still queued at exit are written
+        atexit.register(self.stop)
+        logger.info("+++logging from a background thread")
+
+    def configure(self, max_length: Optional[int] = None, sample_rates: Optional[Dict[str, float]] = None, **_):
+        """Change the sampling and truncation in place, other settings need a restart."""
+        if max_length is not None:
+            self.formatter.max_length = max_length
+        if sample_rates is not None:
+            self.sampling.sample_rates = dict(sample_rates)
+
+    def stop(self):
+        if not self.started:
+            return
+        self.started = False
+        start = time.monotonic()
+        self.listener.stop()
+        root = logging.getLogger()
+        root.removeHandler(self.queue_handler)
+        for handler in self.replaced:
+            root.addHandler(handler)
+        log.handler.setLevel(logging.NOTSET)
+        for handler in self.handlers:
+            handler.close()
+        atexit.unregister(self.stop)
+        logger.info("+++wrote the queued log records in %.3f seconds", time.monotonic() - start)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'queued': self.queue_handler.queue.qsize(),
+            'dropped': self.queue_handler.dropped,
+            'sampled_out': self.sampling.sampled_out,
+        }
@@ -9,13 +9,16 @@ import re
 import shelve
 import time
 import uuid
-from typing import Any, Dict, Optional, Tuple, Union
+from typing import Any, Callable, Dict, Optional, Tuple, Union
 
 from cf_clearance import StealthConfig
 from playwright.async_api import BrowserContext as AsyncContext
 from playwright.async_api import Page as AsyncPage
 from pymixin import log
 
+from . import metrics, tracing
+from .flush_policy import FlushPolicy
+
 logger = log.get_logger(__name__)
 logger.addHandler(log.handler)
 
@@ -59,25 +62,27 @@ auto_send_messages = [
 ]
 
 class MessageParser:
-    def __init__(self):
+    def __init__(self, policy: Optional[FlushPolicy] = None):
+        self.policy = policy or FlushPolicy()
         self.pos = 0
         self.message = None
-        self.start = time.time()
+        self.first = True
+        self.start = time.monotonic()
 
     def feed(self, message: str):
+        # the backend sends the whole message generated so far
         self.message = message
 
     def get_message(self):
-        if time.time() - self.start < 1.0:
-            return None
-        try:
-            last_index = self.message.rindex('\n\n', self.pos)
-            pos = self.pos
-            self.pos = last_index + 2
-            self.start = time.time()
-            return self.message[pos: self.pos]
-        except ValueError:
+        now = time.monotonic()
+        pos = self.policy.flush_position(self.message[self.pos:], now - self.start, self.first)
+        if not pos:
             return None
+        start = self.pos
+        self.pos += pos
+        self.first = False
+        self.start = now
+        return self.message[start: self.pos]
 
     def get_remanent_message(self):
         return self.message[self.pos:]
@@ -97,13 +102,22 @@ class ChatGPTUser:
         return self.expiration < time.time()
 
 class ChatGPTBot:
+    # conversations live in the account, users have to stay with it
+    sticky = True
+    # messages are sent one at a time through the page
+    max_concurrency = 1
 
-    def __init__(self, PLAY: Any, user: str, password: str, model='gpt-4'):
+    def __init__(self, PLAY: Any, user: str, password: str, model='gpt-4', flush_policy: Optional[FlushPolicy] = None,
+                expired_user_ttl: float = 0.0):
         self.page: Optional[Any] = None
+        self.browser: Optional[Any] = None
+        self.heart_beat_task: Optional[asyncio.Task] = None
         self.access_token: Optional[str] = None
 
         self.PLAY = PLAY
         self.user = user
+        # label of the bot in metrics
+        self.name = user
         self.password = password
         self._standby: bool = False
         self._busy: bool = False
@@ -117,9 +131,14 @@ class ChatGPTBot:
             os.mkdir('.db')
         self.users = shelve.open(f".db/{user}-1")
         self.expired_user = shelve.open(f".db/{user}-2")
+        # seconds expired users are remembered, 0 remembers them forever
+        self.expired_user_ttl = expired_user_ttl
+        # called with a user id and whether `users` holds it now, set by the scheduler
+        self.on_users_changed: Optional[Callable[[str, bool], None]] = None
 
         self.alive_counter = 0
         self.model = model #'text-davinci-002-render',
+        self.flush_policy = flush_policy or FlushPolicy()
 
     @property
     def standby(self):
@@ -129,6 +148,10 @@ class ChatGPTBot:
     def standby(self, value):
         self._standby = value
 
+    @property
+    def available(self):
+        return not self._standby
+
     @property
     def busy(self):
         return self._busy
@@ -140,6 +163,8 @@ class ChatGPTBot:
     def handle_expired_user(self, user: ChatGPTUser):
         self.expired_user[user.user_id] = user
         self.users.pop(user.user_id, None)
+        if self.on_users_changed:
+            self.on_users_changed(user.user_id, False)
 
     def reset_alive_counter(self):
         self.alive_counter = 0
@@ -159,10 +184,19 @@ class ChatGPTBot:
 
                 await asyncio.sleep(1.0)
         except asyncio.CancelledError:
-            logger.info("+++++++saving data on exit...")
-            self.close()
+            # the data is saved by close
+            logger.info("+++++++heart beat of %s stopped", self.user)
 
     async def close(self):
+        # retired by a config reload while the bot keeps running
+        if self.heart_beat_task and not self.heart_beat_task.done():
+            self.heart_beat_task.cancel()
+        if self.browser:
+            try:
+                await self.browser.close()
+            except Exception as e:
+                logger.info("+++closing the browser of %s failed: %s", self.user, e)
+            self.browser = None
         self.users.close()
         self.expired_user.close()
 
@@ -170,6 +204,15 @@ class ChatGPTBot:
         for user in self.users.values():
             if user.is_expired():
                 self.handle_expired_user(user)
+        if self.expired_user_ttl > 0 and self.alive_counter % 600 == 0:
+            self.forget_expired_users()
+
+    def forget_expired_users(self):
+        forgotten = [user_id for user_id, user in self.expired_user.items() if user.expiration < time.time() - self.expired_user_ttl]
+        for user_id in forgotten:
+            del self.expired_user[user_id]
+        if forgotten:
+            logger.info("+++forgot %s expired users, run `python -m chatgpt_mixin compact` to reclaim the space", len(forgotten))
 
     async def keep_alive(self):
         self.alive_counter += 1
@@ -199,22 +242,23 @@ class ChatGPTBot:
     async def on_response(self, response):
         url = response.url
         if not (url.endswith('.otf') or url.endswith('.js')):
-            logger.info(f"Response: {url} {response.status}")
+            logger.info("Response: %s %s", url, response.status, extra={'category': 'http_response', 'bot': self.name})
         if url.endswith("api/auth/session"):
             if response.status == 200:
                 body = await response.json()
-                logger.info(f"body: {body}")
+                logger.info("body: %s", body, extra={'category': 'http_response', 'bot': self.name})
                 if body:
                     self.access_token = body["accessToken"]
                     logger.info("++++=access token: %s", self.access_token)
 
     async def init(self):
-        asyncio.create_task(self.heart_beat())
+        self.heart_beat_task = asyncio.create_task(self.heart_beat())
 
         BROWSER = await self.PLAY.firefox.launch_persistent_context(
             user_data_dir=f"/tmp/playwright/firefox-{self.user}",
             headless=False
         )
+        self.browser = BROWSER
 
         self.page = await BROWSER.new_page()
         self.page.on('response', self.on_response)
@@ -306,9 +350,13 @@ class ChatGPTBot:
             user.reset_expiration()
             del self.expired_user[user_id]
             self.users[user_id] = user
+            if self.on_users_changed:
+                self.on_users_changed(user_id, True)
         else:
             user = ChatGPTUser(user_id)
-            self.users[user_id] = user        
+            self.users[user_id] = user
+            if self.on_users_changed:
+                self.on_users_changed(user_id, True)
         return user
 
     def reset_conversation_id(self, user_id):
@@ -324,8 +372,12 @@ class ChatGPTBot:
             yield 'Done'
             return
         try:
+            lock_wait = time.monotonic()
             async with self.lock:
-                user = self.get_user(user_id)
+                # messages to a browser account are answered one at a time
+                tracing.add_span('bot_lock', lock_wait, bot=self.name)
+                with tracing.span('get_user', bot=self.name):
+                    user = self.get_user(user_id)
                 self.busy = True
                 async for msg in self._send_message(user, message):
                     yield msg
@@ -338,7 +390,7 @@ class ChatGPTBot:
         if not user.parent_message_id:
             user.parent_message_id = str(uuid.uuid4())
 
-        parser = MessageParser()
+        parser = MessageParser(self.flush_policy)
 
         logger.info("++++++conversation_id: %s, parent_message_id: %s", user.conversation_id, user.parent_message_id)
         body = {
@@ -390,8 +442,10 @@ class ChatGPTBot:
         }
     '''
         ret = None
+        requested = time.monotonic()
         try:
-            ret = await self.page.evaluate(script, { 'url': url, 'body': json.dumps(body), "accessToken": self.access_token })
+            with tracing.span('request', bot=self.name):
+                ret = await self.page.evaluate(script, { 'url': url, 'body': json.dumps(body), "accessToken": self.access_token })
         except Exception as e:
             logger.exception(e)
             await self.reload()
@@ -403,13 +457,16 @@ class ChatGPTBot:
             if 'Conversation not found' in ret:
                 self.reset_conversation_id(user.user_id)
             elif 'Rate limit reached' in ret:
+                metrics.bot_rate_limited.inc(self.name)
                 self.standby = True
             elif 'Too many requests' in ret:
+                metrics.bot_rate_limited.inc(self.name)
                 self.standby = True
                 raise TooManyRequestsException(ret)
             raise ChatGPTException(ret)
         yield "[BEGIN]\n"
         done = False
+        first_message = True
         buffer = b''
         while not done:
             try:
@@ -446,6 +503,9 @@ class ChatGPTBot:
                 message = parser.get_message()
                 if message:
                     logger.info("++++++message %s", message)
+                    if first_message:
+                        first_message = False
+                        tracing.add_span('first_token', requested, bot=self.name)
                     yield message
                 else:
                     await asyncio.sleep(0.0)
@@ -453,8 +513,10 @@ class ChatGPTBot:
         if message:
             logger.info("++++++last message: %s", message)
             yield message
+        tracing.add_span('completion', requested, bot=self.name)
         self.reset_alive_counter()
-        self.users[user.user_id] = user
+        with tracing.span('save_user', bot=self.name):
+            self.users[user.user_id] = user
         return
 
 async def run():
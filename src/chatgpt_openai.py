@@ -1,180 +1,311 @@
 import asyncio
+import functools
 import json
 import os
-import shelve
 import time
 import uuid
+import weakref
 from collections import deque
-from dataclasses import dataclass
 from datetime import datetime
 from typing import Any, Dict, List, Optional, Tuple
 
-from openai import AsyncOpenAI
-import tiktoken
+from openai import AsyncOpenAI, RateLimitError
 from pymixin import log
-import httpx
+
+from . import metrics, tracing
+from .conversation_cache import ConversationCache, default_max_bytes, default_ttl
+from .conversation_store import ConversationStore, Message
+from .flush_policy import FlushPolicy, StreamBuffer
+from .http_pool import HttpPool
+from .rate_limiter import ApiRateLimitError, get_rate_limiter
+from .resilience import RetryPolicy
+from .response_cache import ResponseCache, response_key
+from .single_flight import SingleFlight
+from .tokenizer import count_tokens, g_tokenizer
 
 logger = log.get_logger(__name__)
 logger.addHandler(log.handler)
 
-if not os.path.exists('.db'):
-    os.mkdir('.db')
-g_conversations = shelve.open(f".db/conversations")
-
+default_model = "gpt-3.5-turbo"
 default_role = 'You are a helpful assistant'
 max_prompt_token = 3000
-gpt_encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+# upper bound of messages fetched for a prompt, each message costs at least one token
+max_chain_length = max_prompt_token
+
+if not os.path.exists('.db'):
+    os.mkdir('.db')
+# the old shelve database is migrated on the first start
+g_conversations = ConversationCache(
+    ConversationStore(".db/conversations.sqlite3", shelve_path=".db/conversations", count_tokens=count_tokens)
+)
 
 rate_limit_size = 5
 rate_limit_window_seconds = 60
 
+# concurrent requests served by one api key
+default_max_concurrency = 8
+
+# completion tokens reserved from the token budget of a key before a request is sent
+expected_completion_tokens = 500
+# seconds to wait for the budget of a rate limited key before giving up
+max_rate_limit_wait = 10.0
+
+summary_prompt = 'Summarize the conversation above in a short paragraph. Keep names, facts, decisions and open questions, write in the language of the conversation.'
+summary_prefix = 'Summary of the earlier conversation: '
+
+# cached answers are fed to the stream buffer in pieces of this size, like streamed deltas
+replay_chunk_size = 16
+
+# conversations with a summary in progress
+g_summary_tasks: Dict[str, asyncio.Task] = {}
+
+# identical questions without context asked at the same time share one upstream stream
+g_single_flight = SingleFlight()
+
+# initialized bots, failed requests are retried with the keys of other bots
+g_bots: List['ChatGPTBot'] = []
+
+# turns of a conversation are handled one at a time, whichever bot serves them
+g_conversation_locks: 'weakref.WeakValueDictionary[str, asyncio.Lock]' = weakref.WeakValueDictionary()
+
+def get_conversation_lock(conversation_id: str) -> asyncio.Lock:
+    lock = g_conversation_locks.get(conversation_id)
+    if not lock:
+        lock = asyncio.Lock()
+        g_conversation_locks[conversation_id] = lock
+    return lock
+
 class RateLimitExceededError(Exception):
     pass
 
-@dataclass
-class Message:
-    message: str
-    parent_message_id: Optional[str]
-    completion: str
-
 class ChatGPTBot:
-    def __init__(self, api_key: str, base_url: str = '', proxy_url: str = '', stream=True):
-        if proxy_url:
-            proxies = {
-                "http://": proxy_url,
-                "https://": proxy_url
-            }
-        else:
-            proxies = {}
+    # conversations live in the shared store, any bot can continue them
+    sticky = False
+
+    def __init__(self, api_key: str, base_url: str = '', proxy_url: str = '', stream=True,
+                cache_max_bytes: int = default_max_bytes, cache_ttl: float = default_ttl,
+                max_concurrency: int = default_max_concurrency, flush_policy: Optional[FlushPolicy] = None,
+                requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None,
+                summarize_threshold: int = 0, summarize_keep_tokens: int = 1000,
+                response_cache: Optional[ResponseCache] = None, retry_policy: Optional[RetryPolicy] = None,
+                http_pool: Optional[HttpPool] = None):
+        self.http_pool = http_pool or HttpPool()
+        self.http_pool.add_warm_up(base_url, proxy_url)
         self.openai = AsyncOpenAI(
-            base_url=base_url,
+            base_url=base_url or None,
             api_key=api_key,
-            http_client=httpx.AsyncClient(proxies=proxies),
+            http_client=self.http_pool.client(proxy_url),
         )
         self.conversation_id = uuid.uuid4()
+        # label of the bot in metrics, without the secret part of the key
+        self.name = 'openai-' + api_key[-4:]
 
         self.standby = False
-        self.users: Dict[str, bool] = {}
 
-        self.lock = asyncio.Lock()
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.flush_policy = flush_policy or FlushPolicy()
+        self.rate_limiter = get_rate_limiter(api_key, requests_per_minute, tokens_per_minute)
+        # once a chain is larger than summarize_threshold tokens, all but the newest
+        # summarize_keep_tokens tokens are summarized, 0 disables summaries
+        self.summarize_threshold = summarize_threshold
+        self.summarize_keep_tokens = summarize_keep_tokens
+        self.model = default_model
+        self.response_cache = response_cache
+        self.retry_policy = retry_policy or RetryPolicy()
         self.stream = stream
         self.rate_limits: Dict[str, deque] = {}
+        self.cache_max_bytes = cache_max_bytes
+        self.cache_ttl = cache_ttl
+
+    @property
+    def available(self):
+        return not self.standby and self.rate_limiter.available(expected_completion_tokens)
 
     async def init(self):
-        pass
+        g_conversations.set_limits(self.cache_max_bytes, self.cache_ttl)
+        await g_conversations.open()
+        if self.response_cache:
+            self.response_cache.attach(g_conversations.store)
+        g_bots.append(self)
+
+    def set_max_concurrency(self, max_concurrency: int):
+        # requests holding or waiting for the old semaphore finish with it
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
 
     async def close(self):
-        global g_conversations
-        if not g_conversations:
+        # not started, the store may be opening for another api key
+        if self not in g_bots:
             return
-        g_conversations.close()
-        g_conversations = None
+        g_bots.remove(self)
+        # the store is shared with the other api keys
+        if not g_bots:
+            await g_conversations.close()
 
     def generate_key(self, conversation_id: str, message_id: str):
         return f'{conversation_id}-{message_id}'
 
-    def get_parent_messsage(self, conversation_id: str, message_id: str) -> Optional[Message]:
-        key = self.generate_key(conversation_id, message_id)
-        if key in g_conversations:
-            return g_conversations[key]
-        return None
+    async def get_parent_messsage(self, conversation_id: str, message_id: str) -> Optional[Message]:
+        return await g_conversations.get_message(conversation_id, message_id)
 
     def count_tokens(self, message) -> int:
-        tokens = gpt_encoding.encode(message)
-        return len(tokens)
+        return count_tokens(message)
 
-    def add_messsage(self, conversation_id: str, query: str, reply: str) -> str:
+    async def count_tokens_async(self, message) -> int:
+        return await g_tokenizer.count_async(message)
 
+    async def add_messsage(self, conversation_id: str, query: str, reply: str) -> str:
         message_id = str(uuid.uuid4())
-        key = self.generate_key(conversation_id, message_id)
-        assert not key in g_conversations
-
-        parent_message_id = self.get_last_message_id(conversation_id)
-        message = Message(query, parent_message_id, reply)
-        g_conversations[key] = message
-        self.set_last_message_id(conversation_id, message_id)
+        parent_message_id = await self.get_last_message_id(conversation_id)
+        tokens = await self.count_tokens_async(' '.join((query, reply)))
+        message = Message(query, parent_message_id, reply, tokens)
+        await g_conversations.add_message(conversation_id, message_id, message)
+        if self.summarize_threshold:
+            self.schedule_summary(conversation_id, message_id)
         return message_id
 
-    def get_last_message_id(self, conversation_id: str) -> Optional[str]:
-        key = f'{conversation_id}-last_message_id'
-        try:
-            return g_conversations[key]
-        except KeyError:
-            return None
-
-    def set_last_message_id(self, conversation_id: str, message_id):
-        key = f'{conversation_id}-last_message_id'
-        g_conversations[key] = message_id
-
-    def clear_last_message_id(self, conversation_id: str):
-        key = f'{conversation_id}-last_message_id'
+    def schedule_summary(self, conversation_id: str, message_id: str):
+        if conversation_id in g_summary_tasks:
+            return
+        task = asyncio.create_task(self.summarize(conversation_id, message_id))
+        g_summary_tasks[conversation_id] = task
+        task.add_done_callback(lambda _: g_summary_tasks.pop(conversation_id, None))
+
+    async def summarize(self, conversation_id: str, message_id: str):
+        """Replace the older part of a long chain with a summary, runs in the background.
+
+        The older turns are folded into the previous summary in steps of at most
+        `max_prompt_token` tokens, so none of them are left out. At most
+        `max_chain_length` messages since the previous summary are read, more
+        don't pile up while summaries are made every `summarize_threshold` tokens.
+        """
         try:
-            del g_conversations[key]
-        except KeyError:
-            pass
+            chain = await g_conversations.get_chain(conversation_id, message_id, max_chain_length)
+            if sum(message.prompt_tokens() for message in chain) <= self.summarize_threshold:
+                return
+            kept_tokens = chain[0].prompt_tokens()
+            cut = 1
+            for i, message in enumerate(chain[1:], 1):
+                if kept_tokens + message.prompt_tokens() > self.summarize_keep_tokens:
+                    break
+                kept_tokens += message.prompt_tokens()
+                cut = i + 1
+            # the summary is attached to the newest message it covers
+            summary_message_id = chain[cut - 1].parent_message_id
+            older = chain[cut:]
+            if not older or older[0].summary is not None:
+                return
+
+            older.reverse()
+            summary: Optional[str] = None
+            summary_tokens = 0
+            if older[0].summary is not None:
+                summary, summary_tokens = older[0].summary, older[0].summary_tokens
+                older = older[1:]
+            summarized_tokens = 0
+            i = 0
+            while i < len(older):
+                tokens_count = summary_tokens
+                messages = []
+                if summary is not None:
+                    messages.append({"role": "system", "content": summary_prefix + summary})
+                start = i
+                while i < len(older) and (i == start or tokens_count + older[i].tokens <= max_prompt_token):
+                    messages.append({"role": "user", "content": older[i].message})
+                    messages.append({"role": "assistant", "content": older[i].completion})
+                    tokens_count += older[i].tokens
+                    i += 1
+                messages.append({"role": "user", "content": summary_prompt})
+                summary = await self.complete_summary(messages, tokens_count)
+                if not summary:
+                    return
+                summary_tokens = await self.count_tokens_async(summary)
+                summarized_tokens += tokens_count
+            await g_conversations.set_summary(conversation_id, summary_message_id, summary, summary_tokens)
+            logger.info("+++summarized %s tokens of %s to %s tokens", summarized_tokens, conversation_id, summary_tokens)
+        except Exception as e:
+            logger.exception(e)
 
-    def get_role(self, conversation_id: str) -> str:
-        key = self.generate_key(conversation_id, 'role')
+    async def complete_summary(self, messages: List[Dict[str, str]], tokens_count: int) -> Optional[str]:
+        reserved_tokens = tokens_count + expected_completion_tokens
+        await self.rate_limiter.reserve(reserved_tokens, max_rate_limit_wait)
+        # returned if the request fails
+        used_tokens = 0
         try:
-            return g_conversations[key]
-        except KeyError:
-            return default_role
-
-    def set_role(self, conversation_id: str, role: str):
-        if role == self.get_role(conversation_id):
+            async with self.semaphore:
+                response = await self.openai.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                )
+            used_tokens = response.usage.total_tokens if response.usage else reserved_tokens
+        finally:
+            self.rate_limiter.reconcile(reserved_tokens, used_tokens)
+        return response.choices[0].message.content
+
+    async def get_last_message_id(self, conversation_id: str) -> Optional[str]:
+        return await g_conversations.get_last_message_id(conversation_id)
+
+    async def clear_last_message_id(self, conversation_id: str):
+        await g_conversations.clear_last_message_id(conversation_id)
+
+    async def get_role(self, conversation_id: str) -> str:
+        role, _ = await self.get_role_and_tokens(conversation_id)
+        return role
+
+    async def get_role_and_tokens(self, conversation_id: str) -> Tuple[str, int]:
+        conversation = await g_conversations.get_conversation(conversation_id)
+        if not conversation or conversation.role is None:
+            return default_role, await self.count_tokens_async(default_role)
+        return conversation.role, conversation.role_tokens
+
+    async def set_role(self, conversation_id: str, role: str):
+        if role == await self.get_role(conversation_id):
             return
-        key = self.generate_key(conversation_id, 'role')
-        g_conversations[key] = role
-        self.clear_last_message_id(conversation_id)
+        tokens = await self.count_tokens_async(role)
+        await g_conversations.set_role(conversation_id, role, tokens)
 
-    def set_default_role(self, conversation_id: str):
-        if default_role == self.get_role(conversation_id):
-            return
-        key = self.generate_key(conversation_id, 'role')
-        g_conversations[key] = default_role
-        self.clear_last_message_id(conversation_id)
+    async def set_default_role(self, conversation_id: str):
+        await self.set_role(conversation_id, default_role)
 
-    def generate_prompt(self, conversation_id: str, message: str) -> Optional[List[Dict[str, str]]]:
-        parent_message_id = self.get_last_message_id(conversation_id)
-        parent_messages: list[Message] = []
-        total_length = 0
-        content = self.get_role(conversation_id)
-        tokens_count = self.count_tokens(content)
+    async def generate_prompt(self, conversation_id: str, message: str) -> Optional[List[Dict[str, str]]]:
+        prompt, _ = await self.generate_prompt_and_tokens(conversation_id, message)
+        return prompt
+
+    async def generate_prompt_and_tokens(self, conversation_id: str, message: str) -> Tuple[Optional[List[Dict[str, str]]], int]:
+        conversation = await g_conversations.get_conversation(conversation_id)
+        parent_message_id = conversation and conversation.last_message_id
+        if conversation and conversation.role is not None:
+            content, tokens_count = conversation.role, conversation.role_tokens
+        else:
+            content, tokens_count = default_role, await self.count_tokens_async(default_role)
 
         context_messages=[]
         if not parent_message_id:
             context_messages.append({"role": "user", "content": message})
-            return context_messages
+            return context_messages, await self.count_tokens_async(message)
 
-        tokens_count += self.count_tokens(message)
+        tokens_count += await self.count_tokens_async(message)
 
         if tokens_count > max_prompt_token:
-            return None
+            return None, tokens_count
 
-        #add latest conversations to prompt
-        while True:
-            parent_message = self.get_parent_messsage(conversation_id, parent_message_id)
-            assert parent_message
-            contents = ' '.join((parent_message.message, parent_message.completion))
-            current_tokens_count = self.count_tokens(contents)
-            # count unicode characters tokens
-            if tokens_count + current_tokens_count > max_prompt_token:
-                break
-            tokens_count += current_tokens_count
-
-            parent_messages.append(parent_message)
-            parent_message_id = parent_message.parent_message_id
-            if not parent_message_id:
-                break
+        #add latest conversations to prompt, token counts were computed when messages were saved
+        parent_messages = await g_conversations.get_chain(conversation_id, parent_message_id, max_chain_length, max_prompt_token - tokens_count)
+        for parent_message in parent_messages:
+            tokens_count += parent_message.prompt_tokens()
         logger.info("+++++++estimate the token count: %s", tokens_count)
         parent_messages.reverse()
         for parent_message in parent_messages:
+            if parent_message.summary is not None:
+                context_messages.append({"role": "system", "content": summary_prefix + parent_message.summary})
+                continue
             context_messages.append({"role": "user", "content": parent_message.message})
             context_messages.append({"role": "assistant", "content": parent_message.completion})
 
         context_messages.append({"role": "system", "content": content})
         context_messages.append({"role": "user", "content": message})
-        return context_messages
+        return context_messages, tokens_count
 
     def check_rate_limit(self, conversation_id: str):
         try:
@@ -202,29 +333,32 @@ class ChatGPTBot:
             yield str(e)
             return
 
-        if message.startswith('/role '):
-            role = message.split(' ', 1)[1]
-            self.set_role(conversation_id, role)
-            yield "[BEGIN]"
-            yield "Done!"
-            return
-        elif message == '/role':
-            role = self.get_role(conversation_id)
-            yield "[BEGIN]"
-            yield role
-            return
-        elif message == '/reset_role':
-            role = self.set_default_role(conversation_id)
-            yield "[BEGIN]"
-            yield 'Done!'
-            return
-        elif message == '/reset':
-            role = self.clear_last_message_id(conversation_id)
-            yield "[BEGIN]"
-            yield 'Done!'
-            return
+        lock_wait = time.monotonic()
+        async with get_conversation_lock(conversation_id):
+            # messages of a conversation are answered one at a time
+            tracing.add_span('conversation_lock', lock_wait, bot=self.name)
+            if message.startswith('/role '):
+                role = message.split(' ', 1)[1]
+                await self.set_role(conversation_id, role)
+                yield "[BEGIN]"
+                yield "Done!"
+                return
+            elif message == '/role':
+                role = await self.get_role(conversation_id)
+                yield "[BEGIN]"
+                yield role
+                return
+            elif message == '/reset_role':
+                await self.set_default_role(conversation_id)
+                yield "[BEGIN]"
+                yield 'Done!'
+                return
+            elif message == '/reset':
+                await self.clear_last_message_id(conversation_id)
+                yield "[BEGIN]"
+                yield 'Done!'
+                return
 
-        async with self.lock:
             if self.stream:
                 async for msg in self._send_message_stream(conversation_id, message):
                     yield msg
@@ -232,78 +366,218 @@ class ChatGPTBot:
                 async for msg in self._send_message(conversation_id, message):
                     yield msg
 
+    async def get_context_free_role(self, conversation_id: str) -> Optional[str]:
+        """Return the role of a conversation without prior context, None if it has context."""
+        conversation = await g_conversations.get_conversation(conversation_id)
+        if conversation and conversation.last_message_id:
+            return None
+        if conversation and conversation.role is not None:
+            return conversation.role
+        return default_role
+
+    async def get_response_cache_key(self, conversation_id: str, message: str) -> Optional[str]:
+        """Return the response cache key of a question without prior context, None if it can't be cached."""
+        if not self.response_cache:
+            return None
+        role = await self.get_context_free_role(conversation_id)
+        if role is None or not self.response_cache.enabled_for(role):
+            return None
+        return self.response_cache.key(self.model, role, message)
+
+    def replay_response(self, reply: str):
+        buffer = StreamBuffer(self.flush_policy)
+        for i in range(0, len(reply), replay_chunk_size):
+            chunk = buffer.feed(reply[i:i + replay_chunk_size])
+            if chunk:
+                yield chunk
+        yield buffer.flush()
+
     async def _send_message(self, conversation_id: str, message: str):
         if len(message) == 0:
             return
-        self.users[conversation_id] = True
 
-        prompt = self.generate_prompt(conversation_id, message)
+        cache_key = await self.get_response_cache_key(conversation_id, message)
+        if cache_key:
+            reply = await self.response_cache.get(cache_key)
+            if reply is not None:
+                yield '[BEGIN]'
+                await self.add_messsage(conversation_id, message, reply)
+                yield reply
+                return
+
+        with tracing.span('generate_prompt', bot=self.name):
+            prompt, prompt_tokens = await self.generate_prompt_and_tokens(conversation_id, message)
         # logger.info('+++prompt:%s', prompt)
         if not prompt:
             yield '[BEGIN]'
             yield 'oops, something went wrong, please try to reduce your worlds.'
             return
+        reserved_tokens = prompt_tokens + expected_completion_tokens
+        with tracing.span('rate_limit_wait', bot=self.name):
+            await self.rate_limiter.reserve(reserved_tokens, max_rate_limit_wait)
+        # returned if the request fails, corrected by the usage of an answer
+        used_tokens = 0
         try:
-            yield '[BEGIN]'
-            response = await self.openai.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=prompt,
-            )
-        except Exception as e:
-            logger.exception(e)
-            yield 'Sorry, I am not available now.'
-            return
-        reply = response.choices[0].delta.content or ""
-
-        logger.info('++++response: %s', reply)
-        self.add_messsage(conversation_id, message, reply)
+            try:
+                yield '[BEGIN]'
+                semaphore_wait = time.monotonic()
+                async with self.semaphore:
+                    tracing.add_span('concurrency_wait', semaphore_wait, bot=self.name)
+                    with tracing.span('completion', bot=self.name):
+                        raw_response = await self.openai.chat.completions.with_raw_response.create(
+                            model=self.model,
+                            messages=prompt,
+                        )
+                self.rate_limiter.update_from_headers(raw_response.headers)
+                response = raw_response.parse()
+            except RateLimitError as e:
+                logger.exception(e)
+                metrics.bot_rate_limited.inc(self.name)
+                self.rate_limiter.on_rate_limited(e.response.headers)
+                yield 'Sorry, I am not available now.'
+                return
+            except Exception as e:
+                logger.exception(e)
+                yield 'Sorry, I am not available now.'
+                return
+            reply = response.choices[0].message.content or ""
+            if response.usage:
+                used_tokens = response.usage.total_tokens
+                metrics.completion_tokens.inc(self.name, amount=response.usage.completion_tokens)
+            else:
+                used_tokens = reserved_tokens
+        finally:
+            self.rate_limiter.reconcile(reserved_tokens, used_tokens)
+        if cache_key and reply:
+            await self.response_cache.put(cache_key, reply)
+
+        logger.info('++++response: %s', reply,
+            extra={'category': 'completion', 'conversation': conversation_id, 'bot': self.name, 'stage': 'completion'})
+        with tracing.span('save_message', bot=self.name):
+            await self.add_messsage(conversation_id, message, reply)
         yield reply
         return
 
+    async def stream_completion(self, prompt: List[Dict[str, str]], prompt_tokens: int):
+        """Yield the content deltas of a streamed completion."""
+        reserved_tokens = prompt_tokens + expected_completion_tokens
+        # waiting for the budget of the key doesn't hold a concurrency slot
+        with tracing.span('rate_limit_wait', bot=self.name):
+            await self.rate_limiter.reserve(reserved_tokens, max_rate_limit_wait)
+        # returned if no answer is received, corrected by the tokens of the answer
+        answered = False
+        completion_tokens = 0
+        try:
+            semaphore_wait = time.monotonic()
+            async with self.semaphore:
+                tracing.add_span('concurrency_wait', semaphore_wait, bot=self.name)
+                requested = time.monotonic()
+                try:
+                    raw_response = await asyncio.wait_for(
+                        self.openai.chat.completions.with_raw_response.create(
+                            model=self.model,
+                            messages=prompt,
+                            stream=True
+                        ),
+                        self.http_pool.first_byte_timeout
+                    )
+                except RateLimitError as e:
+                    metrics.bot_rate_limited.inc(self.name)
+                    tracing.add_span('upstream_headers', requested, bot=self.name, status=429)
+                    self.rate_limiter.on_rate_limited(e.response.headers)
+                    raise
+                tracing.add_span('upstream_headers', requested, bot=self.name)
+                self.rate_limiter.update_from_headers(raw_response.headers)
+                response = raw_response.parse()
+                answered = True
+                # each content event carries about one token
+                first_token_at = 0.0
+                try:
+                    async for event in response:
+                        if not event.choices:
+                            continue
+                        event_text = event.choices[0].delta.content or ""
+                        if event_text:
+                            completion_tokens += 1
+                            if completion_tokens == 1:
+                                first_token_at = time.monotonic()
+                            yield event_text
+                finally:
+                    metrics.completion_tokens.inc(self.name, amount=completion_tokens)
+                    generation_time = time.monotonic() - first_token_at
+                    if completion_tokens > 1 and generation_time > 0:
+                        metrics.completion_tokens_per_second.observe((completion_tokens - 1) / generation_time, self.name)
+        finally:
+            self.rate_limiter.reconcile(reserved_tokens, prompt_tokens + completion_tokens if answered else 0)
+
+    def stream_completion_retry(self, prompt: List[Dict[str, str]], prompt_tokens: int):
+        """Stream a completion with this key first, retries and hedged requests use other available keys."""
+        bots = [self] + [bot for bot in g_bots if bot is not self and bot.available]
+        factories = [functools.partial(bot.stream_completion, prompt, prompt_tokens) for bot in bots]
+        return self.retry_policy.stream(factories)
+
     async def _send_message_stream(self, conversation_id: str, message: str):
         if len(message) == 0:
             return
-        self.users[conversation_id] = True
 
-        prompt = self.generate_prompt(conversation_id, message)
+        role = await self.get_context_free_role(conversation_id)
+        flight_key = None
+        cache_key = None
+        if role is not None:
+            flight_key = response_key(self.model, role, message)
+            if self.response_cache and self.response_cache.enabled_for(role):
+                cache_key = flight_key
+
+        if cache_key:
+            with tracing.span('response_cache', bot=self.name):
+                reply = await self.response_cache.get(cache_key)
+            if reply is not None:
+                yield '[BEGIN]'
+                await self.add_messsage(conversation_id, message, reply)
+                for msg in self.replay_response(reply):
+                    yield msg
+                return
+
+        with tracing.span('generate_prompt', bot=self.name):
+            prompt, prompt_tokens = await self.generate_prompt_and_tokens(conversation_id, message)
         if not prompt:
             yield '[BEGIN]'
             yield 'oops, something went wrong, please try to reduce your worlds.'
             return
-        start_time = time.time()
+        if flight_key:
+            deltas = g_single_flight.stream(flight_key, lambda: self.stream_completion_retry(prompt, prompt_tokens))
+        else:
+            deltas = self.stream_completion_retry(prompt, prompt_tokens)
+
+        buffer = StreamBuffer(self.flush_policy)
+        completion_text = ''
+        yield '[BEGIN]'
+        requested = time.monotonic()
         try:
-            yield '[BEGIN]'
-            response = await self.openai.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=prompt,
-                stream=True
-            )
+            async for event_text in deltas:
+                if not completion_text:
+                    # includes retries, hedged requests and waiting for an identical question
+                    tracing.add_span('first_token', requested, bot=self.name)
+                # chunks keep their whitespace, the outbox joins them and trims the messages
+                reply = buffer.feed(event_text)
+                if reply:
+                    yield reply
+                completion_text += event_text  # append the text
+        except ApiRateLimitError:
+            raise
         except Exception as e:
+            if completion_text:
+                raise
             logger.exception(e)
             yield 'Sorry, I am not available now.'
             return
-        collected_events = []
-        completion_text = ''
-        tokens: List[str] = []
-
-        async for event in response:
-            collected_events.append(event)  # save the event response
-            # logger.info(event.choices)
-            if not event.choices:
-                continue
-            event_text = event.choices[0].delta.content or ""
-            tokens.append(event_text)
-            if event_text.endswith('\n'):
-                if time.time() - start_time > 3.0:
-                    start_time = time.time()
-                    reply = ''.join(tokens)
-                    reply = reply.strip()
-                    if reply:
-                        yield reply
-                    tokens = []
-            completion_text += event_text  # append the text
+        tracing.add_span('completion', requested, bot=self.name)
         reply = completion_text
-        logger.info('++++response: %s', reply)
-        self.add_messsage(conversation_id, message, reply)
-        yield ''.join(tokens)
+        if cache_key and reply:
+            await self.response_cache.put(cache_key, reply)
+        logger.info('++++response: %s', reply, extra={'category': 'completion', 'conversation': conversation_id, 'bot': self.name,
+            'stage': 'completion', 'duration': time.monotonic() - requested})
+        with tracing.span('save_message', bot=self.name):
+            await self.add_messsage(conversation_id, message, reply)
+        yield buffer.flush()
         return
@@ -0,0 +1,84 @@
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import yaml
+from pymixin import log
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+# kind of the backend followed by everything it is created from
+BackendId = Tuple[str, ...]
+
+def load_config(config_file: str) -> Dict[str, Any]:
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+    if not isinstance(config, dict):
+        raise ValueError(f"{config_file} is not a mapping")
+    return config
+
+def backend_specs(config: Dict[str, Any]) -> Dict[BackendId, Any]:
+    """The backends of `config` by id, a backend whose id changes is replaced.
+
+    Browser backends are created from an account, api backends from a key and
+    the base and proxy urls shared by all keys.
+    """
+    specs: Dict[BackendId, Any] = {}
+    for account in config.get('accounts') or []:
+        specs[('browser', account['user'], account['psw'])] = account
+    base_url = config.get('openai_base_url') or ''
+    proxy_url = config.get('openai_proxy_url') or ''
+    for key in config.get('openai_api_keys') or []:
+        specs[('openai', key, base_url, proxy_url)] = key
+    return specs
+
+class ConfigWatcher:
+    """Calls `on_change` once the modification time of `path` changes, checked every `interval` seconds."""
+
+    def __init__(self, path: str, on_change: Callable[[], Awaitable[None]], interval: float = 5.0):
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self.mtime = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_config(cls, config, path: str, on_change: Callable[[], Awaitable[None]]) -> Optional['ConfigWatcher']:
+        """None if watching is disabled, the file is reloaded on SIGHUP only."""
+        interval = (config or {}).get('watch_interval', 0)
+        if not interval:
+            return None
+        return cls(path, on_change, interval)
+
+    def stat(self) -> float:
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return self.mtime
+
+    def start(self):
+        self.mtime = self.stat()
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            mtime = self.stat()
+            if mtime == self.mtime:
+                continue
+            # a file still being written fails to load and is loaded again on the next write
+            self.mtime = mtime
+            try:
+                await self.on_change()
+            except Exception as e:
+                logger.exception(e)
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
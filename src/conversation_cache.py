@@ -0,0 +1,245 @@
+import asyncio
+import sys
+import time
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from pymixin import log
+
+from .conversation_store import Conversation, ConversationStore, Message
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+default_max_bytes = 64 * 1024 * 1024
+default_ttl = 30 * 60.0
+# tokens of the recent chain kept in memory for each conversation
+default_chain_tokens = 4000
+
+@dataclass
+class CacheEntry:
+    conversation: Conversation
+    # recent messages ending at conversation.last_message_id, newest first
+    chain: List[Message] = field(default_factory=list)
+    expiration: float = 0.0
+    size: int = 0
+
+    def is_complete(self):
+        if not self.chain:
+            return False
+        return self.chain[-1].parent_message_id is None or self.chain[-1].summary is not None
+
+def message_size(message: Message) -> int:
+    size = sys.getsizeof(message.message) + sys.getsizeof(message.completion) + 200
+    if message.summary:
+        size += sys.getsizeof(message.summary)
+    return size
+
+class ConversationCache:
+    """Bounded in-memory LRU tier in front of a `ConversationStore`.
+
+    Entries are keyed by conversation id, expire after `ttl` seconds without access
+    and the least recently used entries are dropped once `max_bytes` is reached.
+    Writes go to the store first and then update the cached entry. Loading a
+    conversation on a miss and writes to it are serialized, so a write made while
+    the conversation is loaded isn't overwritten by the older state of the store.
+    """
+
+    def __init__(self, store: ConversationStore, max_bytes: int = default_max_bytes, ttl: float = default_ttl, chain_tokens: int = default_chain_tokens):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.chain_tokens = chain_tokens
+        self.entries: 'OrderedDict[str, CacheEntry]' = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.locks: 'weakref.WeakValueDictionary[str, asyncio.Lock]' = weakref.WeakValueDictionary()
+
+    def lock(self, conversation_id: str) -> asyncio.Lock:
+        lock = self.locks.get(conversation_id)
+        if not lock:
+            lock = asyncio.Lock()
+            self.locks[conversation_id] = lock
+        return lock
+
+    def set_limits(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.evict()
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+    async def open(self):
+        await self.store.open()
+
+    async def close(self):
+        self.entries.clear()
+        self.size = 0
+        await self.store.close()
+
+    def get_entry(self, conversation_id: str) -> Optional[CacheEntry]:
+        entry = self.entries.get(conversation_id)
+        if not entry:
+            return None
+        if entry.expiration < time.time():
+            self.remove(conversation_id)
+            return None
+        entry.expiration = time.time() + self.ttl
+        self.entries.move_to_end(conversation_id)
+        return entry
+
+    def put_entry(self, conversation_id: str, entry: CacheEntry):
+        self.remove(conversation_id)
+        entry.expiration = time.time() + self.ttl
+        self.trim_chain(entry)
+        self.entries[conversation_id] = entry
+        self.size += entry.size
+        self.evict()
+
+    def remove(self, conversation_id: str):
+        entry = self.entries.pop(conversation_id, None)
+        if entry:
+            self.size -= entry.size
+
+    def evict(self):
+        while self.size > self.max_bytes and self.entries:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry.size
+            self.evictions += 1
+
+    def trim_chain(self, entry: CacheEntry):
+        tokens = 0
+        for i, message in enumerate(entry.chain):
+            tokens += message.prompt_tokens()
+            if tokens > self.chain_tokens or message.summary is not None:
+                del entry.chain[i + 1:]
+                break
+        size = 200
+        if entry.conversation.role:
+            size += sys.getsizeof(entry.conversation.role)
+        entry.size = size + sum(message_size(message) for message in entry.chain)
+
+    def resize_entry(self, entry: CacheEntry):
+        self.size -= entry.size
+        self.trim_chain(entry)
+        self.size += entry.size
+        self.evict()
+
+    async def get_conversation(self, conversation_id: str) -> Optional[Conversation]:
+        entry = self.get_entry(conversation_id)
+        if entry:
+            self.hits += 1
+            return entry.conversation
+        async with self.lock(conversation_id):
+            # loaded by another miss while waiting
+            entry = self.get_entry(conversation_id)
+            if entry:
+                self.hits += 1
+                return entry.conversation
+            self.misses += 1
+            conversation = await self.store.get_conversation(conversation_id)
+            if conversation is None:
+                conversation = Conversation(None, 0, None)
+            self.put_entry(conversation_id, CacheEntry(conversation))
+            return conversation
+
+    async def get_last_message_id(self, conversation_id: str) -> Optional[str]:
+        conversation = await self.get_conversation(conversation_id)
+        return conversation.last_message_id
+
+    async def get_role(self, conversation_id: str) -> Optional[str]:
+        conversation = await self.get_conversation(conversation_id)
+        return conversation.role
+
+    async def get_message(self, conversation_id: str, message_id: str) -> Optional[Message]:
+        entry = self.get_entry(conversation_id)
+        if entry and entry.conversation.last_message_id:
+            current_id = entry.conversation.last_message_id
+            for message in entry.chain:
+                if current_id == message_id:
+                    self.hits += 1
+                    return message
+                current_id = message.parent_message_id
+        self.misses += 1
+        return await self.store.get_message(conversation_id, message_id)
+
+    async def get_chain(self, conversation_id: str, message_id: str, limit: int = 100, max_tokens: Optional[int] = None) -> List[Message]:
+        entry = self.get_entry(conversation_id)
+        if not entry or entry.conversation.last_message_id != message_id:
+            self.misses += 1
+            return await self.store.get_chain(conversation_id, message_id, limit, max_tokens)
+
+        chain = []
+        tokens = 0
+        for message in entry.chain[:limit]:
+            if max_tokens is not None and tokens + message.prompt_tokens() > max_tokens:
+                break
+            tokens += message.prompt_tokens()
+            chain.append(message)
+        else:
+            if len(chain) < limit and not entry.is_complete():
+                # the cached chain is shorter than requested, load it from the store
+                self.misses += 1
+                chain = await self.store.get_chain(conversation_id, message_id, max(limit, len(entry.chain) + 1), max_tokens)
+                if entry.conversation.last_message_id == message_id:
+                    entry.chain = chain[:]
+                    self.resize_entry(entry)
+                return chain
+        self.hits += 1
+        return chain
+
+    async def add_message(self, conversation_id: str, message_id: str, message: Message):
+        async with self.lock(conversation_id):
+            await self.store.add_message(conversation_id, message_id, message)
+            entry = self.entries.get(conversation_id)
+            if not entry:
+                return
+            if entry.conversation.last_message_id != message.parent_message_id:
+                self.remove(conversation_id)
+                return
+            if message.parent_message_id is None or entry.chain:
+                entry.chain.insert(0, message)
+            entry.conversation.last_message_id = message_id
+            self.resize_entry(entry)
+
+    async def set_summary(self, conversation_id: str, message_id: str, summary: str, summary_tokens: int):
+        async with self.lock(conversation_id):
+            await self.store.set_summary(conversation_id, message_id, summary, summary_tokens)
+            entry = self.entries.get(conversation_id)
+            if not entry:
+                return
+            current_id = entry.conversation.last_message_id
+            for message in entry.chain:
+                if current_id == message_id:
+                    message.summary = summary
+                    message.summary_tokens = summary_tokens
+                    self.resize_entry(entry)
+                    return
+                current_id = message.parent_message_id
+
+    async def clear_last_message_id(self, conversation_id: str):
+        async with self.lock(conversation_id):
+            await self.store.clear_last_message_id(conversation_id)
+            entry = self.entries.get(conversation_id)
+            if entry:
+                entry.conversation.last_message_id = None
+                entry.chain = []
+                self.resize_entry(entry)
+
+    async def set_role(self, conversation_id: str, role: str, role_tokens: int = 0):
+        async with self.lock(conversation_id):
+            await self.store.set_role(conversation_id, role, role_tokens)
+            self.put_entry(conversation_id, CacheEntry(Conversation(role, role_tokens, None)))
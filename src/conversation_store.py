@@ -0,0 +1,458 @@
+import asyncio
+import dbm
+import os
+import shelve
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, List, Optional, Sequence, Tuple
+
+from pymixin import log
+
+from . import metrics
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+@dataclass
+class Message:
+    message: str
+    parent_message_id: Optional[str]
+    completion: str
+    # token count of the question and the answer
+    tokens: int = 0
+    # summary of this message and all of its parents, replaces them in prompts
+    summary: Optional[str] = None
+    summary_tokens: int = 0
+
+    def prompt_tokens(self) -> int:
+        if self.summary is not None:
+            return self.summary_tokens
+        return self.tokens
+
+@dataclass
+class Conversation:
+    role: Optional[str]
+    role_tokens: int
+    last_message_id: Optional[str]
+
+# each entry upgrades the schema by one version, see PRAGMA user_version
+migrations = [
+    '''
+    CREATE TABLE messages (
+        conversation_id TEXT NOT NULL,
+        message_id TEXT NOT NULL,
+        parent_message_id TEXT,
+        message TEXT NOT NULL,
+        completion TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        PRIMARY KEY (conversation_id, message_id)
+    ) WITHOUT ROWID;
+    CREATE TABLE conversations (
+        conversation_id TEXT PRIMARY KEY,
+        role TEXT,
+        last_message_id TEXT,
+        updated_at REAL NOT NULL
+    ) WITHOUT ROWID;
+    ''',
+    # token counts of messages saved before counts were kept are estimated like `estimate_tokens`, 4 bytes a token
+    '''
+    ALTER TABLE messages ADD COLUMN tokens INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE conversations ADD COLUMN role_tokens INTEGER NOT NULL DEFAULT 0;
+    UPDATE messages SET tokens = (length(CAST(message || ' ' || completion AS BLOB)) + 3) / 4;
+    UPDATE conversations SET role_tokens = (length(CAST(role AS BLOB)) + 3) / 4 WHERE role IS NOT NULL;
+    ''',
+    '''
+    ALTER TABLE messages ADD COLUMN summary TEXT;
+    ALTER TABLE messages ADD COLUMN summary_tokens INTEGER NOT NULL DEFAULT 0;
+    ''',
+    '''
+    CREATE TABLE responses (
+        key TEXT PRIMARY KEY,
+        response TEXT NOT NULL,
+        expiration REAL NOT NULL
+    ) WITHOUT ROWID;
+    ''',
+    # used by the retention sweeper
+    '''
+    CREATE INDEX conversations_updated_at ON conversations (updated_at);
+    CREATE INDEX responses_expiration ON responses (expiration);
+    ''',
+]
+
+Operation = Tuple[str, Sequence[Any]]
+
+class SqliteStore:
+    """SQLite (WAL) database accessed from a single worker thread.
+
+    All I/O runs on the worker thread so the event loop never blocks on disk.
+    Writes are queued and committed in batches, reads are ordered after pending writes.
+    Subclasses list their schema in `migrations`.
+    """
+    migrations: List[str] = []
+    thread_name = 'sqlite-store'
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db: Optional[sqlite3.Connection] = None
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.pending_writes: Deque[Tuple[List[Operation], asyncio.Future]] = deque()
+        # created by open() on the event loop, stores may be constructed by an import in
+        # another thread, where asyncio.Lock() fails before python 3.10
+        self.lock: Optional[asyncio.Lock] = None
+
+    async def open(self):
+        if not self.lock:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.db:
+                return
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.thread_name)
+            await self.run(self._open)
+
+    async def close(self):
+        if not self.lock:
+            return
+        async with self.lock:
+            if not self.db:
+                return
+            await self.run(self._close)
+            self.executor.shutdown()
+            self.executor = None
+
+    def _open(self):
+        new_db = not os.path.exists(self.path)
+        db_dir = os.path.dirname(self.path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        self.db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.upgrade_schema()
+        self.on_open(new_db)
+
+    def on_open(self, new_db: bool):
+        pass
+
+    def _close(self):
+        self.flush_writes()
+        self.db.close()
+        self.db = None
+
+    def upgrade_schema(self):
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        for i in range(version, len(self.migrations)):
+            self.db.executescript(f'BEGIN;{self.migrations[i]};PRAGMA user_version={i + 1};COMMIT;')
+
+    async def run(self, fn: Callable, *args):
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        try:
+            return await loop.run_in_executor(self.executor, fn, *args)
+        finally:
+            metrics.store_operation_seconds.observe(time.monotonic() - start, self.thread_name, fn.__name__.lstrip('_'))
+
+    async def write(self, operations: List[Operation]):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending_writes.append((operations, future))
+        start = time.monotonic()
+        # every write schedules a flush, the first one to run commits all pending writes at once
+        loop.run_in_executor(self.executor, self.flush_writes)
+        try:
+            await future
+        finally:
+            metrics.store_operation_seconds.observe(time.monotonic() - start, self.thread_name, 'write')
+
+    def flush_writes(self):
+        if not self.pending_writes:
+            return
+        batch = []
+        while self.pending_writes:
+            batch.append(self.pending_writes.popleft())
+        results = []
+        self.db.execute('BEGIN')
+        try:
+            for operations, future in batch:
+                self.db.execute('SAVEPOINT write')
+                try:
+                    for sql, params in operations:
+                        self.db.execute(sql, params)
+                    self.db.execute('RELEASE write')
+                    results.append((future, None))
+                except sqlite3.Error as e:
+                    self.db.execute('ROLLBACK TO write')
+                    self.db.execute('RELEASE write')
+                    results.append((future, e))
+            self.db.execute('COMMIT')
+        except sqlite3.Error as e:
+            logger.exception(e)
+            self.db.execute('ROLLBACK')
+            results = [(future, e) for _, future in batch]
+        for future, error in results:
+            future.get_loop().call_soon_threadsafe(set_future_result, future, error)
+
+    @contextmanager
+    def transaction(self):
+        self.db.execute('BEGIN')
+        try:
+            yield
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+class ConversationStore(SqliteStore):
+    """SQLite backed conversation storage."""
+    migrations = migrations
+    thread_name = 'conversation-store'
+
+    def __init__(self, path: str, shelve_path: Optional[str] = None, count_tokens: Optional[Callable[[str], int]] = None):
+        super().__init__(path)
+        self.shelve_path = shelve_path
+        self.count_tokens = count_tokens or len
+
+    def on_open(self, new_db: bool):
+        if new_db and self.shelve_path and dbm.whichdb(self.shelve_path):
+            count = self.migrate_from_shelve(self.shelve_path)
+            logger.info("+++migrated %s records from %s", count, self.shelve_path)
+
+    async def get_message(self, conversation_id: str, message_id: str) -> Optional[Message]:
+        return await self.run(self._get_message, conversation_id, message_id)
+
+    def _get_message(self, conversation_id: str, message_id: str) -> Optional[Message]:
+        row = self.db.execute(
+            'SELECT message, parent_message_id, completion, tokens, summary, summary_tokens FROM messages '
+            'WHERE conversation_id = ? AND message_id = ?',
+            (conversation_id, message_id)
+        ).fetchone()
+        if not row:
+            return None
+        return Message(*row)
+
+    async def get_chain(self, conversation_id: str, message_id: str, limit: int = 100, max_tokens: Optional[int] = None) -> List[Message]:
+        """Return up to `limit` messages ending at `message_id`, newest first.
+
+        The chain ends at the first message with a summary. If `max_tokens` is given,
+        the chain stops before the message which would exceed it.
+        """
+        if max_tokens is None:
+            max_tokens = -1
+        return await self.run(self._get_chain, conversation_id, message_id, limit, max_tokens)
+
+    def _get_chain(self, conversation_id: str, message_id: str, limit: int, max_tokens: int) -> List[Message]:
+        rows = self.db.execute('''
+            WITH RECURSIVE chain(message_id, parent_message_id, message, completion, tokens, summary, summary_tokens, used, depth) AS (
+                SELECT message_id, parent_message_id, message, completion, tokens, summary, summary_tokens,
+                    CASE WHEN summary IS NULL THEN tokens ELSE summary_tokens END, 1
+                FROM messages
+                WHERE conversation_id = ?1 AND message_id = ?2 AND (?4 < 0 OR CASE WHEN summary IS NULL THEN tokens ELSE summary_tokens END <= ?4)
+                UNION ALL
+                SELECT m.message_id, m.parent_message_id, m.message, m.completion, m.tokens, m.summary, m.summary_tokens,
+                    chain.used + CASE WHEN m.summary IS NULL THEN m.tokens ELSE m.summary_tokens END, chain.depth + 1
+                FROM messages m JOIN chain ON m.conversation_id = ?1 AND m.message_id = chain.parent_message_id
+                WHERE chain.summary IS NULL AND chain.depth < ?3
+                    AND (?4 < 0 OR chain.used + CASE WHEN m.summary IS NULL THEN m.tokens ELSE m.summary_tokens END <= ?4)
+            )
+            SELECT message, parent_message_id, completion, tokens, summary, summary_tokens FROM chain ORDER BY depth
+        ''', (conversation_id, message_id, limit, max_tokens)).fetchall()
+        return [Message(*row) for row in rows]
+
+    async def add_message(self, conversation_id: str, message_id: str, message: Message):
+        """Save `message` and make it the last message of the conversation."""
+        now = time.time()
+        await self.write([
+            ('INSERT INTO messages (conversation_id, message_id, parent_message_id, message, completion, created_at, tokens) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (conversation_id, message_id, message.parent_message_id, message.message, message.completion, now, message.tokens)),
+            ('INSERT INTO conversations (conversation_id, last_message_id, updated_at) VALUES (?, ?, ?) '
+                'ON CONFLICT(conversation_id) DO UPDATE SET last_message_id = excluded.last_message_id, updated_at = excluded.updated_at',
+                (conversation_id, message_id, now)),
+        ])
+
+    async def set_summary(self, conversation_id: str, message_id: str, summary: str, summary_tokens: int):
+        """Attach the summary of the chain ending at `message_id` to that message."""
+        await self.write([
+            ('UPDATE messages SET summary = ?, summary_tokens = ? WHERE conversation_id = ? AND message_id = ?',
+                (summary, summary_tokens, conversation_id, message_id)),
+        ])
+
+    async def get_conversation(self, conversation_id: str) -> Optional[Conversation]:
+        return await self.run(self._get_conversation, conversation_id)
+
+    def _get_conversation(self, conversation_id: str) -> Optional[Conversation]:
+        row = self.db.execute(
+            'SELECT role, role_tokens, last_message_id FROM conversations WHERE conversation_id = ?',
+            (conversation_id,)
+        ).fetchone()
+        if not row:
+            return None
+        return Conversation(*row)
+
+    async def get_last_message_id(self, conversation_id: str) -> Optional[str]:
+        conversation = await self.get_conversation(conversation_id)
+        if not conversation:
+            return None
+        return conversation.last_message_id
+
+    async def clear_last_message_id(self, conversation_id: str):
+        await self.write([
+            ('UPDATE conversations SET last_message_id = NULL, updated_at = ? WHERE conversation_id = ?', (time.time(), conversation_id)),
+        ])
+
+    async def get_role(self, conversation_id: str) -> Optional[str]:
+        conversation = await self.get_conversation(conversation_id)
+        if not conversation:
+            return None
+        return conversation.role
+
+    async def set_role(self, conversation_id: str, role: str, role_tokens: int = 0):
+        """Set the role of a conversation, this also starts a new context."""
+        await self.write([
+            ('INSERT INTO conversations (conversation_id, role, role_tokens, last_message_id, updated_at) VALUES (?, ?, ?, NULL, ?) '
+                'ON CONFLICT(conversation_id) DO UPDATE SET role = excluded.role, role_tokens = excluded.role_tokens, '
+                'last_message_id = NULL, updated_at = excluded.updated_at',
+                (conversation_id, role, role_tokens, time.time())),
+        ])
+
+    async def get_response(self, key: str) -> Optional[str]:
+        return await self.run(self._get_response, key)
+
+    def _get_response(self, key: str) -> Optional[str]:
+        row = self.db.execute('SELECT response FROM responses WHERE key = ? AND expiration > ?', (key, time.time())).fetchone()
+        if not row:
+            return None
+        return row[0]
+
+    async def put_response(self, key: str, response: str, expiration: float):
+        await self.write([
+            ('INSERT OR REPLACE INTO responses (key, response, expiration) VALUES (?, ?, ?)', (key, response, expiration)),
+        ])
+
+    async def delete_expired(self, updated_before: float, limit: int) -> List[str]:
+        """Delete up to `limit` conversations not updated since `updated_before`, return their ids."""
+        return await self.run(self._delete_expired, updated_before, limit)
+
+    def _delete_expired(self, updated_before: float, limit: int) -> List[str]:
+        conversation_ids = [row[0] for row in self.db.execute(
+            'SELECT conversation_id FROM conversations WHERE updated_at < ? LIMIT ?', (updated_before, limit)
+        )]
+        with self.transaction():
+            for conversation_id in conversation_ids:
+                self.db.execute('DELETE FROM messages WHERE conversation_id = ?', (conversation_id,))
+                self.db.execute('DELETE FROM conversations WHERE conversation_id = ?', (conversation_id,))
+            self.db.execute('DELETE FROM responses WHERE key IN (SELECT key FROM responses WHERE expiration < ? LIMIT ?)', (time.time(), limit))
+        return conversation_ids
+
+    async def collect_garbage(self, after: str, limit: int, max_messages: int, created_before: float) -> Tuple[Optional[str], int, List[str]]:
+        """Delete the messages of up to `limit` conversations following `after` which prompts never use.
+
+        Kept are the messages of the current chain up to the first summary and, if
+        `max_messages` isn't 0, at most `max_messages` of them. Messages created after
+        `created_before` are always kept. Return the last conversation id handled,
+        None once all were handled, the number of deleted messages and the ids of the
+        conversations whose messages were deleted.
+        """
+        return await self.run(self._collect_garbage, after, limit, max_messages, created_before)
+
+    def _collect_garbage(self, after: str, limit: int, max_messages: int, created_before: float) -> Tuple[Optional[str], int, List[str]]:
+        conversation_ids = [row[0] for row in self.db.execute(
+            'SELECT DISTINCT conversation_id FROM messages WHERE conversation_id > ? ORDER BY conversation_id LIMIT ?', (after, limit)
+        )]
+        deleted = 0
+        changed = []
+        with self.transaction():
+            for conversation_id in conversation_ids:
+                # rowcount isn't set for statements starting with WITH
+                changes = self.db.total_changes
+                self.db.execute('''
+                    WITH RECURSIVE chain(message_id, parent_message_id, summary, depth) AS (
+                        SELECT m.message_id, m.parent_message_id, m.summary, 1
+                        FROM conversations c JOIN messages m ON m.conversation_id = c.conversation_id AND m.message_id = c.last_message_id
+                        WHERE c.conversation_id = ?1
+                        UNION ALL
+                        SELECT m.message_id, m.parent_message_id, m.summary, chain.depth + 1
+                        FROM messages m JOIN chain ON m.conversation_id = ?1 AND m.message_id = chain.parent_message_id
+                        WHERE chain.summary IS NULL AND (?2 <= 0 OR chain.depth < ?2)
+                    )
+                    DELETE FROM messages WHERE conversation_id = ?1 AND created_at < ?3 AND message_id NOT IN (SELECT message_id FROM chain)
+                ''', (conversation_id, max_messages, created_before))
+                count = self.db.total_changes - changes
+                if count:
+                    # the oldest kept message starts the chain now
+                    self.db.execute(
+                        'UPDATE messages SET parent_message_id = NULL WHERE conversation_id = ?1 AND parent_message_id IS NOT NULL '
+                        'AND NOT EXISTS (SELECT 1 FROM messages p WHERE p.conversation_id = ?1 AND p.message_id = messages.parent_message_id)',
+                        (conversation_id,)
+                    )
+                    deleted += count
+                    changed.append(conversation_id)
+        if len(conversation_ids) < limit:
+            return None, deleted, changed
+        return conversation_ids[-1], deleted, changed
+
+    async def vacuum(self):
+        await self.run(self._vacuum)
+
+    def _vacuum(self):
+        self.flush_writes()
+        self.db.execute('VACUUM')
+        self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def migrate_from_shelve(self, shelve_path: str) -> int:
+        """Copy records of the old `shelve` conversation database, return the number of records copied.
+
+        shelve keys are `{conversation_id}-{message_id}`, `{conversation_id}-last_message_id`
+        and `{conversation_id}-role`, message ids are uuid4 strings.
+        """
+        messages = {}
+        conversations = {}
+        with shelve.open(shelve_path, flag='r') as db:
+            for key in db.keys():
+                try:
+                    value = db[key]
+                except Exception as e:
+                    logger.info("+++skip broken record %s: %s", key, e)
+                    continue
+                if key.endswith('-last_message_id'):
+                    conversation_id = key[:-len('-last_message_id')]
+                    conversations.setdefault(conversation_id, [None, None])[1] = value
+                elif key.endswith('-role'):
+                    conversation_id = key[:-len('-role')]
+                    conversations.setdefault(conversation_id, [None, None])[0] = value
+                else:
+                    conversation_id, message_id = key[:-37], key[-36:]
+                    messages[(conversation_id, message_id)] = value
+        now = time.time()
+        tokens = {}
+        for key, message in messages.items():
+            tokens[key] = self.count_tokens(' '.join((message.message, message.completion)))
+
+        rows = []
+        for (conversation_id, message_id), message in messages.items():
+            rows.append((conversation_id, message_id, message.parent_message_id, message.message, message.completion, 0.0,
+                tokens[(conversation_id, message_id)]))
+        self.db.execute('BEGIN')
+        self.db.executemany(
+            'INSERT OR IGNORE INTO messages (conversation_id, message_id, parent_message_id, message, completion, created_at, tokens) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            rows
+        )
+        self.db.executemany(
+            'INSERT OR REPLACE INTO conversations (conversation_id, role, role_tokens, last_message_id, updated_at) VALUES (?, ?, ?, ?, ?)',
+            [(conversation_id, role, self.count_tokens(role) if role else 0, last_message_id, now)
+                for conversation_id, (role, last_message_id) in conversations.items()]
+        )
+        self.db.execute('COMMIT')
+        return len(messages) + len(conversations)
+
+def set_future_result(future: asyncio.Future, error: Optional[Exception]):
+    if future.done():
+        return
+    if error:
+        future.set_exception(error)
+    else:
+        future.set_result(None)
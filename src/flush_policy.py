@@ -0,0 +1,76 @@
+import re
+import time
+from dataclasses import dataclass, fields
+from typing import Any, Dict, Optional
+
+# newlines and CJK punctuation end a sentence anywhere, ascii punctuation only before a space
+sentence_end_pattern = re.compile(r'[\n。！？；…]|[.!?;](?=\s)')
+
+@dataclass
+class FlushPolicy:
+    """Decides when buffered stream text is sent to the user.
+
+    The first chunk is sent as soon as `first_chunk_delay` has passed, later chunks
+    end on sentence punctuation at most every `min_interval` seconds. Text is
+    sent anyway once `max_buffer` characters or `max_delay` seconds are reached.
+    Subclass and override `flush_position` for another policy.
+    """
+    first_chunk_delay: float = 0.5
+    min_interval: float = 1.0
+    max_delay: float = 3.0
+    max_buffer: int = 500
+
+    @classmethod
+    def from_config(cls, config: Optional[Dict[str, Any]]) -> 'FlushPolicy':
+        if not config:
+            return cls()
+        return cls(**config)
+
+    def update(self, other: 'FlushPolicy'):
+        """Take the settings of `other` in place, for the streams holding this policy."""
+        for f in fields(self):
+            setattr(self, f.name, getattr(other, f.name))
+
+    def last_sentence_end(self, text: str) -> int:
+        pos = 0
+        for match in sentence_end_pattern.finditer(text):
+            pos = match.end()
+        return pos
+
+    def flush_position(self, text: str, elapsed: float, first: bool) -> int:
+        """Return how many characters of `text` should be sent now, 0 means keep buffering."""
+        if not text:
+            return 0
+        if elapsed >= self.max_delay:
+            return len(text)
+        if len(text) >= self.max_buffer or (first and elapsed >= self.first_chunk_delay):
+            return self.last_sentence_end(text) or len(text)
+        if elapsed >= self.min_interval:
+            return self.last_sentence_end(text)
+        return 0
+
+class StreamBuffer:
+    """Collects the deltas of a stream and hands out chunks chosen by a `FlushPolicy`."""
+
+    def __init__(self, policy: FlushPolicy):
+        self.policy = policy
+        self.text = ''
+        self.first = True
+        self.last_flush = time.monotonic()
+
+    def feed(self, delta: str) -> Optional[str]:
+        self.text += delta
+        now = time.monotonic()
+        pos = self.policy.flush_position(self.text, now - self.last_flush, self.first)
+        if not pos:
+            return None
+        chunk = self.text[:pos]
+        self.text = self.text[pos:]
+        self.first = False
+        self.last_flush = now
+        return chunk
+
+    def flush(self) -> str:
+        chunk = self.text
+        self.text = ''
+        return chunk
@@ -0,0 +1,118 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from pymixin import log
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+@dataclass
+class GroupMessage:
+    user_id: str
+    text: str
+    received_at: float = field(default_factory=time.monotonic)
+    # the trace of the message, held until the batch is handed on
+    trace: Optional[Any] = None
+
+@dataclass
+class GroupBatch:
+    messages: List[GroupMessage] = field(default_factory=list)
+    # monotonic time the batch is flushed at, pushed back by every message
+    deadline: float = 0.0
+    task: Optional[asyncio.Task] = None
+
+OnBatch = Callable[[str, List[GroupMessage]], Awaitable[None]]
+
+def speaker(user_id: str) -> str:
+    return 'user ' + user_id[:8]
+
+def merge_messages(messages: List[GroupMessage]) -> str:
+    """One prompt for the messages of a batch, each line is attributed to its sender if there are several."""
+    if len({message.user_id for message in messages}) == 1:
+        return '\n'.join(message.text for message in messages)
+    return '\n'.join(f'[{speaker(message.user_id)}] {message.text}' for message in messages)
+
+class GroupDebouncer:
+    """Merges group messages of a conversation that arrive in quick succession.
+
+    A batch is handed to `on_batch` once no message arrived for `window_ms`
+    milliseconds, `max_wait_ms` after its first message or when it has
+    `max_messages` messages, whichever comes first. A `window_ms` of 0 disables it.
+    """
+
+    def __init__(self, on_batch: OnBatch, window_ms: int = 0, max_messages: int = 5, max_wait_ms: int = 5000):
+        self.on_batch = on_batch
+        self.window_ms = window_ms
+        self.max_messages = max_messages
+        self.max_wait_ms = max_wait_ms
+        self.batches: Dict[str, GroupBatch] = {}
+        self.messages = 0
+        self.flushed = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.window_ms > 0
+
+    def configure(self, window_ms: Optional[int] = None, max_messages: Optional[int] = None, max_wait_ms: Optional[int] = None):
+        """Change the limits in place, pending batches keep their deadlines until the next message."""
+        if window_ms is not None:
+            self.window_ms = window_ms
+        if max_messages is not None:
+            self.max_messages = max_messages
+        if max_wait_ms is not None:
+            self.max_wait_ms = max_wait_ms
+
+    async def add(self, conversation_id: str, message: GroupMessage):
+        batch = self.batches.get(conversation_id)
+        if not batch:
+            batch = GroupBatch()
+            self.batches[conversation_id] = batch
+        batch.messages.append(message)
+        self.messages += 1
+        if len(batch.messages) >= self.max_messages:
+            await self.flush(conversation_id)
+            return
+        first = batch.messages[0].received_at
+        batch.deadline = min(time.monotonic() + self.window_ms / 1000, first + self.max_wait_ms / 1000)
+        if not batch.task:
+            batch.task = asyncio.create_task(self.wait(conversation_id, batch))
+
+    async def wait(self, conversation_id: str, batch: GroupBatch):
+        while True:
+            delay = batch.deadline - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        if self.batches.get(conversation_id) is batch:
+            batch.task = None
+            await self.flush(conversation_id)
+
+    async def flush(self, conversation_id: str):
+        """Hand the pending messages of the conversation on now, e.g. before a command that can't be merged."""
+        batch = self.batches.pop(conversation_id, None)
+        if not batch:
+            return
+        if batch.task and batch.task is not asyncio.current_task():
+            batch.task.cancel()
+        self.flushed += 1
+        try:
+            await self.on_batch(conversation_id, batch.messages)
+        except Exception as e:
+            logger.exception(e)
+
+    def close(self) -> Dict[str, List[GroupMessage]]:
+        """Stop waiting and return the messages of the pending batches."""
+        batches, self.batches = self.batches, {}
+        for batch in batches.values():
+            if batch.task:
+                batch.task.cancel()
+        return {conversation_id: batch.messages for conversation_id, batch in batches.items()}
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'pending': sum(len(batch.messages) for batch in self.batches.values()),
+            'messages': self.messages,
+            'batches': self.flushed,
+        }
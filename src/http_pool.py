@@ -0,0 +1,101 @@
+import asyncio
+from typing import Dict, Optional, Set, Tuple
+
+import httpx
+from pymixin import log
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+default_warm_up_url = 'https://api.openai.com/v1'
+
+class HttpPool:
+    """Connection pools shared by the api backends and the web search.
+
+    One `httpx.AsyncClient` is kept per proxy url, so requests to the same origin
+    reuse kept-alive connections. `warm_up` opens connections to the registered
+    origins before the first user needs them, with `keep_warm` set it is repeated
+    periodically so idle connections don't expire.
+    """
+
+    def __init__(self, max_connections: int = 100, max_keepalive_connections: int = 20,
+                keepalive_expiry: float = 120.0, http2: bool = False,
+                connect_timeout: float = 5.0, read_timeout: float = 60.0, write_timeout: float = 10.0,
+                pool_timeout: float = 10.0, first_byte_timeout: float = 30.0,
+                warm_up_connections: int = 2, keep_warm: float = 0.0):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.timeout = httpx.Timeout(connect=connect_timeout, read=read_timeout, write=write_timeout, pool=pool_timeout)
+        # seconds until the response headers of a completion request arrive
+        self.first_byte_timeout = first_byte_timeout
+        self.http2 = http2
+        if http2:
+            try:
+                import h2
+            except ImportError:
+                logger.warning("h2 is not installed, falling back to HTTP/1.1, install it with: pip install httpx[http2]")
+                self.http2 = False
+        self.warm_up_connections = warm_up_connections
+        self.keep_warm = keep_warm
+        self.clients: Dict[str, httpx.AsyncClient] = {}
+        self.warm_up_targets: Set[Tuple[str, str]] = set()
+        self.keep_warm_task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_config(cls, config) -> 'HttpPool':
+        if not config:
+            return cls()
+        return cls(**config)
+
+    def client(self, proxy_url: str = '') -> httpx.AsyncClient:
+        try:
+            return self.clients[proxy_url]
+        except KeyError:
+            client = httpx.AsyncClient(
+                proxy=proxy_url or None,
+                limits=self.limits,
+                timeout=self.timeout,
+                http2=self.http2
+            )
+            self.clients[proxy_url] = client
+            return client
+
+    def add_warm_up(self, url: str, proxy_url: str = ''):
+        """Register an origin whose connections `warm_up` pre-opens."""
+        origin = httpx.URL(url or default_warm_up_url).copy_with(path='/', query=None, fragment=None)
+        self.warm_up_targets.add((str(origin), proxy_url))
+
+    async def warm_up(self):
+        requests = []
+        for url, proxy_url in self.warm_up_targets:
+            client = self.client(proxy_url)
+            # HTTP/2 multiplexes all requests over one connection
+            count = 1 if self.http2 else self.warm_up_connections
+            requests.extend(self.open_connection(client, url) for _ in range(count))
+        if requests:
+            await asyncio.gather(*requests)
+        if self.keep_warm > 0 and not self.keep_warm_task:
+            self.keep_warm_task = asyncio.create_task(self.keep_warm_loop())
+
+    async def open_connection(self, client: httpx.AsyncClient, url: str):
+        # any response leaves a connection with a finished TLS handshake in the pool
+        try:
+            await client.head(url)
+        except httpx.HTTPError as e:
+            logger.info("+++warm up %s failed: %s", url, e)
+
+    async def keep_warm_loop(self):
+        while True:
+            await asyncio.sleep(self.keep_warm)
+            await self.warm_up()
+
+    async def aclose(self):
+        if self.keep_warm_task:
+            self.keep_warm_task.cancel()
+            self.keep_warm_task = None
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients.clear()
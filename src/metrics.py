@@ -0,0 +1,229 @@
+import asyncio
+import bisect
+import inspect
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+from pymixin import log
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+# seconds, from a cached answer to a long browser answer
+latency_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0, 160.0)
+# seconds of sqlite operations, including the wait for the store thread
+store_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+tokens_per_second_buckets = (5.0, 10.0, 20.0, 30.0, 50.0, 75.0, 100.0, 150.0, 250.0)
+
+Labels = Tuple[str, ...]
+
+def format_labels(names: Sequence[str], values: Labels, extra: str = '') -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def header(self) -> List[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def set_total(self, value: float, *labels: str):
+        """Set the count to a total kept elsewhere, for collectors exporting the counts of a component."""
+        self.values[labels] = value
+
+    def render(self) -> List[str]:
+        return [f'{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}' for labels, value in self.values.items()]
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.values: Dict[Labels, float] = {}
+
+    def set(self, value: float, *labels: str):
+        self.values[labels] = value
+
+    def render(self) -> List[str]:
+        return [f'{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}' for labels, value in self.values.items()]
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = latency_buckets):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # per label values: count per bucket with +Inf last, sum
+        self.values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str):
+        try:
+            counts, total = self.values[labels]
+        except KeyError:
+            counts, total = [0] * (len(self.buckets) + 1), [0.0]
+            self.values[labels] = (counts, total)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def render(self) -> List[str]:
+        lines = []
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{format_labels(self.labelnames, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labelnames, labels)} {format_value(total[0])}')
+            lines.append(f'{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+# updates gauges right before they are rendered
+Collector = Callable[[], Union[None, Awaitable[None]]]
+
+class Registry:
+    """Metrics of this process, rendered in the Prometheus text format.
+
+    Recording is a dict lookup and an addition on the event loop, values that are
+    cheaper to read than to track, like queue depths, are set by collectors when
+    the metrics are scraped.
+    """
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.collectors: List[Collector] = []
+
+    def get_or_add(self, metric: Metric) -> Metric:
+        existing = self.metrics.get(metric.name)
+        if existing:
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.get_or_add(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.get_or_add(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = latency_buckets) -> Histogram:
+        return self.get_or_add(Histogram(name, help, labelnames, buckets))
+
+    def add_collector(self, collector: Collector):
+        self.collectors.append(collector)
+
+    def remove_collector(self, collector: Collector):
+        if collector in self.collectors:
+            self.collectors.remove(collector)
+
+    async def render(self) -> str:
+        for collector in self.collectors:
+            try:
+                result = collector()
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                logger.exception(e)
+        lines = []
+        for metric in self.metrics.values():
+            samples = metric.render()
+            if samples:
+                lines.extend(metric.header())
+                lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+bot_requests = registry.counter('chatgpt_mixin_bot_requests_total', 'Messages sent to the bot.', ('bot',))
+bot_errors = registry.counter('chatgpt_mixin_bot_errors_total', 'Answers of the bot that failed.', ('bot',))
+bot_rate_limited = registry.counter('chatgpt_mixin_bot_rate_limited_total', 'Rate limit responses, 429, the bot got.', ('bot',))
+bot_in_flight = registry.gauge('chatgpt_mixin_bot_in_flight', 'Answers the bot is working on.', ('bot',))
+bot_standby = registry.gauge('chatgpt_mixin_bot_standby', '1 if the bot is on standby.', ('bot',))
+bot_time_to_first_chunk = registry.histogram('chatgpt_mixin_bot_time_to_first_chunk_seconds',
+    'Seconds until the first chunk of an answer.', ('bot',))
+bot_answer_seconds = registry.histogram('chatgpt_mixin_bot_answer_seconds', 'Seconds until an answer is complete.', ('bot',))
+completion_tokens = registry.counter('chatgpt_mixin_completion_tokens_total', 'Completion tokens generated.', ('bot',))
+completion_tokens_per_second = registry.histogram('chatgpt_mixin_completion_tokens_per_second',
+    'Completion tokens per second of streamed answers, after the first token.', ('bot',), tokens_per_second_buckets)
+store_operation_seconds = registry.histogram('chatgpt_mixin_store_operation_seconds',
+    'Seconds of store operations.', ('store', 'operation'), store_buckets)
+questions = registry.gauge('chatgpt_mixin_questions', 'Saved questions waiting for an answer, and given up ones.', ('state',))
+websocket_connects = registry.counter('chatgpt_mixin_websocket_connects_total', 'Websocket connections opened.')
+websocket_reconnects = registry.counter('chatgpt_mixin_websocket_reconnects_total', 'Websocket connections opened after the first one.')
+
+class MetricsServer:
+    """Serves `GET /metrics` of a registry over plain HTTP, meant to listen on a local address."""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 9108, registry: Registry = registry):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    @classmethod
+    def from_config(cls, config, port_offset: int = 0) -> Optional['MetricsServer']:
+        if not config or not config.get('enabled', True):
+            return None
+        config = {key: value for key, value in config.items() if key != 'enabled'}
+        server = cls(**config)
+        server.port += port_offset
+        return server
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        logger.info("+++serving metrics on http://%s:%s/metrics", self.host, self.port)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10.0)
+            # the headers are not needed
+            while (await asyncio.wait_for(reader.readline(), 10.0)).strip():
+                pass
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, content_type, body = '200 OK', 'text/plain; version=0.0.4; charset=utf-8', (await self.registry.render()).encode()
+            else:
+                status, content_type, body = '404 Not Found', 'text/plain; charset=utf-8', b'not found\n'
+            writer.write(
+                f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode()
+                + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
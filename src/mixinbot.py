@@ -2,6 +2,7 @@
 
 import asyncio
 import base64
+import importlib
 import os
 import platform
 import signal
@@ -9,15 +10,33 @@ import sys
 import time
 import traceback
 from dataclasses import dataclass
-from datetime import datetime
-from typing import Any, Dict, List, Optional, Set, Union
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Dict, List, Optional, Set, Tuple, Union
 
-import httpx
 import websockets
-import yaml
 from pymixin import log, utils
 from pymixin.mixin_ws_api import MessageView, MixinWSApi
 
+from . import metrics, tracing
+from .acks import AckBatcher
+from .admission import AdmissionController
+from .async_log import AsyncLogging
+from .config_reload import BackendId, ConfigWatcher, backend_specs, load_config
+from .flush_policy import FlushPolicy
+from .group_debounce import GroupDebouncer, GroupMessage, merge_messages
+from .http_pool import HttpPool
+from .metrics import MetricsServer
+from .outbox import Outbox
+from .question_queue import Question, QuestionQueue
+from .resilience import RetryPolicy
+from .response_cache import ResponseCache
+from .retention import ConversationSweeper, RetentionPolicy
+from .scheduler import BotScheduler
+from .tokenizer import g_tokenizer
+from .tracing import Tracer
+from .web_search import WebappSearchProvider, WebSearch
+from .workers import WorkerPool, shard_for
+
 logger = log.get_logger(__name__)
 logger.addHandler(log.handler)
 
@@ -27,12 +46,6 @@ class AnswerRequestTask:
     user_id: str
     task: asyncio.Task
 
-@dataclass
-class SavedQuestion:
-    conversation_id: str
-    user_id: str
-    data: str
-
 sayhi = {
     'hi': '''
 Hello, this is an intelligent robot. Is there anything I can help you with?
@@ -119,10 +132,40 @@ here is a list of things that I As an AI language model, can do, along with a br
     '''
 }
 
+busy_reply = "Sorry, I am busy right now, please try again in a minute."
+
+# keys of the stats() of the components which only grow, exported as counters, the others as gauges
+component_counters = {
+    'admission': ('admitted', 'shed'),
+    'group_debounce': ('messages', 'batches'),
+    'outbox': ('texts', 'messages', 'send_time'),
+    'web_search': ('hits', 'misses', 'errors'),
+    'response_cache': ('hits', 'disk_hits', 'misses'),
+    'workers': ('dispatched', 'texts', 'restarts'),
+    'tracing': ('exported', 'dropped'),
+    'logging': ('dropped', 'sampled_out'),
+    'conversation_cache': ('hits', 'misses', 'evictions'),
+}
+# components answering messages, in worker mode they live in the workers, which export them,
+# group messages are merged by the process receiving them
+worker_components = ('admission', 'web_search', 'response_cache', 'conversation_cache')
+
+def parse_created_at(created_at: str) -> Optional[float]:
+    """Parse timestamps like `2023-03-20T08:53:09.123456789Z` to seconds since the epoch."""
+    try:
+        seconds, _, fraction = created_at.rstrip('Z').partition('.')
+        return datetime.strptime(seconds, '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc).timestamp() + float('0.' + (fraction or '0'))
+    except (AttributeError, ValueError):
+        return None
+
 class MixinBot(MixinWSApi):
-    def __init__(self, config_file):
-        f = open(config_file)
-        config = yaml.safe_load(f)
+    def __init__(self, config_file, worker_index: Optional[int] = None):
+        self.config_file = config_file
+        config = load_config(config_file)
+        # None writes log records on the logging thread, as set up by pymixin
+        self.async_log = AsyncLogging.from_config(config.get('logging'))
+        if self.async_log:
+            self.async_log.start()
         super().__init__(config['bot_config'], on_message=self.on_message)
         self.chatgpt_accounts = config['accounts']
         self.openai_api_keys = config['openai_api_keys']
@@ -136,146 +179,418 @@ class MixinBot(MixinWSApi):
         else:
             self.openai_proxy_url = ''
 
+        self.conversation_cache = config.get('conversation_cache') or {}
+        # concurrent requests of each openai api key
+        self.openai_max_concurrency = config.get('openai_max_concurrency', 8)
+        self.flush_policy = FlushPolicy.from_config(config.get('stream_flush'))
+        # used for api keys until the api reports their real limits
+        self.openai_rate_limits = config.get('openai_rate_limits') or {}
+        self.summarize = config.get('summarize') or {}
+        # shared by all api keys, None if disabled
+        self.response_cache = ResponseCache.from_config(config.get('response_cache'))
+        # shared by all api keys so the hedging deadline sees every request
+        self.retry_policy = RetryPolicy.from_config(config.get('openai_retry'))
+
         self.client_id = config['bot_config']['client_id']
 
-        self.tasks: List[SavedQuestion] = []
-        self.saved_questions: Dict[str, SavedQuestion] = {}
+        # received messages are acknowledged in batches in the background
+        self.acks = AckBatcher(self.send_acks, **(config.get('acks') or {}))
+        # texts sent to conversations in the background, joined and rate limited
+        self.outbox = Outbox(self.sendUserText, **(config.get('outbox') or {}))
+        # limits and fair ordering of the messages handled at a time
+        self.admission = AdmissionController.from_config(config.get('admission'))
+        # group messages arriving in quick succession are answered together
+        self.group_debounce = GroupDebouncer(self.submit_group_messages, **(config.get('group_debounce') or {}))
+        # questions waiting for an answer, kept across restarts
+        self.questions = QuestionQueue.from_config(config.get('question_queue'))
 
         self.developer_conversation_id = None
         self.developer_user_id = None
-        self.web_client = httpx.AsyncClient()
+        # None keeps everything forever
+        self.retention = RetentionPolicy.from_config(config.get('retention'))
+        self.sweeper: Optional[ConversationSweeper] = None
+        # connection pools shared by the api backends and the web search
+        self.http_pool = HttpPool.from_config(config.get('http_pool'))
+        self.web_search = WebSearch.from_config(config.get('web_search'), self.http_pool.client())
+        if isinstance(self.web_search.provider, WebappSearchProvider):
+            self.http_pool.add_warm_up(self.web_search.provider.url)
 
         if 'developer_conversation_id' in config:
             self.developer_conversation_id = config['developer_conversation_id']
             self.developer_user_id = config['developer_user_id']
+        # loaded in the background once the api backends start
+        g_tokenizer.configure(**(config.get('tokenizer') or {}))
         # openai_api_key
         self.bots = []
+        # initialization of each backend by id, its result is the bot or None if it failed,
+        # backends take messages as soon as they are ready
+        self.backends: Dict[BackendId, asyncio.Task] = {}
+        # removed by a reload and finishing their answers
+        self.retiring: Set[asyncio.Task] = set()
+        self.playwright: Optional[asyncio.Future] = None
+        self.openai_module: Optional[asyncio.Future] = None
+        self.warm_up_task: Optional[asyncio.Task] = None
+        # the config is applied again on SIGHUP, or when it changes if watched
+        self.reload_config = config.get('reload') or {}
+        self.reload_lock = asyncio.Lock()
+        self.config_watcher = ConfigWatcher.from_config(self.reload_config, config_file, self.reload)
+        self.scheduler = BotScheduler(**(config.get('scheduler') or {}))
         self.standby_bots = []
 
+        # processes answering the messages, with more than one this process only receives and sends them
+        self.worker_count = max(1, config.get('workers') or 1)
+        # set in worker processes
+        self.worker_index = worker_index
+        self.worker_pool: Optional[WorkerPool] = None
+        if self.worker_count > 1 and worker_index is None:
+            if not self.openai_api_keys:
+                raise Exception("workers need openai_api_keys, browser accounts are only used by the first worker")
+            self.worker_pool = WorkerPool(config_file, self.worker_count, run_worker)
+        # stages of handling sampled messages
+        self.tracer = Tracer.from_config(config.get('tracing'), self.http_pool.client())
+        # websocket connections opened
+        self.connects = 0
+        # None if disabled, workers listen on the next ports
+        self.metrics_server = MetricsServer.from_config(config.get('metrics'), 0 if worker_index is None else worker_index + 1)
+
     async def init(self):
-        asyncio.create_task(self.handle_questions())
-
-        if self.chatgpt_accounts:
-            from playwright.async_api import async_playwright
-
-            from .chatgpt_browser import ChatGPTBot
-            PLAY = await async_playwright().start()
-            for account in self.chatgpt_accounts:
-                user = account['user']
-                psw = account['psw']
-                bot = ChatGPTBot(PLAY, user, psw)
-                await bot.init()
-                self.bots.append(bot)
-
-        if self.openai_api_keys:
-            from .chatgpt_openai import ChatGPTBot
-            for key in self.openai_api_keys:
-                bot = ChatGPTBot(key, self.openai_base_url, self.openai_proxy_url)
-                await bot.init()
-                self.bots.append(bot)
-        
-        assert self.bots
+        await self.start_metrics()
+        if self.worker_pool:
+            # the workers answer the messages and this process sends their texts
+            await self.worker_pool.start(self.on_worker_text)
+        else:
+            await self.init_bots()
 
         loop = asyncio.get_running_loop()
         loop.add_signal_handler(signal.SIGINT, lambda: asyncio.create_task(self.handle_signal(signal.SIGINT)))
         loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.handle_signal(signal.SIGTERM)))
+        if hasattr(signal, 'SIGHUP'):
+            loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.create_task(self.reload()))
+        if self.config_watcher:
+            self.config_watcher.start()
+
+    async def init_bots(self):
+        """Initialize all backends concurrently, return once the first one is ready."""
+        self.update_backends(load_config(self.config_file))
+        if not self.backends:
+            raise Exception("no accounts or openai_api_keys are configured")
+        await self.questions.open(self.answer_question, self.on_dead_question)
+
+        pending = set(self.backends.values())
+        while pending and not self.bots:
+            _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        if not self.bots:
+            raise Exception("no backend could be initialized")
+        logger.info("+++%s of %s backends are ready", len(self.bots), len(self.backends))
+
+    def update_backends(self, config: Dict[str, Any]):
+        """Start the backends of `config` that are not running and retire those it doesn't have."""
+        # one browser session per account, kept by the first worker
+        specs = {backend_id: spec for backend_id, spec in backend_specs(config).items()
+                 if backend_id[0] != 'browser' or not self.worker_index}
+        for backend_id in [backend_id for backend_id in self.backends if backend_id not in specs]:
+            self.retire_backend(self.backends.pop(backend_id))
+        for backend_id, spec in specs.items():
+            if backend_id in self.backends:
+                continue
+            if backend_id[0] == 'browser':
+                init = self.init_browser_bot(self.get_playwright(), spec)
+            else:
+                init = self.init_openai_bot(self.import_openai(), spec)
+            self.backends[backend_id] = asyncio.create_task(self.add_bot(init))
+
+    async def add_bot(self, init: Awaitable[Any]) -> Optional[Any]:
+        try:
+            bot = await init
+        except Exception as e:
+            logger.exception(e)
+            return None
+        self.bots.append(bot)
+        self.scheduler.add(bot)
+        # saved questions may be answered by the new bot
+        self.questions.notify()
+        return bot
+
+    def retire_backend(self, task: asyncio.Task):
+        if not task.done():
+            # still starting
+            task.cancel()
+            return
+        bot = None if task.cancelled() else task.result()
+        if bot:
+            retiring = asyncio.create_task(self.retire_bot(bot))
+            self.retiring.add(retiring)
+            retiring.add_done_callback(self.retiring.discard)
+
+    async def retire_bot(self, bot: Any):
+        """Stop sending messages to `bot` and close it once its answers in flight are done."""
+        self.bots.remove(bot)
+        stats = self.scheduler.drain(bot)
+        logger.info("+++retiring %s, %s answers in flight", bot.name, stats.in_flight)
+        deadline = time.monotonic() + self.reload_config.get('drain_timeout', 300.0)
+        try:
+            # a bot chosen right before it was drained starts its answer a moment later
+            await asyncio.sleep(1.0)
+            while stats.in_flight > 0 and time.monotonic() < deadline:
+                await asyncio.sleep(1.0)
+        finally:
+            self.scheduler.forget(bot)
+            if self.sweeper and self.openai_module.result().g_bots == [bot]:
+                # the last api bot closes the conversation store, the sweeper is started
+                # again by the next one
+                await self.sweeper.stop()
+                self.sweeper = None
+            await bot.close()
+            logger.info("+++retired %s", bot.name)
+
+    async def reload(self):
+        """Apply the config file again: start added backends, retire removed ones and update limits in place.
+
+        Other settings, like the number of workers, take effect on the next start.
+        """
+        async with self.reload_lock:
+            try:
+                config = load_config(self.config_file)
+                if not backend_specs(config):
+                    raise ValueError("no accounts or openai_api_keys are configured")
+            except Exception as e:
+                logger.error("+++reloading %s failed, the running config is kept: %s", self.config_file, e)
+                return
+            logger.info("+++reloading %s", self.config_file)
+            if self.worker_pool:
+                # the backends and limits are in the workers, group messages are merged here
+                self.group_debounce.configure(**(config.get('group_debounce') or {}))
+                self.worker_pool.reload()
+                return
+            self.update_limits(config)
+            self.update_backends(config)
+
+    def update_limits(self, config: Dict[str, Any]):
+        # used by the backends started from now on
+        self.openai_base_url = config.get('openai_base_url') or ''
+        self.openai_proxy_url = config.get('openai_proxy_url') or ''
+        self.openai_max_concurrency = config.get('openai_max_concurrency', 8)
+        self.openai_rate_limits = config.get('openai_rate_limits') or {}
+        self.summarize = config.get('summarize') or {}
+        self.conversation_cache = config.get('conversation_cache') or {}
+        self.reload_config = config.get('reload') or {}
+        # shared with the running bots and their streams
+        self.flush_policy.update(FlushPolicy.from_config(config.get('stream_flush')))
+        self.admission.set_limits(**(config.get('admission') or {}))
+        self.group_debounce.configure(**(config.get('group_debounce') or {}))
+        if self.async_log:
+            self.async_log.configure(**(config.get('logging') or {}))
+        for bot in self.bots:
+            # browser bots answer one message at a time
+            if not hasattr(bot, 'set_max_concurrency'):
+                continue
+            bot.set_max_concurrency(self.openai_max_concurrency)
+            bot.rate_limiter.set_default_limits(self.openai_rate_limits.get('requests_per_minute'),
+                                                self.openai_rate_limits.get('tokens_per_minute'))
+            bot.summarize_threshold = self.summarize.get('threshold_tokens', 0)
+            bot.summarize_keep_tokens = self.summarize.get('keep_tokens', 1000)
+        self.scheduler.update_weights()
+
+    def get_playwright(self) -> asyncio.Future:
+        # started once for all accounts, again if it failed
+        if not self.playwright or (self.playwright.done() and self.playwright.exception()):
+            self.playwright = asyncio.ensure_future(self.start_playwright())
+        return self.playwright
+
+    async def start_playwright(self):
+        loop = asyncio.get_running_loop()
+        module = await loop.run_in_executor(None, importlib.import_module, 'playwright.async_api')
+        return await module.async_playwright().start()
+
+    def import_openai(self) -> asyncio.Future:
+        if not self.openai_module:
+            g_tokenizer.start()
+            # importing the openai sdk takes a while, the event loop keeps running meanwhile
+            loop = asyncio.get_running_loop()
+            self.openai_module = loop.run_in_executor(None, importlib.import_module, '.chatgpt_openai', __package__)
+        return self.openai_module
+
+    async def init_browser_bot(self, playwright: Awaitable[Any], account: Dict[str, str]):
+        from .chatgpt_browser import ChatGPTBot
+        expired_user_ttl = self.retention.expired_user_ttl if self.retention else 0.0
+        # shared by the accounts, a reload cancelling this one leaves it running for the others
+        bot = ChatGPTBot(await asyncio.shield(playwright), account['user'], account['psw'], flush_policy=self.flush_policy, expired_user_ttl=expired_user_ttl)
+        await self.init_backend(bot)
+        return bot
+
+    async def init_backend(self, bot: Any):
+        try:
+            await bot.init()
+        except BaseException:
+            # failed, or cancelled by a reload removing it while it was starting
+            await bot.close()
+            raise
+
+    async def init_openai_bot(self, module: Awaitable[Any], key: str):
+        chatgpt_openai = await asyncio.shield(module)
+        from .conversation_cache import default_max_bytes, default_ttl
+        cache_max_bytes = self.conversation_cache.get('max_bytes', default_max_bytes)
+        cache_ttl = self.conversation_cache.get('ttl', default_ttl)
+        bot = chatgpt_openai.ChatGPTBot(key, self.openai_base_url, self.openai_proxy_url,
+                            cache_max_bytes=cache_max_bytes, cache_ttl=cache_ttl,
+                            max_concurrency=self.openai_max_concurrency, flush_policy=self.flush_policy,
+                            requests_per_minute=self.openai_rate_limits.get('requests_per_minute'),
+                            tokens_per_minute=self.openai_rate_limits.get('tokens_per_minute'),
+                            summarize_threshold=self.summarize.get('threshold_tokens', 0),
+                            summarize_keep_tokens=self.summarize.get('keep_tokens', 1000),
+                            response_cache=self.response_cache, retry_policy=self.retry_policy,
+                            http_pool=self.http_pool)
+        if not self.warm_up_task:
+            # pay for the tls handshakes before the first user does, all keys share the origin
+            self.warm_up_task = asyncio.create_task(self.http_pool.warm_up())
+        await self.init_backend(bot)
+        # the databases are shared by the workers, one of them sweeps them
+        if self.retention and not self.worker_index and not self.sweeper:
+            self.sweeper = ConversationSweeper(chatgpt_openai.g_conversations.store, self.retention, chatgpt_openai.g_conversations,
+                                               on_swept=self.on_conversations_swept)
+            self.sweeper.start()
+        return bot
+
+    def on_conversations_swept(self, conversation_ids: List[str]):
+        # the cache of this process is updated by the sweeper
+        pass
+
+    async def start_metrics(self):
+        if not self.metrics_server:
+            return
+        metrics.registry.add_collector(self.collect_metrics)
+        try:
+            await self.metrics_server.start()
+        except OSError as e:
+            # the bot works without metrics
+            logger.error("+++metrics server failed to start: %s", e)
+
+    async def collect_metrics(self):
+        for bot in self.bots:
+            metrics.bot_in_flight.set(self.scheduler.get_stats(bot).in_flight, bot.name)
+            metrics.bot_standby.set(float(bot.standby), bot.name)
+        if self.questions.store.db:
+            for state, count in (await self.questions.store.count()).items():
+                metrics.questions.set(count, state)
+        components = {
+            'admission': self.admission,
+            'group_debounce': self.group_debounce,
+            'outbox': self.outbox,
+            'web_search': self.web_search,
+            'response_cache': self.response_cache,
+            'workers': self.worker_pool,
+            'tracing': self.tracer,
+            'logging': self.async_log,
+        }
+        if self.openai_api_keys and not self.worker_pool:
+            from .chatgpt_openai import g_conversations
+            components['conversation_cache'] = g_conversations
+        for component, source in components.items():
+            if not source or (self.worker_pool and component in worker_components):
+                continue
+            counters = component_counters.get(component, ())
+            for key, value in source.stats().items():
+                description = f'{key.replace("_", " ")} of the {component.replace("_", " ")}.'
+                if key in counters:
+                    metrics.registry.counter(f'chatgpt_mixin_{component}_{key}_total', description).set_total(value)
+                else:
+                    metrics.registry.gauge(f'chatgpt_mixin_{component}_{key}', description).set(value)
 
     async def handle_signal(self, signum):
         logger.info("+++++++handle signal: %s", signum)
+        # messages received so far are not delivered again
+        await self.acks.close()
+        if self.worker_pool:
+            await self.worker_pool.close()
+            await self.outbox.close()
+        await self.tracer.close()
+        # the tasks are cancelled without closing the bot
+        await self.save_group_batches()
         loop = asyncio.get_running_loop()
         for task in asyncio.all_tasks(loop):
             task.cancel()
 
-    def choose_bot(self, user_id):
-        bots = []
-        for bot in self.bots:
-            if bot.standby:
-                continue
-            bots.append(bot)
-
-        for bot in bots:
-            if user_id in bot.users:
-                return bot
+    async def save_group_batches(self):
+        # group messages still waiting for the window are answered after a restart
+        batches = self.group_debounce.close()
+        if batches and self.worker_pool:
+            # the questions are answered by the workers, this process only saves them
+            await self.questions.store.open()
+        for conversation_id, messages in batches.items():
+            await self.save_question(conversation_id, messages[-1].user_id, merge_messages(messages))
 
-        bot_index = 0
-        user_counts = [len(bot.users) for bot in bots]
-        try:
-            bot_index = user_counts.index(min(user_counts))
-            return bots[bot_index]
-        except ValueError:
-            return None
+    def choose_bot(self, user_id):
+        return self.scheduler.choose(user_id)
 
-    async def send_message_to_chat_gpt(self, conversation_id: str, user_id: str, message: str):
-        bot = self.choose_bot(user_id)
+    async def ask_chat_gpt(self, conversation_id: str, user_id: str, message: str, stream: bool = True) -> bool:
+        """Answer `message`, return False if no bot is available, raise if the bot failed."""
+        with tracing.span('choose_bot'):
+            bot = self.choose_bot(user_id)
         if not bot:
             logger.info('no available bot')
-            self.save_question(conversation_id, user_id, message)
-            #queue message
             return False
+
         if message.startswith('/web'):
             message = message.replace('/web', '', 1)
             old_message = message
-            message = await self.get_web_result(message)
+            with tracing.span('web_search'):
+                message = await self.get_web_result(message)
             if not old_message == message:
                 await self.sendUserText(conversation_id, user_id, message)
+
         try:
-            async for msg in bot.send_message(user_id, message):
-                await self.sendUserText(conversation_id, user_id, msg)
-            await self.sendUserText(conversation_id, user_id, "[END]")
-            return True
+            if stream:
+                start = time.monotonic()
+                async for msg in self.scheduler.observe(bot, bot.send_message(user_id, message)):
+                    # markers stay messages of their own
+                    self.outbox.push(conversation_id, user_id, msg, coalesce=msg.strip() != '[BEGIN]')
+                upstream_time = time.monotonic() - start
+                self.outbox.push(conversation_id, user_id, "[END]", coalesce=False)
+                with tracing.span('send'):
+                    send_time = await self.outbox.flush(conversation_id, user_id)
+                duration = time.monotonic() - start
+                logger.info("+++answered %s, upstream %.2f seconds, sending %.2f seconds, done after %.2f seconds",
+                    conversation_id, upstream_time, send_time, duration,
+                    extra={'conversation': conversation_id, 'user': user_id, 'bot': bot.name, 'stage': 'answer', 'duration': duration})
+            else:
+                msgs: List[str] = []
+                async for msg in self.scheduler.observe(bot, bot.send_message(user_id, message)):
+                    msgs.append(msg)
+                with tracing.span('send'):
+                    await self.sendUserText(conversation_id, user_id, ''.join(msgs) + '\n[END]')
+        finally:
+            # the bot can take the next question
+            self.questions.notify()
+        return True
+
+    async def send_message_to_chat_gpt(self, conversation_id: str, user_id: str, message: str, stream: bool = True):
+        if self.questions.is_pending(user_id):
+            # answer the questions of a user in order
+            await self.save_question(conversation_id, user_id, message)
+            return False
+        try:
+            if await self.ask_chat_gpt(conversation_id, user_id, message, stream):
+                return True
         except Exception as e:
             logger.exception(e)
-        self.save_question(conversation_id, user_id, message)
+        await self.save_question(conversation_id, user_id, message)
         return False
 
     async def send_message_to_chat_gpt2(self, conversation_id, user_id, message):
-        bot = self.choose_bot(user_id)
-        if not bot:
-            logger.info('no available bot')
-            self.save_question(conversation_id, user_id, message)
-            #TODO: queue message
-            return False
-
-        if message.startswith('/web'):
-            message = message.replace('/web', '', 1)
-            old_message = message
-            message = await self.get_web_result(message)
-            if not old_message == message:
-                await self.sendUserText(conversation_id, user_id, message)
+        return await self.send_message_to_chat_gpt(conversation_id, user_id, message, stream=False)
 
-        msgs: List[str] = []
-        try:
-            async for msg in bot.send_message(user_id, message):
-                msgs.append(msg)
-            await self.sendUserText(conversation_id, user_id, ''.join(msgs) + '\n[END]')
-            return True
-        except Exception as e:
-            logger.exception(e)
-        self.save_question(conversation_id, user_id, message)
-        return False
+    async def answer_question(self, question: Question) -> bool:
+        with self.tracer.trace('question', conversation_id=question.conversation_id, user_id=question.user_id, attempts=question.attempts):
+            return await self.ask_chat_gpt(question.conversation_id, question.user_id, question.data, stream=False)
 
-    async def handle_questions(self):
-        while True:
-            try:
-                await asyncio.sleep(15.0)
-                handled_question = []
-                saved_questions = self.saved_questions.copy()
-                for user_id, question in saved_questions.items():
-                    try:
-                        logger.info("++++++++handle question: %s", question.data)
-                        if await self.send_message_to_chat_gpt2(question.conversation_id, question.user_id, question.data):
-                            handled_question.append(user_id)
-                    except Exception as e:
-                        logger.info("%s", str(e))
-                        continue
-                for question in handled_question:
-                    del self.saved_questions[question]
-            except asyncio.exceptions.CancelledError:
-                logger.info("++++handle_questions received CancelledError exception, exit..")
-                return
+    async def on_dead_question(self, question: Question, error: Exception):
+        await self.sendUserText(question.conversation_id, question.user_id, "Sorry, I could not answer your question, please try again later.")
+        if self.developer_user_id:
+            await self.sendUserText(self.developer_conversation_id, self.developer_user_id, f"question {question.id} failed {question.attempts + 1} times: {error}")
 
-    def save_question(self, conversation_id, user_id, data):
-        self.saved_questions[user_id] = SavedQuestion(conversation_id, user_id, data)
+    async def save_question(self, conversation_id, user_id, data):
+        with tracing.span('save_question'):
+            await self.questions.put(conversation_id, user_id, data)
 
     async def handle_user_message(self, conversation_id, user_id, message):
         try:
@@ -288,31 +603,8 @@ class MixinBot(MixinWSApi):
                 await self.sendUserText(self.developer_conversation_id, self.developer_user_id, f"exception occur at:{time.time()}: {traceback.format_exc()}")
 
     async def get_web_result(self, message: str):
-        date = datetime.now()
-        formatted_date = date.strftime('%m/%d/%Y')
-        prompt = message
-        search = message
-        if message.count('/p ') == 1:
-            search, prompt = message.split('/p ')
-        logger.info("+++++%s %s", search, prompt)
-        url = f'https://ddg-webapp-aagd.vercel.app/search?max_results=3&q="{search}"'
-        r = httpx.get(url)
-        results: List[Any] = r.json()
-        logger.info("++++++results: %s", results)
-        if not results:
-            return prompt
-        counter = 0
-        querys = []
-        querys.append("Web search results:\n\n")
-        for a in results:
-            counter += 1
-            body = a['body']
-            href = a['href']
-            querys.append(f'[{counter}] "{body}"')
-            querys.append(f"Source: {href}")
-        querys.append(f"\nCurrent date: {formatted_date}")
-        querys.append(f"\nInstructions: Using the provided web search results, write a comprehensive reply to the given prompt. Make sure to cite results using [[number](URL)] notation after the reference. If the provided search results refer to multiple subjects with the same name, write separate answers for each subject.\nPrompt: {prompt}")
-        return "\n".join(querys)
+        return await self.web_search.prompt(message)
+
     async def handle_group_message(self, conversation_id, user_id, data):
         try:
             await self.send_message_to_chat_gpt2(conversation_id, user_id, data)
@@ -333,43 +625,151 @@ class MixinBot(MixinWSApi):
         if not msg:
             return
 
-        logger.info('++++++++conversation_id:%s', msg.conversation_id)
-
-        await self.echoMessage(msg.message_id)
-
-        logger.info('user_id %s', msg.user_id)
-        logger.info("created_at %s",msg.created_at)
+        logger.info('+++received %s', msg.message_id,
+            extra={'category': 'message', 'conversation': msg.conversation_id, 'user': msg.user_id, 'stage': 'receive'})
 
+        self.acks.add(msg.message_id)
+        if self.worker_pool:
+            if await self.debounce_group_message(msg):
+                return
+            # the conversations of a user are kept by the backends under the user id
+            self.worker_pool.dispatch(msg.user_id, msg)
+            return
+        await self.handle_message_view(msg)
+
+    async def handle_message_view(self, msg: MessageView):
+        with self.tracer.trace('message', conversation_id=msg.conversation_id, user_id=msg.user_id,
+                category=msg.category, worker=self.worker_index) as trace:
+            created_at = parse_created_at(msg.created_at)
+            if trace and created_at:
+                # from the message being created to it being handled here, includes the clock offset to the server
+                trace.add_span('delivery', trace.start - (trace.start_time - created_at), trace.start)
+            await self.dispatch_message(msg)
+
+    def decode_message(self, msg: MessageView) -> Optional[str]:
+        """The text of a message to answer, None if it is ignored."""
         if not msg.category in ["SYSTEM_ACCOUNT_SNAPSHOT", "PLAIN_TEXT", "SYSTEM_CONVERSATION", "PLAIN_STICKER", "PLAIN_IMAGE", "PLAIN_CONTACT"]:
             logger.info("unknown category: %s", msg.category)
-            return
+            return None
 
         if not msg.category == "PLAIN_TEXT" and msg.type == "message":
-            return
+            return None
 
         data = msg.data
-        logger.info(data)
         data = base64.urlsafe_b64decode(data)
 
         if data.startswith(b'@'):
             index = data.find(b' ')
             if index == -1:
-                return
+                return None
             data = data[index + 1:]
         data = data.decode()
-        logger.info(data)
+        logger.info('+++message: %s', data,
+            extra={'category': 'payload', 'conversation': msg.conversation_id, 'user': msg.user_id, 'stage': 'decode'})
+        return data
+
+    async def debounce_group_message(self, msg: MessageView) -> bool:
+        """In worker mode, merge the group messages here, members of a group are routed to different workers.
+
+        Return False for messages to dispatch to the worker of their sender.
+        """
+        if not self.group_debounce.enabled or msg.category != "PLAIN_TEXT":
+            return False
+        if utils.unique_conversation_id(msg.user_id, self.client_id) == msg.conversation_id:
+            return False
+        data = self.decode_message(msg)
+        if data is None:
+            return True
+        if data in sayhi:
+            return False
+        if data.startswith('/'):
+            # commands are handled on their own, after the messages sent before them
+            await self.group_debounce.flush(msg.conversation_id)
+            return False
+        await self.group_debounce.add(msg.conversation_id, GroupMessage(msg.user_id, data))
+        return True
+
+    async def dispatch_message(self, msg: MessageView):
+        data = self.decode_message(msg)
+        if data is None:
+            return
 
         try:
             reply = sayhi[data]
-            await self.sendUserText(msg.conversation_id, msg.user_id, reply)
+            with tracing.span('send'):
+                await self.sendUserText(msg.conversation_id, msg.user_id, reply)
             return
         except KeyError:
             pass
 
-        if utils.unique_conversation_id(msg.user_id, self.client_id) == msg.conversation_id:
-            asyncio.create_task(self.handle_user_message(msg.conversation_id, msg.user_id, data))
+        conversation_id = msg.conversation_id
+        user_id = msg.user_id
+        if utils.unique_conversation_id(user_id, self.client_id) == conversation_id:
+            admitted = self.submit(user_id, conversation_id, True, lambda: self.handle_user_message(conversation_id, user_id, data))
         else:
-            asyncio.create_task(self.handle_group_message(msg.conversation_id, msg.user_id, data))
+            if self.group_debounce.enabled:
+                if not data.startswith('/'):
+                    await self.group_debounce.add(conversation_id, GroupMessage(user_id, data, trace=tracing.hold()))
+                    return
+                # commands are handled on their own, after the messages sent before them
+                await self.group_debounce.flush(conversation_id)
+            admitted = self.submit(user_id, conversation_id, False, lambda: self.handle_group_message(conversation_id, user_id, data))
+        if not admitted:
+            await self.sendUserText(conversation_id, user_id, busy_reply)
+
+    async def submit_group_messages(self, conversation_id: str, messages: List[GroupMessage]):
+        """Answer a batch of group messages with one completion."""
+        # the answer goes to the last sender, the backends keep the context of the group under their id
+        user_id = messages[-1].user_id
+        if self.worker_pool:
+            # answered by the worker of the last sender, like its own messages
+            self.worker_pool.dispatch(user_id, ('group', conversation_id, [(message.user_id, message.text) for message in messages]))
+            return
+        data = merge_messages(messages)
+        # the batch is traced as the last message, the others end once it is handed on
+        token = tracing.current_trace.set(messages[-1].trace)
+        try:
+            for message in messages:
+                if message.trace:
+                    message.trace.add_span('debounce', message.received_at, messages=len(messages))
+            admitted = self.submit(user_id, conversation_id, False, lambda: self.handle_group_message(conversation_id, user_id, data))
+        finally:
+            tracing.current_trace.reset(token)
+            for message in messages:
+                if message.trace:
+                    message.trace.release()
+        if not admitted:
+            await self.sendUserText(conversation_id, user_id, busy_reply)
+
+    async def connect(self):
+        if self.ws:
+            return
+        await super().connect()
+        if self.connects:
+            metrics.websocket_reconnects.inc()
+        self.connects += 1
+        metrics.websocket_connects.inc()
+
+    def submit(self, user_id: str, conversation_id: str, direct: bool, handler) -> bool:
+        """Queue `handler` with the admission controller, the trace of the message stays open until it is done."""
+        trace = tracing.hold()
+        queued_at = time.monotonic()
+
+        async def traced_handler():
+            if not trace:
+                return await handler()
+            # the task may have been started from the context of another message
+            tracing.current_trace.set(trace)
+            trace.add_span('admission', queued_at)
+            try:
+                return await handler()
+            finally:
+                trace.release()
+
+        admitted = self.admission.submit(user_id, conversation_id, direct, traced_handler)
+        if not admitted and trace:
+            trace.release()
+        return admitted
 
     async def run(self):
         try:
@@ -377,13 +777,118 @@ class MixinBot(MixinWSApi):
         except asyncio.CancelledError:
             if self.ws:
                 await self.ws.close()
-            if self.web_client:
-                await self.web_client.aclose()
             logger.info("mixin websocket received CancelledError, exit...")
 
+    async def send_acks(self, message_ids: List[str]):
+        # one request for the whole batch instead of a websocket message per ack
+        await self.bot.post('/acknowledgements', [{'message_id': message_id, 'status': 'READ'} for message_id in message_ids])
+
+    def on_worker_text(self, conversation_id: str, user_id: str, text: str):
+        # the worker has already joined the texts into messages
+        self.outbox.push(conversation_id, user_id, text, coalesce=False)
+
     async def close(self):
+        if self.config_watcher:
+            await self.config_watcher.stop()
+        # backends still starting up, retired ones are closed once cancelled
+        tasks = list(self.backends.values()) + list(self.retiring) + ([self.warm_up_task] if self.warm_up_task else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.metrics_server:
+            metrics.registry.remove_collector(self.collect_metrics)
+            await self.metrics_server.close()
+        await self.tracer.close()
+        await self.acks.close()
+        if self.worker_pool:
+            await self.worker_pool.close()
+        await self.outbox.close()
+        if self.sweeper:
+            await self.sweeper.stop()
+        await self.save_group_batches()
+        await self.questions.close()
         for bot in self.bots:
             await bot.close()
+        await self.http_pool.aclose()
+        if self.async_log:
+            self.async_log.stop()
+
+class WorkerBot(MixinBot):
+    """Answers the messages and merged group messages a WorkerPool routes to this process, its texts are sent by the pool."""
+
+    def __init__(self, config_file, worker_index: int, inbox, replies):
+        super().__init__(config_file, worker_index)
+        self.inbox = inbox
+        self.replies = replies
+        # questions of other users are answered by their workers
+        self.questions.owns = lambda user_id: shard_for(user_id, self.worker_count) == worker_index
+
+    async def sendUserText(self, in_conversation_id, to_user_id, text: Union[bytes, str]):
+        self.replies.put(('text', in_conversation_id, to_user_id, text))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            msg = await loop.run_in_executor(None, self.inbox.get)
+            if msg is None:
+                return
+            if msg == 'reload':
+                await self.reload()
+                continue
+            try:
+                if isinstance(msg, tuple) and msg[0] == 'invalidate':
+                    self.invalidate_conversations(msg[1])
+                    continue
+                if isinstance(msg, tuple):
+                    await self.handle_group_batch(*msg[1:])
+                    continue
+                await self.handle_message_view(msg)
+            except Exception as e:
+                logger.exception(e)
+
+    def on_conversations_swept(self, conversation_ids: List[str]):
+        # the other workers cache the conversations too
+        self.replies.put(('invalidate', self.worker_index, conversation_ids))
+
+    def invalidate_conversations(self, conversation_ids: List[str]):
+        """Drop conversations swept by another worker from the cache of this one."""
+        if not self.openai_module or not self.openai_module.done():
+            return
+        g_conversations = self.openai_module.result().g_conversations
+        for conversation_id in conversation_ids:
+            g_conversations.remove(conversation_id)
+
+    async def handle_group_batch(self, conversation_id: str, messages: List[Tuple[str, str]]):
+        """Answer group messages merged by the process receiving them."""
+        with self.tracer.trace('group_batch', conversation_id=conversation_id, user_id=messages[-1][0],
+                messages=len(messages), worker=self.worker_index):
+            batch = [GroupMessage(user_id, text) for user_id, text in messages]
+            batch[-1].trace = tracing.hold()
+            await self.submit_group_messages(conversation_id, batch)
+
+async def start_worker(config_file, worker_index, inbox, replies):
+    worker = WorkerBot(config_file, worker_index, inbox, replies)
+    await worker.start_metrics()
+    await worker.init_bots()
+    replies.put(('ready', worker_index))
+    try:
+        await worker.run()
+    finally:
+        # answers still being generated are given up as in a single process
+        tasks = list(worker.admission.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await worker.close()
+
+def run_worker(config_file, worker_index, inbox, replies):
+    # stopped and reloaded by the process receiving the messages
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    logger.info('++++++worker %s pid: %s', worker_index, os.getpid())
+    asyncio.run(start_worker(config_file, worker_index, inbox, replies))
 
 bot: Optional[MixinBot]  = None
 
@@ -420,8 +925,20 @@ def run():
     if len(sys.argv) < 2:
         if platform.system() == 'Windows':
             print("usage: python -m chatgpt_mixin config_file")
+            print("       python -m chatgpt_mixin compact [config_file]")
+            print("       python -m chatgpt_mixin tokenizer [config_file]")
         else:
             print("usage: python3 -m chatgpt_mixin config_file")
+            print("       python3 -m chatgpt_mixin compact [config_file]")
+            print("       python3 -m chatgpt_mixin tokenizer [config_file]")
+        return
+    if sys.argv[1] == 'compact':
+        from .retention import compact
+        compact(sys.argv[2] if len(sys.argv) > 2 else None)
+        return
+    if sys.argv[1] == 'tokenizer':
+        from .tokenizer import prepare_cache
+        prepare_cache(sys.argv[2] if len(sys.argv) > 2 else None)
         return
     asyncio.run(start(sys.argv[1]))
 
@@ -0,0 +1,191 @@
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Deque, Dict, Optional
+
+from pymixin import log
+
+from .rate_limiter import TokenBucket
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+SendText = Callable[[str, str, str], Awaitable]
+
+@dataclass
+class OutgoingText:
+    user_id: str
+    text: str
+    # False keeps the text in a message of its own
+    coalesce: bool = True
+    # pushed texts joined into this message
+    texts: int = 1
+
+@dataclass
+class UserTexts:
+    """The texts to one user of a conversation since the last flush for the user."""
+    # pushed and not sent yet
+    pending: int = 0
+    sent: asyncio.Event = field(default_factory=asyncio.Event)
+    error: Optional[Exception] = None
+    # seconds spent in send calls
+    send_time: float = 0.0
+
+@dataclass
+class ConversationOutbox:
+    items: Deque[OutgoingText] = field(default_factory=deque)
+    bucket: Optional[TokenBucket] = None
+    task: Optional[asyncio.Task] = None
+    idle: asyncio.Event = field(default_factory=asyncio.Event)
+    # the members of a group share the outbox of the group
+    users: Dict[str, UserTexts] = field(default_factory=dict)
+
+class Outbox:
+    """Per conversation queues of texts sent to Mixin by background tasks.
+
+    `push` never waits, so upstream streams are read at their own pace. The sender
+    task of a conversation sends the queued texts in order, joining consecutive
+    texts to the same user into one message of at most `max_message_length`
+    characters, and waits for the global and the per conversation rate limits.
+    Joined texts keep the whitespace between them, messages are trimmed.
+    """
+
+    def __init__(self, send: SendText, messages_per_second: float = 20.0, conversation_messages_per_second: float = 1.0,
+                burst: int = 3, max_message_length: int = 4000, max_attempts: int = 3):
+        self.send = send
+        self.bucket = TokenBucket(messages_per_second, messages_per_second)
+        self.conversation_messages_per_second = conversation_messages_per_second
+        self.burst = burst
+        self.max_message_length = max_message_length
+        self.max_attempts = max_attempts
+        self.outboxes: Dict[str, ConversationOutbox] = {}
+        self.messages = 0
+        self.texts = 0
+        self.send_time = 0.0
+
+    def push(self, conversation_id: str, user_id: str, text: str, coalesce: bool = True):
+        if not text:
+            return
+        outbox = self.outboxes.get(conversation_id)
+        if not outbox:
+            outbox = ConversationOutbox(bucket=TokenBucket(self.burst, self.conversation_messages_per_second))
+            self.outboxes[conversation_id] = outbox
+        outbox.items.append(OutgoingText(user_id, text, coalesce))
+        outbox.idle.clear()
+        user = outbox.users.get(user_id)
+        if not user:
+            user = UserTexts()
+            outbox.users[user_id] = user
+        user.pending += 1
+        user.sent.clear()
+        self.texts += 1
+        if not outbox.task:
+            outbox.task = asyncio.create_task(self.run(conversation_id, outbox))
+
+    async def flush(self, conversation_id: str, user_id: str) -> float:
+        """Wait until the texts to the user in the conversation are sent, return the seconds spent sending them.
+
+        Raises the last error sending them since the previous flush, texts to other
+        users of the conversation are not waited for.
+        """
+        outbox = self.outboxes.get(conversation_id)
+        if not outbox:
+            return 0.0
+        user = outbox.users.get(user_id)
+        if not user:
+            return 0.0
+        await user.sent.wait()
+        send_time, error = user.send_time, user.error
+        user.send_time = 0.0
+        user.error = None
+        if not user.pending and outbox.users.get(user_id) is user:
+            del outbox.users[user_id]
+        if not outbox.task and not outbox.items and not outbox.users and self.outboxes.get(conversation_id) is outbox:
+            del self.outboxes[conversation_id]
+        if error:
+            raise error
+        return send_time
+
+    def next_message(self, outbox: ConversationOutbox) -> OutgoingText:
+        item = outbox.items.popleft()
+        if not item.coalesce:
+            return item
+        texts = [item.text]
+        length = len(item.text)
+        while outbox.items:
+            next_item = outbox.items[0]
+            if not next_item.coalesce or next_item.user_id != item.user_id or length + len(next_item.text) > self.max_message_length:
+                break
+            outbox.items.popleft()
+            texts.append(next_item.text)
+            length += len(next_item.text)
+        return OutgoingText(item.user_id, ''.join(texts).strip(), texts=len(texts))
+
+    async def run(self, conversation_id: str, outbox: ConversationOutbox):
+        try:
+            while outbox.items:
+                # texts pushed while waiting for the rate limits are joined into the next message
+                while True:
+                    wait = max(self.bucket.wait_time(1), outbox.bucket.wait_time(1))
+                    if wait <= 0:
+                        break
+                    await asyncio.sleep(wait)
+                self.bucket.take(1)
+                outbox.bucket.take(1)
+                message = self.next_message(outbox)
+                user = outbox.users[message.user_id]
+                if not message.text:
+                    # whitespace between texts sent apart
+                    self.sent(user, message)
+                    continue
+                start = time.monotonic()
+                try:
+                    await self.send_with_retry(conversation_id, message)
+                except Exception as e:
+                    logger.exception(e)
+                    user.error = e
+                finally:
+                    send_time = time.monotonic() - start
+                    user.send_time += send_time
+                    self.send_time += send_time
+                    self.sent(user, message)
+                self.messages += 1
+        finally:
+            outbox.task = None
+            outbox.idle.set()
+            # flushes waiting for texts that are given up on return
+            for user in outbox.users.values():
+                user.sent.set()
+
+    def sent(self, user: UserTexts, message: OutgoingText):
+        user.pending -= message.texts
+        if not user.pending:
+            user.sent.set()
+
+    async def send_with_retry(self, conversation_id: str, message: OutgoingText):
+        for attempt in range(self.max_attempts):
+            try:
+                await self.send(conversation_id, message.user_id, message.text)
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if attempt + 1 >= self.max_attempts:
+                    raise
+                logger.info("+++send to %s failed, retrying: %s", conversation_id, e)
+                await asyncio.sleep(0.5 * 2 ** attempt)
+
+    async def close(self):
+        """Send everything still queued, send errors are logged by the sender tasks."""
+        for outbox in list(self.outboxes.values()):
+            await outbox.idle.wait()
+
+    def stats(self):
+        return {
+            'conversations': len(self.outboxes),
+            'queued': sum(len(outbox.items) for outbox in self.outboxes.values()),
+            'texts': self.texts,
+            'messages': self.messages,
+            'send_time': self.send_time,
+        }
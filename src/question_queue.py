@@ -0,0 +1,241 @@
+import asyncio
+import random
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from pymixin import log
+
+from .conversation_store import SqliteStore
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+default_path = '.db/questions.sqlite3'
+
+@dataclass
+class Question:
+    id: int
+    conversation_id: str
+    user_id: str
+    data: str
+    attempts: int = 0
+    next_attempt_at: float = 0.0
+
+question_migrations = [
+    '''
+    CREATE TABLE questions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        conversation_id TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        data TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL,
+        created_at REAL NOT NULL,
+        dead INTEGER NOT NULL DEFAULT 0,
+        last_error TEXT
+    );
+    CREATE INDEX questions_user_id ON questions (dead, user_id, id);
+    ''',
+]
+
+class QuestionStore(SqliteStore):
+    """Questions waiting for an answer, dead letters are kept with `dead` set."""
+    migrations = question_migrations
+    thread_name = 'question-store'
+
+    async def put(self, conversation_id: str, user_id: str, data: str) -> int:
+        return await self.run(self._put, conversation_id, user_id, data)
+
+    def _put(self, conversation_id: str, user_id: str, data: str) -> int:
+        self.flush_writes()
+        now = time.time()
+        cursor = self.db.execute(
+            'INSERT INTO questions (conversation_id, user_id, data, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)',
+            (conversation_id, user_id, data, now, now)
+        )
+        return cursor.lastrowid
+
+    async def heads(self) -> List[Question]:
+        """Return the oldest pending question of every user."""
+        return await self.run(self._heads)
+
+    def _heads(self) -> List[Question]:
+        rows = self.db.execute(
+            'SELECT id, conversation_id, user_id, data, attempts, next_attempt_at FROM questions q '
+            'WHERE dead = 0 AND id = (SELECT MIN(id) FROM questions WHERE dead = 0 AND user_id = q.user_id)'
+        ).fetchall()
+        return [Question(*row) for row in rows]
+
+    async def pending_users(self) -> Set[str]:
+        return await self.run(self._pending_users)
+
+    def _pending_users(self) -> Set[str]:
+        return {row[0] for row in self.db.execute('SELECT DISTINCT user_id FROM questions WHERE dead = 0')}
+
+    async def has_pending(self, user_id: str) -> bool:
+        return await self.run(self._has_pending, user_id)
+
+    def _has_pending(self, user_id: str) -> bool:
+        return self.db.execute('SELECT 1 FROM questions WHERE dead = 0 AND user_id = ? LIMIT 1', (user_id,)).fetchone() is not None
+
+    async def remove(self, question_id: int):
+        await self.write([('DELETE FROM questions WHERE id = ?', (question_id,))])
+
+    async def retry(self, question_id: int, attempts: int, next_attempt_at: float, error: str):
+        await self.write([
+            ('UPDATE questions SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?',
+                (attempts, next_attempt_at, error, question_id)),
+        ])
+
+    async def kill(self, question_id: int, attempts: int, error: str):
+        await self.write([
+            ('UPDATE questions SET attempts = ?, dead = 1, last_error = ? WHERE id = ?', (attempts, error, question_id)),
+        ])
+
+    async def count(self) -> Dict[str, int]:
+        return await self.run(self._count)
+
+    def _count(self) -> Dict[str, int]:
+        pending, dead = self.db.execute(
+            'SELECT COALESCE(SUM(dead = 0), 0), COALESCE(SUM(dead = 1), 0) FROM questions'
+        ).fetchone()
+        return {'pending': pending, 'dead': dead}
+
+# returns False if no bot was available, failed answers raise
+QuestionHandler = Callable[[Question], Awaitable[bool]]
+DeadLetterHandler = Callable[[Question, Exception], Awaitable[None]]
+
+class QuestionQueue:
+    """Persistent queue of questions that couldn't be answered yet.
+
+    Questions of a user are answered in order, up to `concurrency` users at a
+    time. A failed answer is retried after an exponential backoff and moved to
+    the dead letters after `max_attempts`. Questions waiting for a bot are tried
+    again on `notify`, which is called whenever a bot may have become available.
+    """
+
+    def __init__(self, path: str = default_path, max_attempts: int = 5, backoff: float = 10.0,
+                max_backoff: float = 600.0, concurrency: int = 4, poll_interval: float = 30.0):
+        self.store = QuestionStore(path)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.handler: Optional[QuestionHandler] = None
+        self.on_dead: Optional[DeadLetterHandler] = None
+        self.wake = asyncio.Event()
+        self.pending_users: Set[str] = set()
+        self.workers: Dict[str, asyncio.Task] = {}
+        self.task: Optional[asyncio.Task] = None
+        self.dead_letters = 0
+        # set in worker processes to the users routed to the worker
+        self.owns: Optional[Callable[[str], bool]] = None
+
+    @classmethod
+    def from_config(cls, config) -> 'QuestionQueue':
+        if not config:
+            return cls()
+        return cls(**config)
+
+    async def open(self, handler: QuestionHandler, on_dead: Optional[DeadLetterHandler] = None):
+        self.handler = handler
+        self.on_dead = on_dead
+        await self.store.open()
+        self.pending_users = {user_id for user_id in await self.store.pending_users() if self.is_owned(user_id)}
+        if self.pending_users:
+            logger.info("+++%s users have unanswered questions", len(self.pending_users))
+        self.task = asyncio.create_task(self.run())
+
+    async def close(self):
+        tasks = list(self.workers.values())
+        if self.task:
+            tasks.append(self.task)
+        for task in tasks:
+            task.cancel()
+        # cancelled questions stay in the store and are retried after a restart
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.task = None
+        await self.store.close()
+
+    def is_owned(self, user_id: str) -> bool:
+        return not self.owns or self.owns(user_id)
+
+    def is_pending(self, user_id: str) -> bool:
+        return user_id in self.pending_users
+
+    async def put(self, conversation_id: str, user_id: str, data: str):
+        await self.store.put(conversation_id, user_id, data)
+        self.pending_users.add(user_id)
+        self.notify()
+
+    def notify(self):
+        self.wake.set()
+
+    def backoff_delay(self, attempts: int) -> float:
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+        return random.uniform(delay / 2, delay)
+
+    async def run(self):
+        while True:
+            self.wake.clear()
+            timeout = self.poll_interval
+            try:
+                now = time.time()
+                heads = sorted(await self.store.heads(), key=lambda question: question.next_attempt_at)
+                for question in heads:
+                    if question.user_id in self.workers or not self.is_owned(question.user_id):
+                        continue
+                    if question.next_attempt_at > now:
+                        timeout = min(timeout, question.next_attempt_at - now)
+                        continue
+                    if len(self.workers) >= self.concurrency:
+                        break
+                    self.workers[question.user_id] = asyncio.create_task(self.work(question))
+            except Exception as e:
+                logger.exception(e)
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def work(self, question: Question):
+        done = False
+        try:
+            logger.info("++++++++handle question: %s", question.data)
+            if not await self.handler(question):
+                # no bot, tried again once one may be available
+                return
+            await self.store.remove(question.id)
+            if not await self.store.has_pending(question.user_id):
+                self.pending_users.discard(question.user_id)
+            done = True
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self.failed(question, e)
+            done = True
+        finally:
+            self.workers.pop(question.user_id, None)
+        if done:
+            # schedule the next question of the user
+            self.notify()
+
+    async def failed(self, question: Question, error: Exception):
+        attempts = question.attempts + 1
+        if attempts < self.max_attempts:
+            delay = self.backoff_delay(attempts)
+            logger.info("+++question %s failed %s times, retry in %.1f seconds: %s", question.id, attempts, delay, error)
+            await self.store.retry(question.id, attempts, time.time() + delay, str(error))
+            return
+        logger.warning("+++question %s failed %s times, giving up: %s", question.id, attempts, error)
+        await self.store.kill(question.id, attempts, str(error))
+        self.dead_letters += 1
+        if not await self.store.has_pending(question.user_id):
+            self.pending_users.discard(question.user_id)
+        if self.on_dead:
+            try:
+                await self.on_dead(question, error)
+            except Exception as e:
+                logger.exception(e)
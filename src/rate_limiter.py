@@ -0,0 +1,146 @@
+import asyncio
+import re
+import time
+from typing import Dict, Mapping, Optional
+
+from pymixin import log
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+# budgets used until the api reports the real limits of a key
+default_requests_per_minute = 3500
+default_tokens_per_minute = 90000
+
+class ApiRateLimitError(Exception):
+    pass
+
+def parse_reset(value: str) -> float:
+    """Parse durations like `1s`, `6m0s` or `20ms` of the x-ratelimit-reset-* headers to seconds."""
+    seconds = 0.0
+    for amount, unit in re.findall(r'([\d.]+)(ms|h|m|s)', value):
+        seconds += float(amount) * {'ms': 0.001, 's': 1.0, 'm': 60.0, 'h': 3600.0}[unit]
+    return seconds
+
+class TokenBucket:
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        self.refill()
+        # a request larger than the bucket only waits for a full bucket
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        if self.refill_per_second <= 0:
+            return float('inf')
+        return (amount - self.tokens) / self.refill_per_second
+
+    def take(self, amount: float):
+        self.refill()
+        self.tokens -= amount
+
+    def give(self, amount: float):
+        self.refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def update(self, limit: float, remaining: float, reset_seconds: float):
+        self.refill()
+        self.capacity = limit
+        self.tokens = remaining
+        if reset_seconds > 0:
+            self.refill_per_second = max(limit - remaining, 1.0) / reset_seconds
+        else:
+            self.refill_per_second = limit / 60.0
+
+class ApiKeyRateLimiter:
+    """Request and token budgets of one api key, shared by every bot using the key."""
+
+    def __init__(self, requests_per_minute: int = default_requests_per_minute, tokens_per_minute: int = default_tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60.0)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60.0)
+        self.blocked_until = 0.0
+        # the budgets are set by the response headers once the api reported them
+        self.reported = False
+
+    def set_default_limits(self, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None):
+        """Change the budgets used until the api reports the real limits."""
+        if self.reported:
+            return
+        for bucket, limit in ((self.requests, requests_per_minute or default_requests_per_minute),
+                              (self.tokens, tokens_per_minute or default_tokens_per_minute)):
+            bucket.refill()
+            bucket.capacity = limit
+            bucket.refill_per_second = limit / 60.0
+            bucket.tokens = min(bucket.tokens, limit)
+
+    def wait_time(self, tokens: int) -> float:
+        return max(
+            self.blocked_until - time.monotonic(),
+            self.requests.wait_time(1),
+            self.tokens.wait_time(tokens)
+        )
+
+    def available(self, tokens: int = 1) -> bool:
+        return self.wait_time(tokens) <= 0
+
+    async def reserve(self, tokens: int, max_wait: float):
+        """Reserve one request and `tokens` tokens, waiting at most `max_wait` seconds for the budget."""
+        while True:
+            wait = self.wait_time(tokens)
+            if wait <= 0:
+                break
+            if wait > max_wait:
+                raise ApiRateLimitError(f"rate limit of api key reached, retry after {wait:.2f} seconds")
+            max_wait -= wait
+            await asyncio.sleep(wait)
+        self.requests.take(1)
+        self.tokens.take(tokens)
+
+    def reconcile(self, reserved: int, used: int):
+        """Correct the token budget once the real usage of a reserved request is known."""
+        if used < reserved:
+            self.tokens.give(reserved - used)
+        else:
+            self.tokens.take(used - reserved)
+
+    def update_from_headers(self, headers: Mapping[str, str]):
+        for name, bucket in (('requests', self.requests), ('tokens', self.tokens)):
+            try:
+                limit = float(headers[f'x-ratelimit-limit-{name}'])
+                remaining = float(headers[f'x-ratelimit-remaining-{name}'])
+            except (KeyError, ValueError):
+                continue
+            reset = parse_reset(headers.get(f'x-ratelimit-reset-{name}', ''))
+            bucket.update(limit, remaining, reset)
+            self.reported = True
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def on_rate_limited(self, headers: Mapping[str, str]):
+        self.update_from_headers(headers)
+        try:
+            retry_after = float(headers['retry-after'])
+        except (KeyError, ValueError):
+            retry_after = max(self.requests.wait_time(1), self.tokens.wait_time(1), 1.0)
+        logger.info("+++api key rate limited for %.2f seconds", retry_after)
+        self.block(retry_after)
+
+g_rate_limiters: Dict[str, ApiKeyRateLimiter] = {}
+
+def get_rate_limiter(api_key: str, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None) -> ApiKeyRateLimiter:
+    try:
+        return g_rate_limiters[api_key]
+    except KeyError:
+        limiter = ApiKeyRateLimiter(requests_per_minute or default_requests_per_minute, tokens_per_minute or default_tokens_per_minute)
+        g_rate_limiters[api_key] = limiter
+        return limiter
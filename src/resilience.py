@@ -0,0 +1,148 @@
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Deque, List, Optional, Tuple
+
+import httpx
+from pymixin import log
+
+from .rate_limiter import ApiRateLimitError
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+StreamFactory = Callable[[], AsyncIterator[Any]]
+
+def is_transient(e: BaseException) -> bool:
+    """Timeouts, including the first byte timeout, connection errors, 429 and 5xx responses are worth retrying with another key."""
+    # imported by the api backend already, not at startup
+    from openai import APIConnectionError, APIStatusError, APITimeoutError
+    if isinstance(e, (asyncio.TimeoutError, APITimeoutError, APIConnectionError, ApiRateLimitError, httpx.TimeoutException, httpx.NetworkError)):
+        return True
+    if isinstance(e, APIStatusError):
+        return e.status_code == 429 or e.status_code >= 500
+    return False
+
+class LatencyTracker:
+    """Keeps recent time-to-first-token samples to derive the hedging deadline."""
+
+    def __init__(self, size: int = 200, min_samples: int = 20, default_deadline: float = 10.0):
+        self.samples: Deque[float] = deque(maxlen=size)
+        self.min_samples = min_samples
+        self.default_deadline = default_deadline
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if len(self.samples) < self.min_samples:
+            return None
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def deadline(self) -> float:
+        p95 = self.quantile(0.95)
+        if p95 is None:
+            return self.default_deadline
+        return p95
+
+class RetryPolicy:
+    """Retries streams that fail before their first item and optionally hedges slow ones.
+
+    `stream` takes the stream factories of the candidate api keys, the preferred one
+    first. A stream that fails with a transient error before yielding anything is
+    retried on the next candidate after a jittered exponential backoff. With `hedge`
+    set, a second candidate is started when the first item hasn't arrived within the
+    p95 time to first token, the slower one is cancelled.
+    """
+
+    def __init__(self, max_attempts: int = 3, backoff: float = 0.5, max_backoff: float = 4.0, hedge: bool = False):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge = hedge
+        self.latency = LatencyTracker()
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    @classmethod
+    def from_config(cls, config) -> 'RetryPolicy':
+        if not config:
+            return cls()
+        return cls(**config)
+
+    def backoff_delay(self, attempt: int) -> float:
+        # full jitter
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    async def stream(self, factories: List[StreamFactory]) -> AsyncIterator[Any]:
+        attempt = 0
+        while True:
+            try:
+                first, iterator = await self.first_item(factories, attempt)
+            except Exception as e:
+                if not is_transient(e) or attempt + 1 >= self.max_attempts:
+                    raise
+                delay = self.backoff_delay(attempt)
+                logger.info("+++retry stream in %.2f seconds after: %s", delay, e)
+                self.retries += 1
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            break
+        if iterator is None:
+            return
+        try:
+            yield first
+            # items already sent can't be taken back, later errors are raised
+            async for item in iterator:
+                yield item
+        finally:
+            await iterator.aclose()
+
+    async def first_item(self, factories: List[StreamFactory], attempt: int) -> Tuple[Any, Optional[AsyncIterator[Any]]]:
+        start = time.monotonic()
+        primary = factories[attempt % len(factories)]()
+        primary_task = asyncio.create_task(anext_or_none(primary))
+        tasks = {primary_task: primary}
+        try:
+            if self.hedge and len(factories) > 1:
+                done, _ = await asyncio.wait({primary_task}, timeout=self.latency.deadline())
+                if not done:
+                    self.hedges += 1
+                    secondary = factories[(attempt + 1) % len(factories)]()
+                    tasks[asyncio.create_task(anext_or_none(secondary))] = secondary
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception():
+                        error = task.exception()
+                        continue
+                    self.latency.add(time.monotonic() - start)
+                    if task is not primary_task:
+                        self.hedge_wins += 1
+                    first, exhausted = task.result()
+                    iterator = tasks.pop(task)
+                    if exhausted:
+                        await iterator.aclose()
+                        return None, None
+                    return first, iterator
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+            # their errors are ignored, a cancellation of this task is raised
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for iterator in tasks.values():
+                await iterator.aclose()
+
+async def anext_or_none(iterator: AsyncIterator[Any]) -> Tuple[Any, bool]:
+    """Return the next item of `iterator` and whether it was already exhausted."""
+    try:
+        return await iterator.__anext__(), False
+    except StopAsyncIteration:
+        return None, True
@@ -0,0 +1,104 @@
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+from pymixin import log
+
+from .conversation_store import ConversationStore
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+whitespace_pattern = re.compile(r'\s+')
+trailing_punctuation = '?？!！.。~～ '
+
+def normalize_question(question: str) -> str:
+    question = whitespace_pattern.sub(' ', question.strip()).casefold()
+    return question.rstrip(trailing_punctuation)
+
+def response_key(model: str, role: str, question: str) -> str:
+    return hashlib.sha256('\0'.join((model, role, normalize_question(question))).encode()).hexdigest()
+
+class ResponseCache:
+    """Caches answers of questions asked without prior context.
+
+    Keys are built from the model, the role and the normalized question. Entries
+    live in an LRU map for `ttl` seconds and, if `disk` is set, in the
+    conversation database as a second tier.
+    """
+
+    def __init__(self, ttl: float = 3600.0, max_entries: int = 10000, disk: bool = False, disabled_roles: Iterable[str] = ()):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.disk = disk
+        self.disabled_roles = set(disabled_roles)
+        self.store: Optional[ConversationStore] = None
+        self.entries: 'OrderedDict[str, Tuple[float, str]]' = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_config(cls, config) -> Optional['ResponseCache']:
+        if not config or not config.get('enabled', True):
+            return None
+        return cls(
+            ttl=config.get('ttl', 3600.0),
+            max_entries=config.get('max_entries', 10000),
+            disk=config.get('disk', False),
+            disabled_roles=config.get('disabled_roles') or (),
+        )
+
+    def attach(self, store: ConversationStore):
+        if self.disk:
+            self.store = store
+
+    def enabled_for(self, role: str) -> bool:
+        return role not in self.disabled_roles
+
+    def key(self, model: str, role: str, question: str) -> str:
+        return response_key(model, role, question)
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.disk_hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.disk_hits) / total if total else 0.0,
+        }
+
+    async def get(self, key: str) -> Optional[str]:
+        try:
+            expiration, response = self.entries[key]
+            if expiration > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return response
+            del self.entries[key]
+        except KeyError:
+            pass
+        if self.store:
+            response = await self.store.get_response(key)
+            if response is not None:
+                self.disk_hits += 1
+                self.put_memory(key, response)
+                return response
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, response: str):
+        expiration = self.put_memory(key, response)
+        if self.store:
+            await self.store.put_response(key, response, expiration)
+
+    def put_memory(self, key: str, response: str) -> float:
+        expiration = time.time() + self.ttl
+        self.entries[key] = (expiration, response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return expiration
@@ -0,0 +1,194 @@
+import asyncio
+import dbm
+import glob
+import os
+import shelve
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+import yaml
+from pymixin import log
+
+from .conversation_cache import ConversationCache
+from .conversation_store import ConversationStore
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+default_store_path = '.db/conversations.sqlite3'
+
+@dataclass
+class RetentionPolicy:
+    # seconds a conversation is kept after its last message, 0 keeps them forever
+    max_age: float = 0.0
+    # messages kept of the current chain of a conversation, 0 keeps all of them
+    max_messages: int = 0
+    # unreachable messages younger than this are kept, answers may still be on the way
+    grace_period: float = 600.0
+    # conversations handled per sweep step and seconds between two sweeps
+    batch_size: int = 200
+    interval: float = 300.0
+    # seconds expired users of the browser backend are remembered, 0 remembers them forever
+    expired_user_ttl: float = 7 * 24 * 3600.0
+
+    @classmethod
+    def from_config(cls, config) -> Optional['RetentionPolicy']:
+        if not config or not config.get('enabled', True):
+            return None
+        return cls(**{key: value for key, value in config.items() if key != 'enabled'})
+
+class ConversationSweeper:
+    """Applies a `RetentionPolicy` to a conversation store in the background.
+
+    Every step handles `batch_size` conversations in one transaction on the store's
+    worker thread, other reads and writes are served in between steps.
+    """
+
+    def __init__(self, store: ConversationStore, policy: RetentionPolicy, cache: Optional[ConversationCache] = None,
+                on_swept: Optional[Callable[[List[str]], None]] = None):
+        self.store = store
+        self.policy = policy
+        self.cache = cache
+        # called with the conversations changed by a step, e.g. to update the caches of other processes
+        self.on_swept = on_swept
+        self.task: Optional[asyncio.Task] = None
+        self.expired_conversations = 0
+        self.deleted_messages = 0
+
+    def start(self):
+        if not self.task:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        while True:
+            try:
+                await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(e)
+            await asyncio.sleep(self.policy.interval)
+
+    async def sweep(self):
+        """Run one full pass over the store."""
+        start = time.time()
+        expired = 0
+        deleted = 0
+        if self.policy.max_age > 0:
+            while True:
+                conversation_ids = await self.store.delete_expired(start - self.policy.max_age, self.policy.batch_size)
+                self.invalidate(conversation_ids)
+                expired += len(conversation_ids)
+                if len(conversation_ids) < self.policy.batch_size:
+                    break
+        after: Optional[str] = ''
+        while after is not None:
+            after, count, conversation_ids = await self.store.collect_garbage(
+                after, self.policy.batch_size, self.policy.max_messages, start - self.policy.grace_period)
+            deleted += count
+            # cached chains may hold deleted messages or the old parent of the first kept one
+            self.invalidate(conversation_ids)
+        self.expired_conversations += expired
+        self.deleted_messages += deleted
+        if expired or deleted:
+            logger.info("+++swept %s conversations and %s messages in %.2f seconds", expired, deleted, time.time() - start)
+
+    def invalidate(self, conversation_ids: List[str]):
+        if not conversation_ids:
+            return
+        if self.cache:
+            for conversation_id in conversation_ids:
+                self.cache.remove(conversation_id)
+        if self.on_swept:
+            self.on_swept(conversation_ids)
+
+# files of a shelve, depending on the dbm module, gdbm uses the path itself
+shelve_suffixes = ('', '.db', '.dir', '.pag', '.dat', '.bak')
+
+def shelve_files(path: str) -> List[str]:
+    return [name for name in glob.glob(glob.escape(path) + '*') if name[len(path):] in shelve_suffixes]
+
+def file_size(path: str) -> int:
+    return sum(os.path.getsize(name) for name in glob.glob(glob.escape(path) + '*') if os.path.isfile(name))
+
+def prune_expired_users(path: str, ttl: float) -> int:
+    """Rewrite an expired user shelve of the browser backend without users expired for `ttl` seconds."""
+    users: Dict[str, Any] = {}
+    with shelve.open(path, flag='r') as db:
+        for key in db.keys():
+            # a record which can't be loaded aborts before anything is removed
+            user = db[key]
+            if ttl <= 0 or user.expiration > time.time() - ttl:
+                users[key] = user
+    # dbm files never shrink, the kept users are written to a new shelve which then replaces
+    # the old one, a failure on the way leaves the old shelve as it was
+    new_path = path + '.compact'
+    for name in shelve_files(new_path):
+        os.remove(name)
+    with shelve.open(new_path, flag='n') as db:
+        db.update(users)
+    suffixes = [name[len(new_path):] for name in shelve_files(new_path)]
+    for suffix in suffixes:
+        os.replace(new_path + suffix, path + suffix)
+    for name in shelve_files(path):
+        if name[len(path):] not in suffixes:
+            os.remove(name)
+    return len(users)
+
+async def compact_store(path: str, policy: RetentionPolicy):
+    store = ConversationStore(path)
+    await store.open()
+    try:
+        await ConversationSweeper(store, policy).sweep()
+        await store.vacuum()
+    finally:
+        await store.close()
+
+def compact(config_file: Optional[str] = None, path: str = default_store_path):
+    """Apply the retention policy to the databases in `.db` and rewrite them to reclaim space."""
+    policy = RetentionPolicy()
+    if config_file:
+        with open(config_file) as f:
+            config = yaml.safe_load(f)
+        policy = RetentionPolicy.from_config(config.get('retention')) or RetentionPolicy()
+    # compaction runs while the bot is stopped, no answers are on the way
+    policy.grace_period = 0.0
+
+    stats: List[Any] = []
+    if os.path.exists(path):
+        before = file_size(path)
+        asyncio.run(compact_store(path, policy))
+        stats.append((path, before, file_size(path)))
+
+    # the expired users of an account are kept in `{user}-2`, its users in `{user}-1`
+    shelve_paths = set()
+    db_dir = os.path.dirname(path) or '.'
+    for name in glob.glob(os.path.join(db_dir, '*-2')) + glob.glob(os.path.join(db_dir, '*-2.*')):
+        suffix = os.path.splitext(name)[1]
+        shelve_path = name[:-len(suffix)] if suffix and suffix in shelve_suffixes else name
+        if shelve_path.endswith('-2') and dbm.whichdb(shelve_path):
+            shelve_paths.add(shelve_path)
+    for shelve_path in sorted(shelve_paths):
+        before = file_size(shelve_path)
+        try:
+            count = prune_expired_users(shelve_path, policy.expired_user_ttl)
+        except Exception as e:
+            print(f"{shelve_path}: {e}")
+            continue
+        stats.append((f'{shelve_path} ({count} users kept)', before, file_size(shelve_path)))
+
+    reclaimed = 0
+    for name, before, after in stats:
+        print(f"{name}: {before} -> {after} bytes")
+        reclaimed += before - after
+    print(f"reclaimed {reclaimed} bytes")
@@ -0,0 +1,205 @@
+import functools
+import itertools
+import random
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from pymixin import log
+
+from . import metrics
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+# time to first token assumed for bots without samples yet
+default_ttft = 2.0
+# weight of the newest sample in the moving averages
+default_alpha = 0.2
+# seconds a user stays with the sticky bot that answered them last
+default_affinity_ttl = 24 * 3600.0
+default_max_affinities = 100000
+# a sticky bot keeps its users while its expected wait is at most this many times the best one
+default_affinity_slack = 2.0
+
+begin_marker = '[BEGIN]'
+
+@dataclass
+class BotStats:
+    in_flight: int = 0
+    # exponentially weighted moving averages
+    ttft: float = default_ttft
+    error_rate: float = 0.0
+    requests: int = 0
+    errors: int = 0
+
+class BotScheduler:
+    """Chooses the bot answering a message.
+
+    Each bot is scored by its expected wait, the EWMA time to first token scaled
+    by its queue length relative to its concurrency and by its error rate. Two
+    available bots drawn at random, weighted by concurrency, are compared and the
+    better one wins, which spreads load like a least-loaded pick without scanning
+    all bots. Users stay with a bot only if the bot is `sticky`, i.e. it keeps the
+    conversation itself, and isn't overloaded compared to the others. Users listed
+    in the persisted `users` of a sticky bot, like a browser account, always go back
+    to it while it is available, they are kept in memory from when the bot is added
+    and updated by its `on_users_changed` calls.
+    """
+
+    def __init__(self, alpha: float = default_alpha, affinity_ttl: float = default_affinity_ttl,
+                max_affinities: int = default_max_affinities, affinity_slack: float = default_affinity_slack):
+        self.alpha = alpha
+        self.affinity_slack = affinity_slack
+        self.affinity_ttl = affinity_ttl
+        self.max_affinities = max_affinities
+        self.bots: List[Any] = []
+        self.cum_weights: List[int] = []
+        self.stats: Dict[int, BotStats] = {}
+        self.affinities: 'OrderedDict[str, Tuple[Any, float]]' = OrderedDict()
+        # the sticky bot whose `users` hold the conversation of a user
+        self.owners: Dict[str, Any] = {}
+
+    def add(self, bot: Any):
+        self.bots.append(bot)
+        self.stats[id(bot)] = BotStats()
+        self.update_weights()
+        if getattr(bot, 'sticky', False):
+            for user_id in getattr(bot, 'users', ()):
+                self.owners.setdefault(user_id, bot)
+            if hasattr(bot, 'on_users_changed'):
+                bot.on_users_changed = functools.partial(self.set_owner, bot)
+
+    def set_owner(self, bot: Any, user_id: str, holds: bool):
+        if holds:
+            self.owners[user_id] = bot
+        elif self.owners.get(user_id) is bot:
+            del self.owners[user_id]
+
+    def remove(self, bot: Any):
+        self.drain(bot)
+        self.forget(bot)
+
+    def drain(self, bot: Any) -> BotStats:
+        """Stop choosing `bot`, its stats keep counting the answers in flight until it is forgotten."""
+        self.bots.remove(bot)
+        self.update_weights()
+        for user_id in [user_id for user_id, (sticky_bot, _) in self.affinities.items() if sticky_bot is bot]:
+            del self.affinities[user_id]
+        for user_id in [user_id for user_id, owner in self.owners.items() if owner is bot]:
+            del self.owners[user_id]
+        if getattr(bot, 'on_users_changed', None):
+            bot.on_users_changed = None
+        return self.stats[id(bot)]
+
+    def forget(self, bot: Any):
+        self.stats.pop(id(bot), None)
+
+    def update_weights(self):
+        self.cum_weights = list(itertools.accumulate(getattr(bot, 'max_concurrency', 1) for bot in self.bots))
+
+    def get_stats(self, bot: Any) -> BotStats:
+        return self.stats[id(bot)]
+
+    def score(self, bot: Any) -> float:
+        stats = self.stats[id(bot)]
+        concurrency = getattr(bot, 'max_concurrency', 1)
+        return stats.ttft * (1.0 + stats.in_flight / concurrency) / (1.0 - min(stats.error_rate, 0.9))
+
+    def choose(self, user_id: str) -> Optional[Any]:
+        bot = self.owner(user_id)
+        if bot:
+            return bot
+        sticky_bot = self.sticky_bot(user_id)
+        bot = self.pick_two()
+        if not bot:
+            # most bots are unavailable, fall back to a full scan
+            candidates = [bot for bot in self.bots if bot.available]
+            if not candidates:
+                return None
+            bot = min(candidates, key=self.score)
+        # the context kept by a sticky bot is given up only if it is much slower
+        if sticky_bot and self.score(sticky_bot) <= self.affinity_slack * self.score(bot):
+            bot = sticky_bot
+        if getattr(bot, 'sticky', False):
+            self.affinities[user_id] = (bot, time.monotonic() + self.affinity_ttl)
+            self.affinities.move_to_end(user_id)
+            while len(self.affinities) > self.max_affinities:
+                self.affinities.popitem(last=False)
+        return bot
+
+    def owner(self, user_id: str) -> Optional[Any]:
+        """The available sticky bot whose `users` hold the conversation of the user."""
+        bot = self.owners.get(user_id)
+        if bot and bot.available:
+            return bot
+        return None
+
+    def sticky_bot(self, user_id: str) -> Optional[Any]:
+        try:
+            bot, expiration = self.affinities[user_id]
+        except KeyError:
+            return None
+        if expiration < time.monotonic():
+            del self.affinities[user_id]
+            return None
+        if not bot.available:
+            return None
+        return bot
+
+    def pick_two(self, tries: int = 4) -> Optional[Any]:
+        """Return the better of two random available bots, None if no available bot was drawn."""
+        if len(self.bots) <= 2:
+            candidates = [bot for bot in self.bots if bot.available]
+        else:
+            candidates = []
+            for _ in range(tries):
+                # draws are weighted by concurrency, a single slot bot is rarely compared to itself
+                bot = random.choices(self.bots, cum_weights=self.cum_weights)[0]
+                if bot.available and bot not in candidates:
+                    candidates.append(bot)
+                    if len(candidates) == 2:
+                        break
+        if not candidates:
+            return None
+        return min(candidates, key=self.score)
+
+    def acquire(self, bot: Any):
+        stats = self.stats[id(bot)]
+        stats.in_flight += 1
+        stats.requests += 1
+
+    def release(self, bot: Any, ttft: Optional[float], error: bool):
+        stats = self.stats.get(id(bot))
+        if not stats:
+            return
+        stats.in_flight -= 1
+        if ttft is not None:
+            stats.ttft += self.alpha * (ttft - stats.ttft)
+        stats.error_rate += self.alpha * (float(error) - stats.error_rate)
+        if error:
+            stats.errors += 1
+
+    async def observe(self, bot: Any, replies: AsyncIterator[str]) -> AsyncIterator[str]:
+        """Pass through the replies of `bot` while recording its load, latency and errors."""
+        self.acquire(bot)
+        name = getattr(bot, 'name', '')
+        metrics.bot_requests.inc(name)
+        start = time.monotonic()
+        ttft = None
+        error = False
+        try:
+            async for reply in replies:
+                if ttft is None and reply.strip() != begin_marker:
+                    ttft = time.monotonic() - start
+                    metrics.bot_time_to_first_chunk.observe(ttft, name)
+                yield reply
+        except Exception:
+            error = True
+            metrics.bot_errors.inc(name)
+            raise
+        finally:
+            self.release(bot, ttft, error)
+            if not error:
+                metrics.bot_answer_seconds.observe(time.monotonic() - start, name)
@@ -0,0 +1,84 @@
+import asyncio
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from pymixin import log
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+class FlightDone:
+    pass
+
+class FlightCancelled(Exception):
+    """Raised to the subscribers of a flight cancelled before its stream ended, e.g. at shutdown."""
+
+class Flight:
+    def __init__(self):
+        self.items: List[Any] = []
+        self.subscribers: List[asyncio.Queue] = []
+        self.task: Optional[asyncio.Task] = None
+
+    def publish(self, item: Any):
+        self.items.append(item)
+        for queue in self.subscribers:
+            queue.put_nowait(item)
+
+class SingleFlight:
+    """Coalesces concurrent identical streams.
+
+    The first caller of `stream` with a key starts the upstream stream in a task,
+    later callers with the same key attach to it. Every subscriber receives all
+    items from the start, the upstream is cancelled when nobody listens anymore.
+    A cancelled upstream raises `FlightCancelled` to the subscribers left, its
+    items are not a complete stream.
+    """
+
+    def __init__(self):
+        self.flights: Dict[str, Flight] = {}
+        self.coalesced = 0
+
+    def in_flight(self, key: str) -> bool:
+        return key in self.flights
+
+    async def stream(self, key: str, factory: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        flight = self.flights.get(key)
+        if flight:
+            self.coalesced += 1
+        else:
+            flight = Flight()
+            self.flights[key] = flight
+            flight.task = asyncio.create_task(self.run(key, flight, factory))
+
+        queue: asyncio.Queue = asyncio.Queue()
+        for item in flight.items:
+            queue.put_nowait(item)
+        flight.subscribers.append(queue)
+        try:
+            while True:
+                item = await queue.get()
+                if isinstance(item, FlightDone):
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            flight.subscribers.remove(queue)
+            if not flight.subscribers and not flight.task.done():
+                # callers from now on start a fresh flight instead of attaching to the cancelled one
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+                flight.task.cancel()
+
+    async def run(self, key: str, flight: Flight, factory: Callable[[], AsyncIterator[Any]]):
+        try:
+            async for item in factory():
+                flight.publish(item)
+            flight.publish(FlightDone())
+        except asyncio.CancelledError:
+            flight.publish(FlightCancelled(f'the stream of {key} was cancelled'))
+        except Exception as e:
+            flight.publish(e)
+        finally:
+            # new callers start a fresh flight once this one is finished
+            if self.flights.get(key) is flight:
+                del self.flights[key]
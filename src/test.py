@@ -1,71 +1,982 @@
+import asyncio
+import base64
+import glob
+import json
+import logging
 import os
+import shelve
 import shutil
+import signal
+import sqlite3
+import threading
+import time
+import uuid
 from dataclasses import dataclass
-from typing import List
+from types import SimpleNamespace
+from typing import Dict, Optional
 
-import openai
+import httpx
 import pytest
+from pymixin import utils
 
-from chatgpt_openai import ChatGPTBot
+from chatgpt_mixin import chatgpt_openai, conversation_store, metrics
+from chatgpt_mixin.acks import AckBatcher
+from chatgpt_mixin.admission import AdmissionController
+from chatgpt_mixin.async_log import AsyncLogging
+from chatgpt_mixin.chatgpt_openai import ChatGPTBot
+from chatgpt_mixin.config_reload import backend_specs
+from chatgpt_mixin.conversation_cache import ConversationCache
+from chatgpt_mixin.conversation_store import ConversationStore, Message
+from chatgpt_mixin.flush_policy import FlushPolicy, StreamBuffer
+from chatgpt_mixin.group_debounce import GroupDebouncer, GroupMessage, merge_messages
+from chatgpt_mixin.http_pool import HttpPool
+from chatgpt_mixin.metrics import Registry
+from chatgpt_mixin.mixinbot import MixinBot, WorkerBot
+from chatgpt_mixin.outbox import Outbox
+from chatgpt_mixin.question_queue import QuestionQueue
+from chatgpt_mixin.rate_limiter import ApiKeyRateLimiter, ApiRateLimitError, parse_reset
+from chatgpt_mixin.resilience import RetryPolicy
+from chatgpt_mixin.response_cache import ResponseCache, response_key
+from chatgpt_mixin.retention import ConversationSweeper, RetentionPolicy, compact
+from chatgpt_mixin.scheduler import BotScheduler
+from chatgpt_mixin.single_flight import FlightCancelled, SingleFlight
+from chatgpt_mixin.tokenizer import Tokenizer, estimate_tokens
+from chatgpt_mixin.tracing import SpanExporter, Tracer, hold, span
+from chatgpt_mixin.web_search import SearchResult, StaticSearchProvider, WebSearch
+from chatgpt_mixin.workers import WorkerPool, shard_for
 
 file_dir = os.path.dirname(os.path.realpath(__file__))
 
-def test_save_message_id():
-    bot = ChatGPTBot('test')
-    bot.save_last_message_id('conversation_id', 'message_id')
-    assert bot.get_last_message_id('conversation_id') == 'message_id'
+def completion_response(text: str) -> httpx.Response:
+    return httpx.Response(200, json={
+        'id': 'chatcmpl', 'object': 'chat.completion', 'created': 0, 'model': 'gpt-3.5-turbo',
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': 10, 'completion_tokens': 10, 'total_tokens': 20},
+    })
 
-@pytest.mark.asyncio
-async def test_prompt():
+def stream_response(text: str, headers: Optional[Dict[str, str]] = None) -> httpx.Response:
+    body = ''
+    for word in text.split(' '):
+        delta = {'index': 0, 'delta': {'content': word + ' '}, 'finish_reason': None}
+        body += 'data: ' + json.dumps({'id': 'chatcmpl', 'object': 'chat.completion.chunk', 'created': 0,
+            'model': 'gpt-3.5-turbo', 'choices': [delta]}) + '\n\n'
+    body += 'data: [DONE]\n\n'
+    return httpx.Response(200, content=body.encode(), headers={'content-type': 'text/event-stream', **(headers or {})})
+
+def openai_bot(monkeypatch, handler, **kwargs) -> ChatGPTBot:
+    """An api bot answered by `handler`, with the conversations in a new database."""
     if os.path.exists(f'{file_dir}/.db'):
         # remove db
         shutil.rmtree(f'{file_dir}/.db')
-    @classmethod
-    async def acreate(cls, *args, **kwargs):
-        @dataclass
-        class Choice:
-            text: str
+    monkeypatch.setattr(chatgpt_openai, 'g_conversations', ConversationCache(ConversationStore(f'{file_dir}/.db/conversations.sqlite3')))
+    monkeypatch.setattr(chatgpt_openai, 'g_bots', [])
+    http_pool = HttpPool()
+    http_pool.clients[''] = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return ChatGPTBot(f'sk-{uuid.uuid4().hex}', base_url='http://openai.test/v1', http_pool=http_pool, **kwargs)
 
-        @dataclass
-        class Completion:
-            choices: List[Choice]
-        completion = Completion([Choice('test')])
-        return completion
+@pytest.mark.asyncio
+async def test_save_message_id(monkeypatch):
+    bot = openai_bot(monkeypatch, lambda request: completion_response('test'))
+    await bot.init()
+    message_id_1 = await bot.add_messsage('conversation_id', 'hello', 'hi')
+    message_id_2 = await bot.add_messsage('conversation_id', 'how are you', 'fine')
+    assert await bot.get_last_message_id('conversation_id') == message_id_2
+    message = await bot.get_parent_messsage('conversation_id', message_id_2)
+    assert message.parent_message_id == message_id_1
+    await bot.clear_last_message_id('conversation_id')
+    assert await bot.get_last_message_id('conversation_id') is None
+    await bot.close()
 
-    openai.Completion.acreate = acreate
+@pytest.mark.asyncio
+async def test_prompt(monkeypatch):
+    requests = []
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(json.loads(request.content))
+        return completion_response(f'reply {len(requests)}')
 
-    bot = ChatGPTBot('test')
+    bot = openai_bot(monkeypatch, handler, stream=False)
+    await bot.init()
+    replies = [reply async for reply in bot.send_message('conversation_id', 'hello')]
+    assert replies == ['[BEGIN]', 'reply 1']
+    message_id_1 = await bot.get_last_message_id('conversation_id')
 
-    reply = await bot.send_message('conversation_id', 'hello')
-    assert reply == 'test'
-    message_id_1 = bot.get_last_message_id('conversation_id')
+    replies = [reply async for reply in bot.send_message('conversation_id', 'hello again')]
+    assert replies == ['[BEGIN]', 'reply 2']
+    # the first turn is the context of the second
+    assert requests[1]['messages'] == [
+        {'role': 'user', 'content': 'hello'},
+        {'role': 'assistant', 'content': 'reply 1'},
+        {'role': 'system', 'content': 'You are a helpful assistant'},
+        {'role': 'user', 'content': 'hello again'},
+    ]
+    message = await bot.get_parent_messsage('conversation_id', await bot.get_last_message_id('conversation_id'))
+    assert message.parent_message_id == message_id_1
+    await bot.close()
 
-    reply = await bot.send_message('conversation_id', 'hello')
-    assert reply == 'test'
+@pytest.mark.asyncio
+async def test_prompt_2(monkeypatch):
+    requests = []
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(json.loads(request.content))
+        return stream_response('The cat sat on the mat. It was warm there.')
 
-    print(bot.get_last_message_id('conversation_id'))
-    parent_message_id = bot.get_last_message_id('conversation_id')
+    bot = openai_bot(monkeypatch, handler, flush_policy=FlushPolicy(first_chunk_delay=0, min_interval=0))
+    await bot.init()
+    replies = [reply async for reply in bot.send_message('conversation_id', 'write a poem about a cat')]
+    assert replies[0] == '[BEGIN]'
+    assert ''.join(replies[1:]) == 'The cat sat on the mat. It was warm there. '
 
+    replies = [reply async for reply in bot.send_message('conversation_id', 'make the poem rhyme')]
+    assert requests[1]['stream']
+    assert requests[1]['messages'][:2] == [
+        {'role': 'user', 'content': 'write a poem about a cat'},
+        {'role': 'assistant', 'content': 'The cat sat on the mat. It was warm there. '},
+    ]
+    await bot.close()
 
-    message = bot.get_parent_messsage('conversation_id', parent_message_id)
-    assert message_id_1 == message.parent_message_id
+@pytest.mark.asyncio
+async def test_summarize(monkeypatch):
+    requests = []
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(json.loads(request.content)['messages'])
+        return completion_response(f'summary {len(requests)}')
+
+    bot = openai_bot(monkeypatch, handler, summarize_threshold=20, summarize_keep_tokens=10)
+    await bot.init()
+    monkeypatch.setattr(chatgpt_openai, 'max_prompt_token', 35)
+    conversations = chatgpt_openai.g_conversations
+    message_ids = [None]
+    for i in range(8):
+        message_ids.append(f'm{i}')
+        await conversations.add_message('conversation_id', f'm{i}', Message(f'question {i}', message_ids[-2], f'answer {i}', 10))
 
-    message = bot.get_parent_messsage('conversation_id', message.parent_message_id)
-    print(message.parent_message_id)
+    # the 7 older turns don't fit into one prompt and are summarized 3 at a time on top of the last summary
+    await bot.summarize('conversation_id', 'm7')
+    assert [[message['content'] for message in messages if message['role'] == 'user'] for messages in requests] == [
+        ['question 0', 'question 1', 'question 2', chatgpt_openai.summary_prompt],
+        ['question 3', 'question 4', 'question 5', chatgpt_openai.summary_prompt],
+        ['question 6', chatgpt_openai.summary_prompt],
+    ]
+    assert requests[1][0] == {'role': 'system', 'content': chatgpt_openai.summary_prefix + 'summary 1'}
+    assert (await conversations.get_message('conversation_id', 'm6')).summary == 'summary 3'
 
+    # later turns are added to the stored summary
+    for i in range(8, 11):
+        await conversations.add_message('conversation_id', f'm{i}', Message(f'question {i}', f'm{i - 1}', f'answer {i}', 10))
+    await bot.summarize('conversation_id', 'm10')
+    assert requests[3][0] == {'role': 'system', 'content': chatgpt_openai.summary_prefix + 'summary 3'}
+    assert [message['content'] for message in requests[3][1:]] == ['question 7', 'answer 7', 'question 8', 'answer 8', 'question 9', 'answer 9', chatgpt_openai.summary_prompt]
+    prompt = await bot.generate_prompt('conversation_id', 'next')
+    assert prompt[0] == {'role': 'system', 'content': chatgpt_openai.summary_prefix + 'summary 4'}
+    await bot.close()
 
 @pytest.mark.asyncio
-async def test_prompt_2():
+async def test_conversation_store():
     if os.path.exists(f'{file_dir}/.db'):
         # remove db
         shutil.rmtree(f'{file_dir}/.db')
-    api_key = "sk-xxx"
-    bot = ChatGPTBot(api_key)
+    store = ConversationStore(f'{file_dir}/.db/conversations.sqlite3')
+    await store.open()
+
+    await store.add_message('conversation_id', 'message_id_1', Message('hello', None, 'hi'))
+    await store.add_message('conversation_id', 'message_id_2', Message('how are you', 'message_id_1', 'fine'))
+    assert await store.get_last_message_id('conversation_id') == 'message_id_2'
+
+    chain = await store.get_chain('conversation_id', 'message_id_2')
+    assert [message.message for message in chain] == ['how are you', 'hello']
+
+    await store.set_role('conversation_id', 'You are a poet')
+    assert await store.get_role('conversation_id') == 'You are a poet'
+    assert await store.get_last_message_id('conversation_id') is None
+    await store.close()
+
+@pytest.mark.asyncio
+async def test_conversation_store_migration():
+    if os.path.exists(f'{file_dir}/.db'):
+        shutil.rmtree(f'{file_dir}/.db')
+    os.makedirs(f'{file_dir}/.db')
+    path = f'{file_dir}/.db/conversations.sqlite3'
+    # a database of the first schema version, before token counts were kept
+    db = sqlite3.connect(path)
+    db.executescript(conversation_store.migrations[0] + 'PRAGMA user_version=1;')
+    db.execute("INSERT INTO messages VALUES ('c1', 'm1', NULL, 'hello there', 'hi, how can I help?', 0)")
+    db.execute("INSERT INTO conversations VALUES ('c1', 'You are a poet', 'm1', 0)")
+    db.commit()
+    db.close()
+
+    store = ConversationStore(path)
+    await store.open()
+    message = await store.get_message('c1', 'm1')
+    assert message.tokens == estimate_tokens('hello there hi, how can I help?') == 8
+    assert (await store.get_conversation('c1')).role_tokens == estimate_tokens('You are a poet') == 4
+    await store.add_message('c1', 'm2', Message('and now?', 'm1', 'now this', 5))
+    assert [message.tokens for message in await store.get_chain('c1', 'm2')] == [5, 8]
+    await store.close()
+
+@pytest.mark.asyncio
+async def test_conversation_cache():
+    class SlowStore(ConversationStore):
+        """Returns conversations once `loaded` is set, like a store answering late."""
+        loaded = asyncio.Event()
+
+        async def get_conversation(self, conversation_id):
+            conversation = await super().get_conversation(conversation_id)
+            await self.loaded.wait()
+            return conversation
+
+    if os.path.exists(f'{file_dir}/.db'):
+        shutil.rmtree(f'{file_dir}/.db')
+    store = SlowStore(f'{file_dir}/.db/conversations.sqlite3')
+    cache = ConversationCache(store)
+    await cache.open()
+    await store.add_message('c1', 'm1', Message('hello', None, 'hi', 2))
+
+    # a message added while a miss loads the conversation isn't overwritten by the loaded one
+    loading = asyncio.create_task(cache.get_conversation('c1'))
+    await asyncio.sleep(0.1)
+    adding = asyncio.create_task(cache.add_message('c1', 'm2', Message('how are you', 'm1', 'fine', 3)))
+    await asyncio.sleep(0.1)
+    store.loaded.set()
+    await asyncio.gather(loading, adding)
+    assert await cache.get_last_message_id('c1') == 'm2'
+    assert [message.message for message in await cache.get_chain('c1', 'm2')] == ['how are you', 'hello']
+
+    # later chains are served from memory
+    await cache.add_message('c1', 'm3', Message('and you?', 'm2', 'good', 2))
+    hits = cache.hits
+    assert [message.tokens for message in await cache.get_chain('c1', 'm3', max_tokens=5)] == [2, 3]
+    assert cache.hits == hits + 1
+
+    # least recently used conversations are evicted beyond max_bytes
+    await cache.get_conversation('c2')
+    cache.set_limits(cache.entries['c2'].size, cache.ttl)
+    assert list(cache.entries) == ['c2'] and cache.evictions == 1
+    assert await cache.get_last_message_id('c1') == 'm3'
+    await cache.close()
+
+@pytest.mark.asyncio
+async def test_prompt_tokens(monkeypatch):
+    bot = openai_bot(monkeypatch, lambda request: completion_response('test'))
+    await bot.init()
+    monkeypatch.setattr(chatgpt_openai, 'max_prompt_token', 100)
+    message_ids = []
+    for i in range(10):
+        message_ids.append(await bot.add_messsage('conversation_id', f'question {i} ' + 'x' * 40, f'answer {i}'))
+    tokens = (await bot.get_parent_messsage('conversation_id', message_ids[-1])).tokens
+    role_tokens = estimate_tokens(chatgpt_openai.default_role)
+
+    # the newest messages fitting into max_prompt_token are the context, newest last
+    prompt, prompt_tokens = await bot.generate_prompt_and_tokens('conversation_id', 'next')
+    kept = (100 - role_tokens - estimate_tokens('next')) // tokens
+    questions = [message['content'].split(' x')[0] for message in prompt if message['role'] == 'user']
+    assert questions == [f'question {i}' for i in range(10 - kept, 10)] + ['next']
+    assert prompt_tokens == role_tokens + estimate_tokens('next') + kept * tokens <= 100
+
+    # the same prompt is built from the store once the cached chain is gone
+    chatgpt_openai.g_conversations.entries.clear()
+    assert await bot.generate_prompt_and_tokens('conversation_id', 'next') == (prompt, prompt_tokens)
+    await bot.close()
+
+@pytest.mark.asyncio
+async def test_rate_limiter():
+    assert parse_reset('6m0s') == 360.0
+    assert parse_reset('1.5s') == 1.5
+    assert parse_reset('20ms') == 0.02
+
+    limiter = ApiKeyRateLimiter(requests_per_minute=60, tokens_per_minute=6000)
+    await limiter.reserve(1000, max_wait=0)
+    assert round(limiter.tokens.tokens) == 5000
+    # the answer used fewer tokens than reserved, the rest goes back to the budget
+    limiter.reconcile(1000, 400)
+    assert round(limiter.tokens.tokens) == 5600
+    limiter.reconcile(100, 300)
+    assert round(limiter.tokens.tokens) == 5400
+
+    # the limits reported by the api replace the defaults, which no longer change them
+    limiter.update_from_headers({
+        'x-ratelimit-limit-requests': '3', 'x-ratelimit-remaining-requests': '0', 'x-ratelimit-reset-requests': '20s',
+        'x-ratelimit-limit-tokens': '1000', 'x-ratelimit-remaining-tokens': '500', 'x-ratelimit-reset-tokens': '30s',
+    })
+    assert limiter.reported
+    assert (limiter.requests.capacity, limiter.tokens.capacity, limiter.tokens.tokens) == (3, 1000, 500)
+    limiter.set_default_limits(requests_per_minute=100)
+    assert limiter.requests.capacity == 3
+    assert not limiter.available()
+    assert 6.0 < limiter.wait_time(1) <= 20.0
+    with pytest.raises(ApiRateLimitError):
+        await limiter.reserve(1, max_wait=1.0)
+
+    limiter = ApiKeyRateLimiter()
+    limiter.on_rate_limited({'retry-after': '2'})
+    assert 1.9 < limiter.wait_time(1) <= 2.0
+
+@pytest.mark.asyncio
+async def test_response_cache():
+    assert response_key('model', 'role', '  What is  a Cat? ') == response_key('model', 'role', 'what is a cat')
+    assert response_key('model', 'role', 'what is a cat') != response_key('model', 'other role', 'what is a cat')
+
+    if os.path.exists(f'{file_dir}/.db'):
+        shutil.rmtree(f'{file_dir}/.db')
+    store = ConversationStore(f'{file_dir}/.db/conversations.sqlite3')
+    await store.open()
+    cache = ResponseCache(max_entries=2, disk=True, disabled_roles=['secret'])
+    cache.attach(store)
+    assert not cache.enabled_for('secret')
+    for i in range(3):
+        await cache.put(f'key {i}', f'answer {i}')
+    # the oldest entry left the memory tier and is read from disk
+    assert list(cache.entries) == ['key 1', 'key 2']
+    assert await cache.get('key 0') == 'answer 0'
+    assert await cache.get('key 2') == 'answer 2'
+    assert await cache.get('key 3') is None
+    assert (cache.hits, cache.disk_hits, cache.misses) == (1, 1, 1)
+
+    # expired entries are dropped from both tiers
+    cache.ttl = -1
+    await cache.put('key 4', 'answer 4')
+    assert await cache.get('key 4') is None
+    await store.close()
+
+@pytest.mark.asyncio
+async def test_single_flight():
+    single_flight = SingleFlight()
+    started = []
+    release = asyncio.Event()
+    cancelled = asyncio.Event()
+
+    async def upstream():
+        started.append(True)
+        try:
+            yield 'a'
+            await release.wait()
+            yield 'b'
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    async def collect(items):
+        return [item async for item in items]
+
+    # a caller joining late gets the items from the start, the upstream runs once
+    first = asyncio.create_task(collect(single_flight.stream('key', upstream)))
+    await asyncio.sleep(0.01)
+    second = asyncio.create_task(collect(single_flight.stream('key', upstream)))
+    await asyncio.sleep(0.01)
+    release.set()
+    assert await first == await second == ['a', 'b']
+    assert len(started) == 1 and single_flight.coalesced == 1
+    assert not single_flight.in_flight('key')
+
+    # the upstream is cancelled once the last caller stops listening
+    release.clear()
+    items = single_flight.stream('key', upstream)
+    assert await items.__anext__() == 'a'
+    await items.aclose()
+    # a caller arriving meanwhile starts a fresh upstream
+    assert not single_flight.in_flight('key')
+    await asyncio.wait_for(cancelled.wait(), 1)
+
+    # callers of a flight cancelled at shutdown get an error instead of a cut off answer
+    items = single_flight.stream('key', upstream)
+    assert await items.__anext__() == 'a'
+    single_flight.flights['key'].task.cancel()
+    with pytest.raises(FlightCancelled):
+        await items.__anext__()
+    assert not single_flight.in_flight('key')
+
+    async def failing():
+        yield 'a'
+        raise ValueError('upstream failed')
+
+    with pytest.raises(ValueError):
+        await collect(single_flight.stream('key', failing))
+
+@pytest.mark.asyncio
+async def test_stream_completion_reserve(monkeypatch):
+    bot = openai_bot(monkeypatch, lambda request: stream_response('hi'), max_concurrency=1)
+    await bot.init()
+    bot.rate_limiter.block(0.2)
+    # the slot is free while the request waits for the budget of the key
+    deltas = bot.stream_completion([{'role': 'user', 'content': 'hello'}], 10)
+    waiting = asyncio.create_task(deltas.__anext__())
+    await asyncio.sleep(0.1)
+    assert not bot.semaphore.locked()
+    assert await waiting == 'hi '
+    await deltas.aclose()
+    await bot.close()
+
+    # the reserved tokens are returned when the request fails
+    bot = openai_bot(monkeypatch, lambda request: httpx.Response(400, json={'error': {'message': 'bad request'}}))
+    await bot.init()
+    capacity = bot.rate_limiter.tokens.capacity
+    with pytest.raises(Exception):
+        await bot.stream_completion([{'role': 'user', 'content': 'hello'}], 10).__anext__()
+    bot.rate_limiter.tokens.refill()
+    assert bot.rate_limiter.tokens.tokens > capacity - 100
+    await bot.close()
+
+@pytest.mark.asyncio
+async def test_retry_policy():
+    calls = []
+
+    def factory(name, delay=0.0, error=None, items=('a', 'b')):
+        async def stream():
+            calls.append(name)
+            await asyncio.sleep(delay)
+            if error:
+                raise error
+            for item in items:
+                yield item
+        return stream
+
+    async def collect(items):
+        return [item async for item in items]
+
+    # transient errors before the first item move on to the next key, in order
+    policy = RetryPolicy(max_attempts=3, backoff=0)
+    assert await collect(policy.stream([factory('k1', error=asyncio.TimeoutError()), factory('k2', error=asyncio.TimeoutError()), factory('k3')])) == ['a', 'b']
+    assert calls == ['k1', 'k2', 'k3'] and policy.retries == 2
+
+    # other errors and running out of attempts are raised
+    calls.clear()
+    with pytest.raises(ValueError):
+        await collect(policy.stream([factory('k1', error=ValueError()), factory('k2')]))
+    assert calls == ['k1']
+    calls.clear()
+    with pytest.raises(asyncio.TimeoutError):
+        await collect(RetryPolicy(max_attempts=2, backoff=0).stream([factory('k1', error=asyncio.TimeoutError())]))
+    assert calls == ['k1', 'k1']
+
+    # a slow first token starts a hedged request on the next key, the slower one is cancelled
+    calls.clear()
+    policy = RetryPolicy(hedge=True)
+    policy.latency.default_deadline = 0.05
+    assert await collect(policy.stream([factory('k1', delay=1.0, items=['slow']), factory('k2', items=['fast'])])) == ['fast']
+    assert calls == ['k1', 'k2'] and (policy.hedges, policy.hedge_wins) == (1, 1)
+
+    # cancelling the caller while the losing request winds down cancels the caller
+    async def slow_to_cancel():
+        try:
+            await asyncio.sleep(1.0)
+        except asyncio.CancelledError:
+            await asyncio.sleep(0.2)
+            raise
+        yield 'slow'
+
+    first = asyncio.create_task(policy.stream([slow_to_cancel, factory('k2', delay=0.1, items=['fast'])]).__anext__())
+    await asyncio.sleep(0.25)
+    first.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await first
+
+@pytest.mark.asyncio
+async def test_retention():
+    if os.path.exists(f'{file_dir}/.db'):
+        shutil.rmtree(f'{file_dir}/.db')
+    store = ConversationStore(f'{file_dir}/.db/conversations.sqlite3')
+    await store.open()
+
+    await store.add_message('conversation_id', 'message_id_1', Message('hello', None, 'hi'))
+    await store.add_message('conversation_id', 'message_id_2', Message('how are you', 'message_id_1', 'fine'))
+    await store.add_message('conversation_id', 'message_id_3', Message('bye', 'message_id_2', 'bye'))
+    await store.clear_last_message_id('reset_id')
+    await store.add_message('reset_id', 'message_id_4', Message('hello', None, 'hi'))
+    await store.clear_last_message_id('reset_id')
+
+    cache = ConversationCache(store)
+    await cache.get_conversation('conversation_id')
+    await cache.get_chain('conversation_id', 'message_id_3')
+    swept = []
+    sweeper = ConversationSweeper(store, RetentionPolicy(max_messages=2, grace_period=0.0), cache, on_swept=swept.extend)
+    await sweeper.sweep()
+    assert sweeper.deleted_messages == 2
+    # the cached chain held the deleted message
+    assert 'conversation_id' not in cache.entries
+    assert sorted(swept) == ['conversation_id', 'reset_id']
+    chain = await cache.get_chain('conversation_id', 'message_id_3')
+    assert [message.message for message in chain] == ['bye', 'how are you']
+    assert chain[-1].parent_message_id is None
+    assert await store.get_message('reset_id', 'message_id_4') is None
+
+    # with workers, the conversations swept by the first one are dropped by the others
+    pool = WorkerPool('bot-config.yaml', 3, None)
+    pool.on_reply(('invalidate', 0, ['conversation_id']))
+    assert [inbox.get(timeout=1.0) for inbox in pool.inboxes[1:]] == [('invalidate', ['conversation_id'])] * 2
+    assert pool.inboxes[0].empty()
+    worker = WorkerBot.__new__(WorkerBot)
+    worker.openai_module = asyncio.get_running_loop().create_future()
+    worker.openai_module.set_result(SimpleNamespace(g_conversations=cache))
+    await cache.get_conversation('conversation_id')
+    assert 'conversation_id' in cache.entries
+    worker.invalidate_conversations(['conversation_id'])
+    assert 'conversation_id' not in cache.entries
+    await store.close()
+
+def test_compact():
+    if os.path.exists(f'{file_dir}/.db'):
+        shutil.rmtree(f'{file_dir}/.db')
+    os.makedirs(f'{file_dir}/.db')
+    # expired users of the browser accounts are kept in `{user}-2`, their users in `{user}-1`
+    expired = time.time() - 30 * 24 * 3600
+    for name in ('account-2', 'account-2b-1'):
+        with shelve.open(f'{file_dir}/.db/{name}') as db:
+            db['old'] = SimpleNamespace(expiration=expired)
+            db['new'] = SimpleNamespace(expiration=time.time())
+    compact(path=f'{file_dir}/.db/conversations.sqlite3')
+    with shelve.open(f'{file_dir}/.db/account-2', flag='r') as db:
+        assert list(db.keys()) == ['new']
+    with shelve.open(f'{file_dir}/.db/account-2b-1', flag='r') as db:
+        assert sorted(db.keys()) == ['new', 'old']
+    assert not glob.glob(f'{file_dir}/.db/*.compact*')
+
+@pytest.mark.asyncio
+async def test_question_queue():
+    if os.path.exists(f'{file_dir}/.db'):
+        shutil.rmtree(f'{file_dir}/.db')
+    answered = []
+    failed = []
+
+    async def handler(question):
+        if question.data == 'fail':
+            raise Exception('failed')
+        answered.append(question.data)
+        return True
+
+    async def on_dead(question, error):
+        failed.append(question.data)
+
+    queue = QuestionQueue(f'{file_dir}/.db/questions.sqlite3', max_attempts=2, backoff=0.01)
+    await queue.open(handler, on_dead)
+    await queue.put('conversation_id', 'user_1', 'fail')
+    await queue.put('conversation_id', 'user_1', 'second')
+    await queue.put('conversation_id', 'user_2', 'other')
+    assert queue.is_pending('user_1')
+    for _ in range(100):
+        if len(answered) == 2:
+            break
+        await asyncio.sleep(0.05)
+    # the questions of a user wait for the earlier ones
+    assert answered == ['other', 'second']
+    assert failed == ['fail']
+    assert not queue.is_pending('user_1')
+    assert await queue.store.count() == {'pending': 0, 'dead': 1}
+    await queue.close()
+
+@pytest.mark.asyncio
+async def test_admission():
+    handled = []
+    release = asyncio.Event()
+
+    def handler(name):
+        async def handle():
+            handled.append(name)
+            await release.wait()
+        return handle
+
+    admission = AdmissionController(max_in_flight=1, max_queue=4, max_user_in_flight=1, dm_weight=2, group_weight=1)
+    for i in range(3):
+        assert admission.submit('group_user', 'group', False, handler(f'group_{i}'))
+    assert admission.submit('dm_user', 'dm', True, handler('dm_0'))
+    assert admission.submit('dm_user', 'dm', True, handler('dm_1'))
+    assert not admission.submit('dm_user', 'dm', True, handler('dm_2'))
+    assert admission.stats()['queued'] == 4
+
+    release.set()
+    while admission.tasks or admission.queued:
+        await asyncio.sleep(0.01)
+    # the direct conversation gets two messages per round
+    assert handled == ['group_0', 'group_1', 'dm_0', 'dm_1', 'group_2']
+    assert admission.stats()['shed'] == 1
+
+@pytest.mark.asyncio
+async def test_acks():
+    batches = []
+    failures = [Exception('unavailable')]
+
+    async def send(message_ids):
+        if failures:
+            raise failures.pop()
+        batches.append(message_ids)
+
+    acks = AckBatcher(send, max_batch=3, max_delay=0.01, retry_delay=0.01)
+    for i in range(4):
+        acks.add(f'message_{i}')
+    await asyncio.sleep(0.1)
+    # the failed batch is sent again
+    assert batches == [['message_0', 'message_1', 'message_2'], ['message_3']]
+    acks.add('message_4')
+    await acks.close()
+    assert batches[-1] == ['message_4']
+    assert acks.acked == 5
+
+@pytest.mark.asyncio
+async def test_group_debounce():
+    batches = []
+    async def on_batch(conversation_id, messages):
+        batches.append((conversation_id, merge_messages(messages)))
+    debouncer = GroupDebouncer(on_batch, window_ms=50, max_messages=3)
+    await debouncer.add('group', GroupMessage('alice-id', 'how do I'))
+    await debouncer.add('group', GroupMessage('alice-id', 'sort a list?'))
+    await debouncer.add('other', GroupMessage('bob-id', 'hi'))
+    await asyncio.sleep(0.02)
+    assert batches == []
+    await asyncio.sleep(0.1)
+    assert sorted(batches) == [('group', 'how do I\nsort a list?'), ('other', 'hi')]
+    # a full batch is answered without waiting, each line by its sender
+    batches.clear()
+    for user_id, text in (('alice-id', 'a'), ('bob-id', 'b'), ('alice-id', 'c')):
+        await debouncer.add('group', GroupMessage(user_id, text))
+    assert batches == [('group', '[user alice-id] a\n[user bob-id] b\n[user alice-id] c')]
+    assert not debouncer.batches
+
+@pytest.mark.asyncio
+async def test_worker_group_batches():
+    # with workers, group messages of all members are merged by the process receiving them
+    dispatched = []
+    bot = MixinBot.__new__(MixinBot)
+    bot.__dict__.update(client_id='bot-id', worker_pool=SimpleNamespace(dispatch=lambda key, msg: dispatched.append((key, msg))))
+    bot.group_debounce = GroupDebouncer(bot.submit_group_messages, window_ms=50)
+
+    def message(conversation_id, user_id, text):
+        return SimpleNamespace(category='PLAIN_TEXT', type='message', conversation_id=conversation_id, user_id=user_id,
+            data=base64.urlsafe_b64encode(text.encode()).decode())
+
+    assert await bot.debounce_group_message(message('group', 'alice-id', 'a'))
+    assert await bot.debounce_group_message(message('group', 'bob-id', 'b'))
+    # direct messages and commands go to the worker of their sender, commands after the pending batch
+    assert not await bot.debounce_group_message(message(utils.unique_conversation_id('alice-id', 'bot-id'), 'alice-id', 'c'))
+    assert not await bot.debounce_group_message(message('group', 'alice-id', '/reset'))
+    assert dispatched == [('bob-id', ('group', 'group', [('alice-id', 'a'), ('bob-id', 'b')]))]
+
+    # the worker of the last sender answers the batch with one completion
+    submitted = []
+    worker = WorkerBot.__new__(WorkerBot)
+    worker.__dict__.update(worker_pool=None, worker_index=1, tracer=Tracer(),
+        submit=lambda user_id, conversation_id, direct, handler: submitted.append((user_id, conversation_id, direct)) or True)
+    await worker.handle_group_batch(*dispatched[0][1][1:])
+    assert submitted == [('bob-id', 'group', False)]
+
+def test_shutdown_group_batches():
+    # SIGINT and SIGTERM cancel every task, group messages waiting for the window are saved first
+    if os.path.exists(f'{file_dir}/.db'):
+        shutil.rmtree(f'{file_dir}/.db')
+    path = f'{file_dir}/.db/shutdown.sqlite3'
+
+    async def closed():
+        pass
+
+    async def main():
+        bot = MixinBot.__new__(MixinBot)
+        bot.__dict__.update(acks=SimpleNamespace(close=closed), worker_pool=None, tracer=SimpleNamespace(close=closed),
+            questions=QuestionQueue(path), group_debounce=GroupDebouncer(None, window_ms=60000))
+        await bot.questions.open(lambda question: asyncio.Event().wait())
+        await bot.group_debounce.add('group', GroupMessage('user_1', 'hello'))
+        await bot.group_debounce.add('group', GroupMessage('user_2', 'hi'))
+        await bot.handle_signal(signal.SIGTERM)
+        await asyncio.sleep(1.0)
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(main())
+    db = sqlite3.connect(path)
+    assert db.execute('SELECT conversation_id, user_id, data FROM questions').fetchall() == [
+        ('group', 'user_2', '[user user_1] hello\n[user user_2] hi')]
+    db.close()
+
+@pytest.mark.asyncio
+async def test_outbox():
+    sent = []
 
-    async for reply in bot.send_message('conversation_id', 'write a poem about a cat'):
-        print('++++reply:', reply)
+    async def send(conversation_id, user_id, text):
+        await asyncio.sleep(0.1)
+        sent.append(text)
+
+    outbox = Outbox(send, conversation_messages_per_second=10.0, burst=1)
+    outbox.push('conversation_id', 'user_id', '[BEGIN]', coalesce=False)
+    for i in range(5):
+        outbox.push('conversation_id', 'user_id', f'{i} ')
+    outbox.push('conversation_id', 'user_id', '[END]', coalesce=False)
+    assert await outbox.flush('conversation_id', 'user_id') > 0.0
+    # texts queued while [BEGIN] was sent are joined
+    assert sent == ['[BEGIN]', '0 1 2 3 4', '[END]']
+
+    # members of a group wait only for their own texts and get only their own send errors
+    async def send_group(conversation_id, user_id, text):
+        await asyncio.sleep(0.1)
+        if user_id == 'bob':
+            raise Exception('send failed')
+        sent.append(text)
+
+    sent.clear()
+    outbox = Outbox(send_group, conversation_messages_per_second=100.0, max_attempts=1)
+    outbox.push('group', 'alice', 'hi alice', coalesce=False)
+    for i in range(3):
+        outbox.push('group', 'bob', f'hi bob {i}', coalesce=False)
+    start = time.monotonic()
+    assert await outbox.flush('group', 'alice') > 0.0
+    assert time.monotonic() - start < 0.2
+    with pytest.raises(Exception, match='send failed'):
+        await outbox.flush('group', 'bob')
+    assert sent == ['hi alice'] and not outbox.outboxes
+
+@pytest.mark.asyncio
+async def test_outbox_stream(monkeypatch):
+    answer = 'The cat sat on the mat.\n\nIt was warm there. The dog slept.\nThe end.'
+    bot = openai_bot(monkeypatch, lambda request: stream_response(answer), flush_policy=FlushPolicy(first_chunk_delay=0, min_interval=0))
+    await bot.init()
+    chunks = []
+    sent = []
+
+    async def send(conversation_id, user_id, text):
+        await asyncio.sleep(0.1)
+        sent.append(text)
+
+    outbox = Outbox(send, conversation_messages_per_second=10.0, burst=1)
+    async for chunk in bot.send_message('conversation_id', 'tell a story'):
+        chunks.append(chunk)
+        outbox.push('conversation_id', 'user_id', chunk, coalesce=chunk != '[BEGIN]')
+    await outbox.flush('conversation_id', 'user_id')
+    # sentence sized chunks joined into one message keep the spaces and newlines between them
+    assert len(chunks) > 3
+    assert sent == ['[BEGIN]', answer]
+    await bot.close()
+
+@pytest.mark.asyncio
+async def test_web_search():
+    provider = StaticSearchProvider({'cats': [SearchResult('Cats are small.', 'https://example.com/cats')]})
+    search = WebSearch(provider)
+    prompt = await search.prompt('cats/p what are cats?')
+    assert prompt.startswith('Web search results:\n\n\n[1] "Cats are small."\nSource: https://example.com/cats\n')
+    assert prompt.endswith('\nPrompt: what are cats?')
+    assert await search.prompt('Cats /p what are cats?') == prompt
+    assert provider.searches == 1
+    assert await search.prompt('dogs') == 'dogs'
+
+def test_scheduler():
+    @dataclass
+    class Bot:
+        sticky: bool
+        max_concurrency: int
+        available: bool = True
+
+    browser = Bot(True, 1)
+    api = Bot(False, 8)
+    scheduler = BotScheduler()
+    scheduler.add(browser)
+    scheduler.add(api)
+
+    scheduler.acquire(api)
+    assert scheduler.choose('user_1') is browser
+    # the browser keeps the conversation until it is much slower than the api
+    scheduler.acquire(browser)
+    assert scheduler.choose('user_1') is browser
+    scheduler.release(browser, 30.0, False)
+    assert scheduler.choose('user_1') is api
+    assert scheduler.choose('user_2') is api
+
+    # a browser account keeping the conversation of a user gets it however slow it is,
+    # also after a restart, while it is available
+    account = Bot(True, 1)
+    account.users = {'user_3': None}
+    scheduler = BotScheduler()
+    scheduler.add(account)
+    scheduler.add(api)
+    scheduler.get_stats(account).ttft = 30.0
+    assert scheduler.choose('user_3') is account
+    account.available = False
+    assert scheduler.choose('user_3') is api
+
+    # the users of an account are followed as it assigns them and they expire, without a scan
+    account.available = True
+    account.on_users_changed = None
+    scheduler = BotScheduler()
+    scheduler.add(account)
+    scheduler.add(api)
+    scheduler.get_stats(account).ttft = 30.0
+    account.on_users_changed('user_4', True)
+    assert scheduler.choose('user_4') is account
+    account.on_users_changed('user_3', False)
+    assert scheduler.choose('user_3') is api
+    scheduler.drain(account)
+    assert not scheduler.owners and not account.on_users_changed
+
+def test_backend_specs():
+    config = {'accounts': [{'user': 'a', 'psw': 'p'}], 'openai_api_keys': ['sk-1', 'sk-2']}
+    specs = backend_specs(config)
+    assert specs[('browser', 'a', 'p')] == {'user': 'a', 'psw': 'p'}
+    assert specs[('openai', 'sk-1', '', '')] == 'sk-1'
+    # a new base url replaces every api backend
+    moved = backend_specs(dict(config, openai_base_url='https://example.com/v1'))
+    assert set(moved) & set(specs) == {('browser', 'a', 'p')}
+
+@pytest.mark.asyncio
+async def test_reload(monkeypatch):
+    # a bot with a part of the MixinBot state, the api backends answered by a fake transport
+    monkeypatch.setattr(chatgpt_openai, 'g_conversations', ConversationCache(ConversationStore(f'{file_dir}/.db/reload.sqlite3')))
+    monkeypatch.setattr(chatgpt_openai, 'g_bots', [])
+    http_pool = HttpPool()
+    http_pool.clients[''] = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: completion_response('ok')))
+    bot = MixinBot.__new__(MixinBot)
+    bot.__dict__.update(bots=[], backends={}, retiring=set(), scheduler=BotScheduler(), reload_config={'drain_timeout': 10},
+        questions=SimpleNamespace(notify=lambda: None), conversation_cache={}, openai_base_url='http://openai.test/v1',
+        openai_proxy_url='', openai_max_concurrency=2, openai_rate_limits={}, summarize={}, flush_policy=FlushPolicy(),
+        response_cache=None, retry_policy=RetryPolicy(), http_pool=http_pool, warm_up_task=asyncio.create_task(asyncio.sleep(0)),
+        retention=RetentionPolicy(interval=3600), worker_index=None, sweeper=None)
+    # the sdk is still being imported while the backends start
+    bot.openai_module = asyncio.get_running_loop().create_future()
+    for key in ('sk-1', 'sk-2', 'sk-3'):
+        bot.backends[key] = asyncio.create_task(bot.add_bot(bot.init_openai_bot(bot.openai_module, key)))
+    await asyncio.sleep(0)
+
+    # a backend removed while starting is cancelled, the others keep waiting for the import
+    bot.retire_backend(bot.backends.pop('sk-3'))
+    await asyncio.sleep(0)
+    assert not bot.openai_module.cancelled()
+    bot.openai_module.set_result(chatgpt_openai)
+    api_1, api_2 = await asyncio.gather(bot.backends['sk-1'], bot.backends['sk-2'])
+    assert bot.bots == [api_1, api_2] and chatgpt_openai.g_bots == [api_1, api_2]
+    sweeper = bot.sweeper
+    assert sweeper.task
+
+    # a retired bot gets no new messages and is closed once its answer in flight is done
+    bot.scheduler.acquire(api_1)
+    bot.retire_backend(bot.backends.pop('sk-1'))
+    await asyncio.sleep(1.5)
+    assert bot.bots == [api_2] and bot.scheduler.choose('user') is api_2
+    assert chatgpt_openai.g_bots == [api_1, api_2]
+    bot.scheduler.release(api_1, 0.1, False)
+    await asyncio.gather(*bot.retiring)
+    assert chatgpt_openai.g_bots == [api_2]
+    assert chatgpt_openai.g_conversations.store.db
+
+    # the last api bot closes the store, the sweeper using it is stopped first
+    bot.retire_backend(bot.backends.pop('sk-2'))
+    await asyncio.gather(*bot.retiring)
+    assert not bot.bots and not chatgpt_openai.g_bots
+    assert not chatgpt_openai.g_conversations.store.db
+    assert not sweeper.task and not bot.sweeper
+    await http_pool.aclose()
+
+def test_flush_policy():
+    policy = FlushPolicy(first_chunk_delay=0.0, min_interval=0.0, max_delay=60.0, max_buffer=20)
+    buffer = StreamBuffer(policy)
+    assert buffer.feed('你好') == '你好'
+    assert buffer.feed('，世界。这是') == '，世界。'
+    assert buffer.feed('一个测试！还有') == '这是一个测试！'
+    assert buffer.feed('pi is 3.14') is None
+    assert buffer.feed(' ok. next') == '还有pi is 3.14 ok.'
+    assert buffer.flush() == ' next'
+
+def test_shard_for():
+    users = [f'user_{i}' for i in range(1000)]
+    shards = [shard_for(user, 4) for user in users]
+    # the same in every process, unlike hash()
+    assert shards == [shard_for(user, 4) for user in users]
+    assert all(150 < shards.count(i) < 350 for i in range(4))
+
+@pytest.mark.asyncio
+async def test_tokenizer():
+    # without an encoding, e.g. offline with an empty cache, tokens are estimated
+    tokenizer = Tokenizer(model='no-such-model')
+    assert await tokenizer.count_async('hello world') == estimate_tokens('hello world') == 3
+    assert tokenizer.failed
+
+    # a load taking longer than load_timeout is waited for once
+    class SlowTokenizer(Tokenizer):
+        def load(self):
+            loaded.wait()
+            return False
+
+    loaded = threading.Event()
+    tokenizer = SlowTokenizer(load_timeout=0.05)
+    try:
+        assert await tokenizer.count_async('hello world') == 3
+        start = time.monotonic()
+        assert await tokenizer.count_async('hello world') == 3
+        assert time.monotonic() - start < 0.05
+    finally:
+        loaded.set()
+
+def test_async_log():
+    os.makedirs(f'{file_dir}/.db', exist_ok=True)
+    path = f'{file_dir}/.db/log.jsonl'
+    if os.path.exists(path):
+        os.remove(path)
+    async_log = AsyncLogging(path, stderr=False, max_length=20, sample_rates={'payload': 0.0})
+    async_log.start()
+    logger = logging.getLogger('test_async_log')
+    logger.setLevel(logging.INFO)
+    logger.info('payload %s', 'x' * 100, extra={'category': 'payload'})
+    logger.info('answered %s', 'x' * 100, extra={'conversation': 'c1', 'stage': 'answer', 'duration': 1.5})
+    async_log.stop()
+    entries = [json.loads(line) for line in open(path)]
+    answered = [entry for entry in entries if entry['logger'] == 'test_async_log']
+    assert len(answered) == 1
+    assert answered[0]['message'] == 'answered ' + 'x' * 11 + '...(89 more)'
+    assert (answered[0]['conversation'], answered[0]['stage'], answered[0]['duration']) == ('c1', 'answer', 1.5)
+    assert async_log.stats()['sampled_out'] == 1
+    assert async_log.queue_handler not in logging.getLogger().handlers
+
+@pytest.mark.asyncio
+async def test_metrics(monkeypatch):
+    registry = Registry()
+    latency = registry.histogram('latency_seconds', 'Latency.', ('bot',), buckets=(0.5, 1.0))
+    errors = registry.counter('errors_total', 'Errors.', ('bot',))
+    latency.observe(0.5, 'a')
+    latency.observe(2.0, 'a')
+    errors.inc('a', amount=2)
+    text = await registry.render()
+    assert 'latency_seconds_bucket{bot="a",le="0.5"} 1\n' in text
+    assert 'latency_seconds_bucket{bot="a",le="1"} 1\n' in text
+    assert 'latency_seconds_bucket{bot="a",le="+Inf"} 2\n' in text
+    assert 'latency_seconds_sum{bot="a"} 2.5\n' in text
+    assert '# TYPE errors_total counter\nerrors_total{bot="a"} 2\n' in text
+
+    # counts of the components are exported as counters, in worker mode the workers export
+    # the components answering messages
+    monkeypatch.setattr(metrics, 'registry', Registry())
+    admission = SimpleNamespace(stats=lambda: {'admitted': 3, 'queued': 1})
+    outbox = SimpleNamespace(stats=lambda: {'texts': 5, 'conversations': 2})
+    owner = SimpleNamespace(bots=[], questions=SimpleNamespace(store=SimpleNamespace(db=None)), admission=admission,
+        group_debounce=None, outbox=outbox, web_search=None, response_cache=None, worker_pool=None, tracer=None,
+        async_log=None, openai_api_keys=[])
+    await MixinBot.collect_metrics(owner)
+    text = await metrics.registry.render()
+    assert '# TYPE chatgpt_mixin_admission_admitted_total counter\nchatgpt_mixin_admission_admitted_total 3\n' in text
+    assert '# TYPE chatgpt_mixin_admission_queued gauge\nchatgpt_mixin_admission_queued 1\n' in text
+    assert 'chatgpt_mixin_outbox_texts_total 5\n' in text
+
+    monkeypatch.setattr(metrics, 'registry', Registry())
+    owner.worker_pool = SimpleNamespace(stats=lambda: {'dispatched': 7, 'alive': 2})
+    await MixinBot.collect_metrics(owner)
+    text = await metrics.registry.render()
+    assert 'chatgpt_mixin_admission' not in text
+    assert 'chatgpt_mixin_workers_dispatched_total 7\n' in text
+    assert 'chatgpt_mixin_outbox_texts_total 5\n' in text
+
+@pytest.mark.asyncio
+async def test_tracing():
+    class ListExporter(SpanExporter):
+        traces = []
 
-    async for reply in bot.send_message('conversation_id', 'make the poem rhyme'):
-        print('+++reply:', reply)
+        async def export(self, traces):
+            self.traces.extend(traces)
 
-    print(reply)
+    exporter = ListExporter()
+    tracer = Tracer(exporter, sample_rate=0.0, slow_threshold=0.05, flush_interval=0.01)
+    with tracer.trace('message') as trace:
+        with span('choose_bot'):
+            pass
+        # handed to a task, the trace ends when the task is done
+        held = hold()
+    with span('outside'):
+        pass
+    held.add_span('answer', held.start)
+    await asyncio.sleep(0.06)
+    held.release()
+    with tracer.trace('fast'):
+        pass
+    await tracer.close()
+    # only the slow trace is exported
+    assert [trace.name for trace in exporter.traces] == ['message']
+    assert [span.name for span in exporter.traces[0].spans] == ['choose_bot', 'answer']
+    assert exporter.traces[0].duration >= 0.05
@@ -0,0 +1,106 @@
+import asyncio
+import os
+import threading
+from typing import Any, Optional
+
+from pymixin import log
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+default_model = 'gpt-3.5-turbo'
+
+def estimate_tokens(text: str) -> int:
+    """About one token per 4 bytes of UTF-8, used while no encoding is available."""
+    return (len(text.encode()) + 3) // 4
+
+class Tokenizer:
+    """Counts tokens with tiktoken, loaded on first use or by `start` in the background.
+
+    With `cache_dir` set the encoding is read from that directory, which can be
+    filled on a connected host with `python -m chatgpt_mixin tokenizer` and copied
+    to hosts without internet access. If the encoding can't be loaded, or takes
+    longer than `load_timeout` seconds, tokens are estimated.
+    """
+
+    def __init__(self, model: str = default_model, cache_dir: Optional[str] = None, load_timeout: float = 30.0):
+        self.model = model
+        self.cache_dir = cache_dir
+        self.load_timeout = load_timeout
+        self.encoding: Optional[Any] = None
+        self.failed = False
+        # the first wait for the encoding timed out, tokens are estimated until it is loaded
+        self.timed_out = False
+        self.lock = threading.Lock()
+        self.loading: Optional[asyncio.Future] = None
+
+    def configure(self, model: Optional[str] = None, cache_dir: Optional[str] = None, load_timeout: Optional[float] = None):
+        if model:
+            self.model = model
+        if cache_dir:
+            self.cache_dir = cache_dir
+        if load_timeout is not None:
+            self.load_timeout = load_timeout
+
+    def load(self) -> bool:
+        """Load the encoding, blocking, return False if it is not available."""
+        with self.lock:
+            if self.encoding is not None or self.failed:
+                return not self.failed
+            if self.cache_dir:
+                # read by tiktoken when it loads the encoding files
+                os.environ['TIKTOKEN_CACHE_DIR'] = os.path.abspath(self.cache_dir)
+            try:
+                import tiktoken
+                self.encoding = tiktoken.encoding_for_model(self.model)
+            except Exception as e:
+                self.failed = True
+                logger.error("+++loading the %s tokenizer failed, estimating tokens: %s", self.model, e)
+                return False
+            logger.info("+++loaded the %s tokenizer", self.model)
+            return True
+
+    def start(self) -> asyncio.Future:
+        """Load the encoding in a thread, without blocking the event loop."""
+        if not self.loading:
+            loop = asyncio.get_running_loop()
+            self.loading = loop.run_in_executor(None, self.load)
+        return self.loading
+
+    def count(self, text: str) -> int:
+        if self.encoding is None and not self.load():
+            return estimate_tokens(text)
+        return len(self.encoding.encode(text))
+
+    async def count_async(self, text: str) -> int:
+        if self.encoding is None and not self.failed and not self.timed_out:
+            try:
+                await asyncio.wait_for(asyncio.shield(self.start()), self.load_timeout)
+            except asyncio.TimeoutError:
+                self.timed_out = True
+                logger.warning("+++the %s tokenizer is not loaded after %s seconds, estimating tokens until it is",
+                    self.model, self.load_timeout)
+        if self.encoding is None:
+            return estimate_tokens(text)
+        # encoding a long text takes a while, don't block other conversations
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.count, text)
+
+g_tokenizer = Tokenizer()
+
+def count_tokens(text: str) -> int:
+    return g_tokenizer.count(text)
+
+def prepare_cache(config_file: Optional[str] = None):
+    """Download the encoding into the configured cache directory, for hosts without internet access."""
+    import yaml
+    config = {}
+    if config_file:
+        with open(config_file) as f:
+            config = yaml.safe_load(f).get('tokenizer') or {}
+    tokenizer = Tokenizer(**config)
+    if not tokenizer.cache_dir:
+        tokenizer.cache_dir = '.db/tiktoken'
+    if not tokenizer.load():
+        raise Exception("the tokenizer could not be downloaded")
+    print(f"the {tokenizer.model} tokenizer is in {os.path.abspath(tokenizer.cache_dir)}")
@@ -0,0 +1,319 @@
+import asyncio
+import contextvars
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional
+
+import httpx
+from pymixin import log
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+default_path = 'traces.jsonl'
+service_name = 'chatgpt-mixin'
+
+@dataclass
+class Span:
+    name: str
+    # seconds since the start of the trace, negative for stages before it, like the websocket delivery
+    start: float
+    duration: float
+    attributes: Dict[str, Any]
+    error: Optional[str] = None
+    span_id: str = field(default_factory=lambda: random_id(8))
+
+def random_id(size: int) -> str:
+    return format(random.getrandbits(size * 8), f'0{size * 2}x')
+
+class Trace:
+    """Timed stages of handling one message.
+
+    Spans are recorded flat under the trace, stages may run in other tasks, like
+    hedged requests, as long as they were created from the message's context.
+    """
+
+    def __init__(self, tracer: 'Tracer', name: str, sampled: bool, attributes: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.sampled = sampled
+        self.attributes = attributes
+        self.trace_id = random_id(16)
+        self.span_id = random_id(8)
+        self.start_time = time.time()
+        self.start = time.monotonic()
+        self.duration = 0.0
+        self.spans: List[Span] = []
+        # the message handler and the tasks it was handed to, exported once all are done
+        self.holders = 1
+
+    def add_span(self, name: str, start: float, end: Optional[float] = None, error: Optional[str] = None, **attributes):
+        """Record a stage between the monotonic times `start` and `end`, now if not given."""
+        if end is None:
+            end = time.monotonic()
+        self.spans.append(Span(name, start - self.start, end - start, attributes, error))
+
+    def hold(self):
+        self.holders += 1
+
+    def release(self):
+        self.holders -= 1
+        if self.holders == 0:
+            self.duration = time.monotonic() - self.start
+            self.tracer.finish(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'start': self.start_time,
+            'duration': self.duration,
+            'attributes': self.attributes,
+            'spans': [
+                {'name': span.name, 'start': span.start, 'duration': span.duration, 'attributes': span.attributes, 'error': span.error}
+                for span in self.spans
+            ],
+        }
+
+current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar('current_trace', default=None)
+
+class SpanTimer:
+    __slots__ = ('trace', 'name', 'attributes', 'start')
+
+    def __init__(self, trace: Trace, name: str, attributes: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self) -> 'SpanTimer':
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        error = None
+        if exc_type is not None and not issubclass(exc_type, GeneratorExit):
+            error = repr(exc)
+        self.trace.add_span(self.name, self.start, error=error, **self.attributes)
+
+no_span = nullcontext()
+
+def span(name: str, **attributes):
+    """Time the enclosed block as a stage of the current trace, does nothing outside of one."""
+    trace = current_trace.get()
+    if trace is None:
+        return no_span
+    return SpanTimer(trace, name, attributes)
+
+def add_span(name: str, start: float, end: Optional[float] = None, **attributes):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_span(name, start, end, **attributes)
+
+def hold() -> Optional[Trace]:
+    """Keep the current trace open until the returned trace is released, e.g. by a task handling the message later."""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.hold()
+    return trace
+
+class SpanExporter:
+    async def export(self, traces: List[Trace]):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+class JsonLinesExporter(SpanExporter):
+    """Appends a JSON object per trace to a file."""
+
+    def __init__(self, path: str = default_path):
+        self.path = path
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='trace-writer')
+
+    async def export(self, traces: List[Trace]):
+        lines = ''.join(json.dumps(trace.to_dict(), ensure_ascii=False, default=str) + '\n' for trace in traces)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.write, lines)
+
+    def write(self, lines: str):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(lines)
+
+    async def close(self):
+        self.executor.shutdown()
+
+def otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+def otlp_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{'key': key, 'value': otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+def nanoseconds(seconds: float) -> str:
+    return str(int(seconds * 1e9))
+
+class OtlpExporter(SpanExporter):
+    """Posts traces to an OpenTelemetry collector with OTLP/HTTP in JSON encoding."""
+
+    def __init__(self, client: httpx.AsyncClient, endpoint: str = 'http://127.0.0.1:4318', headers: Optional[Dict[str, str]] = None):
+        self.client = client
+        self.url = endpoint.rstrip('/') + '/v1/traces'
+        self.headers = headers or {}
+
+    def to_otlp(self, traces: List[Trace]) -> Dict[str, Any]:
+        spans = []
+        for trace in traces:
+            spans.append({
+                'traceId': trace.trace_id,
+                'spanId': trace.span_id,
+                'name': trace.name,
+                # server
+                'kind': 2,
+                'startTimeUnixNano': nanoseconds(trace.start_time),
+                'endTimeUnixNano': nanoseconds(trace.start_time + trace.duration),
+                'attributes': otlp_attributes(trace.attributes),
+            })
+            for span in trace.spans:
+                otlp_span = {
+                    'traceId': trace.trace_id,
+                    'spanId': span.span_id,
+                    'parentSpanId': trace.span_id,
+                    'name': span.name,
+                    # internal
+                    'kind': 1,
+                    'startTimeUnixNano': nanoseconds(trace.start_time + span.start),
+                    'endTimeUnixNano': nanoseconds(trace.start_time + span.start + span.duration),
+                    'attributes': otlp_attributes(span.attributes),
+                }
+                if span.error:
+                    otlp_span['status'] = {'code': 2, 'message': span.error}
+                spans.append(otlp_span)
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': otlp_attributes({'service.name': service_name})},
+                'scopeSpans': [{'scope': {'name': 'chatgpt_mixin'}, 'spans': spans}],
+            }]
+        }
+
+    async def export(self, traces: List[Trace]):
+        r = await self.client.post(self.url, json=self.to_otlp(traces), headers=self.headers)
+        r.raise_for_status()
+
+class Tracer:
+    """Creates a trace per message and exports the sampled ones in batches.
+
+    A `sample_rate` share of the messages is traced. With `slow_threshold` set,
+    every message is traced, which costs a few clock reads per stage, and those
+    taking longer than `slow_threshold` seconds are exported too.
+    """
+
+    def __init__(self, exporter: Optional[SpanExporter] = None, sample_rate: float = 0.01, slow_threshold: float = 0.0,
+                flush_interval: float = 5.0, max_pending: int = 10000):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending: List[Trace] = []
+        self.task: Optional[asyncio.Task] = None
+        self.exported = 0
+        self.dropped = 0
+
+    @classmethod
+    def from_config(cls, config, client: httpx.AsyncClient) -> 'Tracer':
+        """A tracer that traces nothing if tracing is not configured."""
+        if not config or not config.get('enabled', True):
+            return cls(sample_rate=0.0)
+        config = dict(config)
+        config.pop('enabled', None)
+        exporter_name = config.pop('exporter', 'jsonl')
+        path = config.pop('path', default_path)
+        endpoint = config.pop('otlp_endpoint', 'http://127.0.0.1:4318')
+        headers = config.pop('otlp_headers', None)
+        if exporter_name == 'otlp':
+            exporter = OtlpExporter(client, endpoint, headers)
+        elif exporter_name == 'jsonl':
+            exporter = JsonLinesExporter(path)
+        else:
+            raise ValueError(f"unknown trace exporter: {exporter_name}")
+        return cls(exporter, **config)
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None and (self.sample_rate > 0 or self.slow_threshold > 0)
+
+    @contextmanager
+    def trace(self, name: str, **attributes) -> Iterator[Optional[Trace]]:
+        """Make a trace current for the enclosed block, it is exported once released by all holders."""
+        if not self.enabled:
+            yield None
+            return
+        sampled = random.random() < self.sample_rate
+        if not sampled and self.slow_threshold <= 0:
+            yield None
+            return
+        trace = Trace(self, name, sampled, attributes)
+        token = current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            current_trace.reset(token)
+            trace.release()
+
+    def finish(self, trace: Trace):
+        if not trace.sampled and trace.duration < self.slow_threshold:
+            return
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self.pending.append(trace)
+        if not self.task:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        traces, self.pending = self.pending, []
+        if not traces:
+            return
+        try:
+            await self.exporter.export(traces)
+            self.exported += len(traces)
+        except asyncio.CancelledError:
+            # exported by close
+            self.pending[:0] = traces
+            raise
+        except Exception as e:
+            self.dropped += len(traces)
+            logger.info("+++exporting %s traces failed: %s", len(traces), e)
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.exporter:
+            await self.flush()
+            await self.exporter.close()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'pending': len(self.pending),
+            'exported': self.exported,
+            'dropped': self.dropped,
+        }
@@ -0,0 +1,149 @@
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from pymixin import log
+
+from .response_cache import normalize_question
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+default_search_url = 'https://ddg-webapp-aagd.vercel.app/search'
+
+@dataclass
+class SearchResult:
+    body: str
+    href: str
+
+class SearchProvider(ABC):
+    """Where the /web command gets its results from."""
+
+    @abstractmethod
+    async def search(self, query: str, max_results: int) -> List[SearchResult]:
+        ...
+
+class WebappSearchProvider(SearchProvider):
+    """Searches with the ddg-webapp service."""
+
+    def __init__(self, client: httpx.AsyncClient, url: str = default_search_url):
+        self.client = client
+        self.url = url
+
+    async def search(self, query: str, max_results: int) -> List[SearchResult]:
+        r = await self.client.get(self.url, params={'max_results': max_results, 'q': f'"{query}"'})
+        r.raise_for_status()
+        return [SearchResult(result['body'], result['href']) for result in r.json()]
+
+class StaticSearchProvider(SearchProvider):
+    """Returns fixed results, for tests and offline use."""
+
+    def __init__(self, results: Optional[Dict[str, List[SearchResult]]] = None):
+        self.results = results or {}
+        self.searches = 0
+
+    async def search(self, query: str, max_results: int) -> List[SearchResult]:
+        self.searches += 1
+        return self.results.get(query, [])[:max_results]
+
+def split_message(message: str) -> Tuple[str, str]:
+    """Split `/web` arguments into the search query and the prompt, separated by `/p `."""
+    if message.count('/p ') == 1:
+        search, prompt = message.split('/p ')
+        return search, prompt
+    return message, message
+
+def format_prompt(results: List[SearchResult], prompt: str, date: datetime) -> str:
+    if not results:
+        return prompt
+    querys = []
+    querys.append("Web search results:\n\n")
+    for counter, result in enumerate(results, 1):
+        querys.append(f'[{counter}] "{result.body}"')
+        querys.append(f"Source: {result.href}")
+    querys.append(f"\nCurrent date: {date.strftime('%m/%d/%Y')}")
+    querys.append(f"\nInstructions: Using the provided web search results, write a comprehensive reply to the given prompt. Make sure to cite results using [[number](URL)] notation after the reference. If the provided search results refer to multiple subjects with the same name, write separate answers for each subject.\nPrompt: {prompt}")
+    return "\n".join(querys)
+
+class WebSearch:
+    """Web search for the /web command.
+
+    Results are cached for `ttl` seconds by normalized query, concurrent searches
+    for the same query share one request, at most `max_concurrency` requests run
+    at a time and each is given up after `timeout` seconds.
+    """
+
+    def __init__(self, provider: SearchProvider, ttl: float = 3600.0, max_entries: int = 1000,
+                timeout: float = 5.0, max_concurrency: int = 4, max_results: int = 3):
+        self.provider = provider
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.max_results = max_results
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.entries: 'OrderedDict[str, Tuple[float, List[SearchResult]]]' = OrderedDict()
+        self.searches: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @classmethod
+    def from_config(cls, config, client: httpx.AsyncClient) -> 'WebSearch':
+        config = dict(config or {})
+        provider = WebappSearchProvider(client, config.pop('url', default_search_url))
+        return cls(provider, **config)
+
+    async def search(self, query: str) -> List[SearchResult]:
+        """Return the results for `query`, no results if the search failed or timed out."""
+        key = normalize_question(query)
+        try:
+            expiration, results = self.entries[key]
+            if expiration > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return results
+            del self.entries[key]
+        except KeyError:
+            pass
+        self.misses += 1
+
+        future = self.searches.get(key)
+        if not future:
+            future = asyncio.ensure_future(self.fetch(key, query))
+            self.searches[key] = future
+            future.add_done_callback(lambda _: self.searches.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def fetch(self, key: str, query: str) -> List[SearchResult]:
+        try:
+            async with self.semaphore:
+                results = await asyncio.wait_for(self.provider.search(query, self.max_results), self.timeout)
+        except Exception as e:
+            self.errors += 1
+            logger.info("+++web search for %s failed: %s", query, repr(e))
+            return []
+        self.entries[key] = (time.time() + self.ttl, results)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return results
+
+    async def prompt(self, message: str) -> str:
+        search, prompt = split_message(message)
+        results = await self.search(search)
+        logger.info("++++++results: %s", results)
+        return format_prompt(results, prompt, datetime.now())
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
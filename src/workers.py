@@ -0,0 +1,160 @@
+import asyncio
+import multiprocessing
+import threading
+import zlib
+from typing import Any, Callable, List, Optional
+
+from pymixin import log
+
+logger = log.get_logger(__name__)
+logger.addHandler(log.handler)
+
+# called in the worker process with (config_file, index, inbox, replies)
+WorkerTarget = Callable[[str, int, Any, Any], None]
+OnText = Callable[[str, str, str], None]
+
+def shard_for(key: str, workers: int) -> int:
+    """Index of the worker handling `key`, the same in every process and after restarts."""
+    return zlib.crc32(key.encode()) % workers
+
+class WorkerPool:
+    """Worker processes answering the messages received by this process.
+
+    A message is routed to the worker `shard_for` its key, so the state kept for
+    a key stays in one process. Workers put `('ready', index)`,
+    `('text', conversation_id, user_id, text)` and `('invalidate', index, conversation_ids)`
+    on one shared reply queue, texts are passed to `on_text` on the event loop of this
+    process, which sends them, invalidations are passed on to the other workers.
+    Besides messages, inboxes get `'reload'` to apply the config file again,
+    `('invalidate', conversation_ids)` to drop conversations from their caches and
+    `None` to exit.
+    Workers that exit are restarted after `restart_delay` seconds.
+    """
+
+    def __init__(self, config_file: str, workers: int, target: WorkerTarget, restart_delay: float = 5.0):
+        self.config_file = config_file
+        self.workers = workers
+        self.target = target
+        self.restart_delay = restart_delay
+        self.context = multiprocessing.get_context('spawn')
+        self.inboxes = [self.context.Queue() for _ in range(workers)]
+        self.replies = self.context.Queue()
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * workers
+        self.ready: List[asyncio.Event] = []
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.on_text: Optional[OnText] = None
+        self.reader: Optional[threading.Thread] = None
+        self.monitor_task: Optional[asyncio.Task] = None
+        self.closing = False
+        self.dispatched = 0
+        self.texts = 0
+        self.restarts = 0
+
+    async def start(self, on_text: OnText):
+        self.loop = asyncio.get_running_loop()
+        self.on_text = on_text
+        self.ready = [asyncio.Event() for _ in range(self.workers)]
+        self.reader = threading.Thread(target=self.read_replies, name='worker-replies', daemon=True)
+        self.reader.start()
+        # the first worker creates and upgrades the databases before the others open them
+        self.spawn(0)
+        await self.wait_ready(0)
+        for index in range(1, self.workers):
+            self.spawn(index)
+        self.monitor_task = asyncio.create_task(self.monitor())
+
+    def spawn(self, index: int):
+        process = self.context.Process(
+            target=self.target,
+            args=(self.config_file, index, self.inboxes[index], self.replies),
+            name=f'chatgpt-mixin-worker-{index}',
+            daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+        logger.info("+++started worker %s, pid %s", index, process.pid)
+
+    async def wait_ready(self, index: int):
+        while not self.ready[index].is_set():
+            process = self.processes[index]
+            if not process.is_alive():
+                raise Exception(f"worker {index} exited with code {process.exitcode}")
+            try:
+                await asyncio.wait_for(self.ready[index].wait(), 1.0)
+            except asyncio.TimeoutError:
+                pass
+
+    def read_replies(self):
+        while True:
+            reply = self.replies.get()
+            if reply is None:
+                return
+            self.loop.call_soon_threadsafe(self.on_reply, reply)
+
+    def on_reply(self, reply: tuple):
+        if reply[0] == 'text':
+            self.texts += 1
+            self.on_text(*reply[1:])
+        elif reply[0] == 'invalidate':
+            # conversations swept by one worker are cached by the others too
+            for index, inbox in enumerate(self.inboxes):
+                if index != reply[1]:
+                    inbox.put(('invalidate', reply[2]))
+        elif reply[0] == 'ready':
+            logger.info("+++worker %s is ready", reply[1])
+            self.ready[reply[1]].set()
+
+    async def monitor(self):
+        while True:
+            await asyncio.sleep(self.restart_delay)
+            for index, process in enumerate(self.processes):
+                if self.closing:
+                    return
+                if process.is_alive():
+                    continue
+                logger.warning("+++worker %s exited with code %s, restarting", index, process.exitcode)
+                self.ready[index].clear()
+                self.restarts += 1
+                self.spawn(index)
+
+    def dispatch(self, key: str, message: Any) -> int:
+        """Queue `message` for the worker of `key`, messages of a worker being restarted wait for it."""
+        index = shard_for(key, self.workers)
+        self.inboxes[index].put(message)
+        self.dispatched += 1
+        return index
+
+    def reload(self):
+        # workers being restarted read the config file anyway
+        for inbox in self.inboxes:
+            inbox.put('reload')
+
+    async def close(self, timeout: float = 30.0):
+        """Stop the workers and pass on the texts they sent before exiting."""
+        if self.closing:
+            return
+        self.closing = True
+        if self.monitor_task:
+            self.monitor_task.cancel()
+        for inbox in self.inboxes:
+            inbox.put(None)
+        loop = asyncio.get_running_loop()
+        for index, process in enumerate(self.processes):
+            if not process:
+                continue
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                logger.warning("+++worker %s did not stop in %s seconds, terminating", index, timeout)
+                process.terminate()
+        if self.reader:
+            self.replies.put(None)
+            await loop.run_in_executor(None, self.reader.join)
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'alive': sum(1 for process in self.processes if process and process.is_alive()),
+            'dispatched': self.dispatched,
+            'texts': self.texts,
+            'restarts': self.restarts,
+        }